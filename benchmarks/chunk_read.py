@@ -0,0 +1,117 @@
+# Compares the pread based Chunk with the seek + read one it replaced.
+# Every variant streams the whole file to /dev/null the way a transport
+# would and runs in its own process so peak RSS is not shared.
+#
+#     python benchmarks/chunk_read.py [--size-mb 1024] [--chunk-mb 100]
+
+import os
+import sys
+import argparse
+import resource
+import subprocess
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from qiwigg._chunk import Chunk
+
+
+class LegacyChunk():
+    def __init__(self, f, offset, max_size):
+        f.seek(0, os.SEEK_END)
+
+        self.final_offset = min(f.tell(), offset + max_size)
+        self.size = self.final_offset - offset
+        self.f = f
+
+        f.seek(offset, os.SEEK_SET)
+
+    def read(self, limit=-1):
+        left = self.final_offset - self.f.tell()
+
+        if limit == -1 or limit > left:
+            limit = left
+
+        return self.f.read(limit)
+
+
+def read_blocks(f, chunk, sink):
+    # what pycurl does with a read callback: read(16384) until empty
+    while True:
+        data = chunk.read(16384)
+        if not data:
+            break
+        sink.write(data)
+
+
+def new_views(f, chunk, sink):
+    for view in chunk.views():
+        sink.write(view)
+
+
+# legacy-read and pread-read run the same loop, only the chunk differs:
+# seek + read of the shared file object against pread
+VARIANTS = {
+    "legacy-read": (LegacyChunk, read_blocks),
+    "pread-read": (Chunk, read_blocks),
+    "pread-views": (Chunk, new_views),
+}
+
+
+def run_variant(name, path, chunk_size):
+    chunk_class, consume = VARIANTS[name]
+    size = os.path.getsize(path)
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    with open(path, "rb") as f, open(os.devnull, "wb", buffering=0) as sink:
+        for offset in range(0, size, chunk_size):
+            consume(f, chunk_class(f, offset, chunk_size), sink)
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - start_cpu
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    gb = size / 1e9
+    print(
+        f"{name:12} {wall / gb:7.3f} s/GB wall {cpu / gb:7.3f} s/GB CPU "
+        f"{rss / 1024:8.1f} MiB peak RSS"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--chunk-mb", type=int, default=100)
+    parser.add_argument("--variant", choices=VARIANTS)
+    parser.add_argument("--path")
+    args = parser.parse_args()
+
+    chunk_size = args.chunk_mb * 1000000
+
+    if args.variant is not None:
+        run_variant(args.variant, args.path, chunk_size)
+        return
+
+    with tempfile.NamedTemporaryFile() as tmp:
+        block = os.urandom(1048576)
+        for _ in range(args.size_mb):
+            tmp.write(block)
+        tmp.flush()
+
+        for name in VARIANTS:
+            subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--variant",
+                    name,
+                    "--path",
+                    tmp.name,
+                    "--chunk-mb",
+                    str(args.chunk_mb),
+                ],
+                check=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# Compares the folder list parser with the BeautifulSoup one it replaced
+# on synthetic dashboard pages.
+#
+#     python benchmarks/dashboard_parse.py [--folders 100 1000 10000]
+
+import os
+import sys
+import argparse
+import json
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from qiwigg import _qiwitypes
+from qiwigg._dashboard import parse_folders
+
+
+def legacy_parse_folders(content):
+    import bs4
+
+    soup = bs4.BeautifulSoup(content, features="html.parser")
+    for script in soup.select("script"):
+        if script.text.startswith('self.__next_f.push([1,"f:'):
+            start = script.text.find('"')
+            end = script.text.rfind('"') + 1
+            tmp1 = json.loads(script.text[start:end])
+            start = tmp1.find("[")
+            end = tmp1.rfind("]") + 1
+            tmp2 = json.loads(tmp1[start:end])
+            for element in tmp2:
+                if isinstance(element, dict):
+                    if "data" in element:
+                        return [
+                            _qiwitypes.QiwiFolder.from_object(x)
+                            for x in element["data"]
+                        ]
+
+
+def flight_script(payload):
+    return f"<script>self.__next_f.push([1,{json.dumps(payload)}])</script>"
+
+
+def make_page(folder_count):
+    folders = [{"_id": "root", "folderName": "Home"}]
+    folders += [
+        {
+            "_id": f"{i:024x}",
+            "folderName": f'folder "{i}" \\ {"x" * 20}',
+            "parentFolder": "root" if i < 10 else f"{i // 10:024x}",
+        }
+        for i in range(1, folder_count)
+    ]
+    flight = json.dumps(["$", "$L1", None, {"data": folders, "user": {}}])
+
+    parts = ["<!DOCTYPE html><html><head><title>Dashboard</title></head><body>"]
+    parts += [f'<div class="row"><span>{i}</span></div>' for i in range(2000)]
+    parts += [flight_script(f"{i}:" + "y" * 2000 + "\n") for i in range(50)]
+    parts.append(flight_script(f"f:{flight}\n"))
+    parts += [flight_script(f"z{i}:" + "w" * 2000 + "\n") for i in range(50)]
+    parts.append("</body></html>")
+    return "".join(parts).encode()
+
+
+def measure(function, content, repeat):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        folders = function(content)
+    seconds = (time.perf_counter() - start) / repeat
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return folders, seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--folders", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for folder_count in args.folders:
+        content = make_page(folder_count)
+        print(f"{folder_count} folders, {len(content) / 1e6:.2f} MB page")
+        results = []
+        for name, function in (
+            ("bs4", legacy_parse_folders),
+            ("scan", parse_folders),
+        ):
+            folders, seconds, peak = measure(function, content, args.repeat)
+            results.append([(f.id, f.name, f.parent_id) for f in folders])
+            print(
+                f"    {name:5} {seconds * 1000:9.2f} ms "
+                f"{peak / 2**20:9.2f} MiB peak allocated"
+            )
+        assert results[0] == results[1]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Guards the cold start of "import qiwigg" and of the CLI's --version:
+# neither may pull in the optional or heavy dependencies, and both have to
+# finish within a time budget. Exits with status 1 when either is broken.
+#
+#     python benchmarks/import_time.py [--repeat 10] [--max-ms 150]
+
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+HEAVY_MODULES = (
+    "requests",
+    "urllib3",
+    "bs4",
+    "Cryptodome",
+    "pycurl",
+    "aiohttp",
+    "asyncio",
+    "http.cookiejar",
+    "ssl",
+)
+
+CHECK_MODULES = (
+    "import sys, qiwigg; "
+    f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+)
+
+
+def run(command):
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE="1")
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, *command], env=env, capture_output=True, text=True
+    )
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--max-ms", type=float, default=150)
+    args = parser.parse_args()
+
+    failed = False
+
+    _, result = run(["-c", CHECK_MODULES])
+    loaded = result.stdout.strip()
+    if result.returncode != 0 or loaded:
+        print(f"import qiwigg loads: {loaded or result.stderr}")
+        failed = True
+
+    baseline = statistics.median(
+        run(["-c", "pass"])[0] for _ in range(args.repeat)
+    )
+    for name, command in (
+        ("import qiwigg", ["-c", "import qiwigg"]),
+        ("qiwigg --version", ["-m", "qiwigg", "--version"]),
+    ):
+        times = []
+        for _ in range(args.repeat):
+            seconds, result = run(command)
+            if result.returncode != 0:
+                print(f"{name} failed:\n{result.stderr}")
+                sys.exit(1)
+            times.append(seconds)
+        median = (statistics.median(times) - baseline) * 1000
+        print(f"{name:18} {median:8.1f} ms over interpreter start")
+        if median > args.max_ms:
+            print(f"    over the {args.max_ms} ms budget")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# Uploads through every available transport to the fake server from
+# qiwigg.testing and reports end to end throughput, CPU time per GB and
+# API requests per second. The server runs in its own process so only the
+# client's CPU time is counted. --stream reads the file as a pipe would be
+# read, through upload_stream.
+#
+#     python benchmarks/offline_upload.py [--size-mb 1024] [--chunk-mb 100]
+#         [--parallel-parts 4] [--latency 0.005] [--bandwidth 100000000]
+#         [--failures 0.05] [--api-ops 500] [--stream]
+
+import os
+import sys
+import argparse
+import subprocess
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+from qiwigg import QiwiGG, TransportConfig, RetryPolicy
+from qiwigg.testing import configure
+
+
+def start_server(args):
+    command = [
+        sys.executable,
+        "-m",
+        "qiwigg.testing",
+        "--latency",
+        str(args.latency),
+        "--failures",
+        str(args.failures),
+    ]
+    if args.bandwidth is not None:
+        command += ["--bandwidth", str(args.bandwidth)]
+    server = subprocess.Popen(
+        command,
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        text=True,
+        env={**os.environ, "PYTHONPATH": ROOT},
+    )
+    return server, server.stdout.readline().strip()
+
+
+def backends():
+    try:
+        import pycurl
+    except ModuleNotFoundError:
+        return ["requests"]
+    return ["curl", "requests"]
+
+
+def run_backend(backend, url, path, args, workdir):
+    qiwi = configure(
+        QiwiGG(
+            "user@example.com",
+            "password",
+            os.path.join(workdir, f"{backend}-cookies.txt"),
+            transport_config=TransportConfig(
+                backend=backend, progress_meter=False
+            ),
+            retry_policy=RetryPolicy(base_delay=0.05, throttle_delay=0.05),
+        ),
+        url,
+    )
+    # log in before anything is timed
+    qiwi.get_files()
+
+    size = os.path.getsize(path)
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    if args.stream:
+        with open(path, "rb", buffering=0) as f:
+            file = qiwi.upload_stream(
+                f,
+                os.path.basename(path),
+                size,
+                chunk_size=args.chunk_mb * 1000000,
+                callback=None,
+                parallel_parts=args.parallel_parts,
+            )
+    else:
+        file = qiwi.upload_file(
+            path,
+            metadata_path=os.path.join(workdir, f"{backend}.qiwi_upload"),
+            chunk_size=args.chunk_mb * 1000000,
+            callback=None,
+            parallel_parts=args.parallel_parts,
+        )
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - start_cpu
+
+    start = time.perf_counter()
+    qiwi.bulk_move_files([file.id] * args.api_ops, None, max_workers=8)
+    moves = args.api_ops / (time.perf_counter() - start)
+
+    listings = max(1, args.api_ops // 10)
+    start = time.perf_counter()
+    for _ in range(listings):
+        qiwi.get_files()
+    lists = listings / (time.perf_counter() - start)
+
+    qiwi.close()
+    gb = size / 1e9
+    print(
+        f"{backend:9} {size / wall / 1e6:8.1f} MB/s {cpu / gb:7.3f} s/GB CPU "
+        f"{file.upload_stats['retries']:3} retries "
+        f"{moves:8.1f} moves/s {lists:8.1f} listings/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--chunk-mb", type=int, default=100)
+    parser.add_argument("--parallel-parts", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--bandwidth", type=float)
+    parser.add_argument("--failures", type=float, default=0.0)
+    parser.add_argument("--api-ops", type=int, default=500)
+    parser.add_argument("--backend", choices=["curl", "requests"])
+    parser.add_argument("--stream", action="store_true")
+    args = parser.parse_args()
+
+    server, url = start_server(args)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "upload.bin")
+            block = os.urandom(1048576)
+            with open(path, "wb") as f:
+                for _ in range(args.size_mb):
+                    f.write(block)
+
+            for backend in [args.backend] if args.backend else backends():
+                run_backend(backend, url, path, args, workdir)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# Compares saving resume metadata after every part by rewriting the whole
+# JSON file, as upload_file used to, with appending to the journal and with
+# a row per part in the SQLite ResumeStore.
+#
+#     python benchmarks/resume_journal.py [--parts 1000 10000]
+
+import os
+import sys
+import argparse
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from qiwigg._utils import save_data
+from qiwigg._journal import UploadJournal
+from qiwigg._resumestore import ResumeStore
+
+
+def metadata(parts):
+    return {
+        "info": {"result": "0" * 24, "key": "k" * 40, "uploadId": "u" * 120},
+        "chunk_size": 5242880,
+        "etags": [None] * parts,
+    }
+
+
+def rewrite(path, parts):
+    data = metadata(parts)
+    save_data(path, data)
+    for index in range(parts):
+        data["etags"][index] = [f"{index:032x}", 5242880]
+        save_data(path, data)
+
+
+def journal(path, parts):
+    data = metadata(parts)
+    store = UploadJournal(path)
+    store.save(data)
+    for index in range(parts):
+        data["etags"][index] = [f"{index:032x}", 5242880]
+        store.save(data, index)
+
+
+def sqlite(path, parts):
+    # the database is kept next to the file it resumes, so the sizes compare
+    with ResumeStore(path + ".sqlite") as store:
+        data, save, delete = store.load(path)
+        data.update(metadata(parts))
+        save()
+        for index in range(parts):
+            data["etags"][index] = [f"{index:032x}", 5242880]
+            save(index)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--parts", type=int, nargs="+", default=[1000, 10000])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "file.qiwi_upload")
+        for parts in args.parts:
+            for name, save in (
+                ("rewrite", rewrite),
+                ("journal", journal),
+                ("sqlite", sqlite),
+            ):
+                # the store looks the file up, so there has to be one
+                open(path, "wb").close()
+                start = time.perf_counter()
+                save(path, parts)
+                seconds = time.perf_counter() - start
+                files = [os.path.join(directory, f) for f in os.listdir(directory)]
+                size = sum(os.path.getsize(f) for f in files)
+                print(
+                    f"{name:8} {parts:6} parts {seconds:8.3f} s "
+                    f"{1e6 * seconds / parts:9.1f} us/part "
+                    f"{size / 1024:8.1f} KiB"
+                )
+                for f in files:
+                    os.remove(f)
+
+
+if __name__ == "__main__":
+    main()
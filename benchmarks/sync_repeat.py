@@ -0,0 +1,68 @@
+# Syncs a generated tree of small files to the fake server from
+# qiwigg.testing, then times runs where nothing and where one file changed
+# and counts the API requests each one makes.
+#
+#     python benchmarks/sync_repeat.py [--files 2000] [--dirs 50]
+
+import os
+import sys
+import argparse
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from qiwigg import QiwiGG, TransportConfig
+from qiwigg.testing import FakeQiwi
+
+
+def make_tree(root, files, dirs):
+    for index in range(files):
+        directory = os.path.join(root, f"dir{index % dirs}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"file{index}.bin"), "wb") as f:
+            f.write(os.urandom(64))
+
+
+def timed_sync(server, qiwi, root, label):
+    requests = sum(server.requests.values())
+    start = time.perf_counter()
+    result = qiwi.sync_directory(root, callback=None, max_files=8)
+    seconds = time.perf_counter() - start
+    print(
+        f"{label:12} {seconds:8.3f} s {len(result.uploaded):6} uploaded "
+        f"{result.unchanged:6} unchanged "
+        f"{sum(server.requests.values()) - requests:6} requests"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--dirs", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir, FakeQiwi() as server:
+        root = os.path.join(workdir, "tree")
+        make_tree(root, args.files, args.dirs)
+        qiwi = server.configure(
+            QiwiGG(
+                server.email,
+                server.password,
+                os.path.join(workdir, "cookies.txt"),
+                transport_config=TransportConfig(progress_meter=False),
+            )
+        )
+
+        timed_sync(server, qiwi, root, "first run")
+        timed_sync(server, qiwi, root, "unchanged")
+        with open(os.path.join(root, "dir0", "file0.bin"), "ab") as f:
+            f.write(b"changed")
+        timed_sync(server, qiwi, root, "one changed")
+        os.remove(os.path.join(root, ".qiwigg-sync.json"))
+        timed_sync(server, qiwi, root, "no state")
+        qiwi.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,20 @@
 from ._exceptions import *
 from ._qiwitypes import *
 from ._qiwi import *
+from ._upload import *
+from ._bulk import *
+from ._sync import *
+from ._ratelimit import *
+from ._retry import *
+
+
+def __getattr__(name):
+    # asyncio and aiohttp are only imported by code that uses AsyncQiwiGG,
+    # the HTTP server only by code that uses the daemon
+    if name == "AsyncQiwiGG":
+        from ._async import AsyncQiwiGG
+        return AsyncQiwiGG
+    if name in ("Daemon", "DaemonClient"):
+        from . import _daemon
+        return getattr(_daemon, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,10 +1,35 @@
 import sys
 import argparse
+import hashlib
 import json
+import textwrap
 
+from functools import partial
 from pathlib import Path
 
-from qiwigg import _qiwi, _qiwitypes
+from qiwigg import _qiwi, _qiwitypes, _utils, _ratelimit
+
+
+def chunk_size_type(value):
+    if value == "auto":
+        return value
+    return int(value)
+
+
+def byte_rate_type(value):
+    # bytes per second with an optional k, m or g suffix (powers of 1024)
+    units = {"k": 2**10, "m": 2**20, "g": 2**30}
+    unit = units.get(value[-1:].lower(), 1)
+    if unit > 1:
+        value = value[:-1]
+    rate = float(value) * unit
+    if rate <= 0:
+        raise ValueError(value)
+    return rate
+
+
+def hashes_type(value):
+    return tuple(name.strip().lower() for name in value.split(",") if name.strip())
 
 
 def pretty_print_folders(folders):
@@ -39,6 +64,11 @@ _action_choices = (
     "move_files",
     "move_all_files",
     "delete_files",
+    "list_pending",
+    "resume_all",
+    "rebuild_dedup",
+    "sync",
+    "serve",
 )
 parser.add_argument(
     "-a",
@@ -75,17 +105,165 @@ parser.add_argument(
     action="store_true",
     help="return JSON data",
 )
+parser.add_argument(
+    "--ndjson",
+    action="store_true",
+    help="return JSON data, one record per line as soon as it's available",
+)
 parser.add_argument(
     "--to",
     help=(
-        "folder ID, used for following actions as a destination folder: "
-        "upload, create_folders, move_files, move_all_files; defaults to main folder"
+        "folder ID or path like /photos/2023, used for following actions as "
+        "a destination folder: upload, create_folders, move_files, "
+        "move_all_files; defaults to main folder"
     ),
 )
+parser.add_argument(
+    "--refresh",
+    action="store_true",
+    help="reload folders from qiwi.gg instead of using the cached folder list",
+)
 parser.add_argument(
     "--chunk-size",
+    type=chunk_size_type,
+    help=(
+        "chunk size for upload, defaults to 100000000 bytes (100MB); "
+        "auto picks it from file size and speed of recent uploads"
+    ),
+)
+parser.add_argument(
+    "--parallel-parts",
+    type=int,
+    default=1,
+    metavar="N",
+    help="number of chunks of a file uploaded at once, defaults to 1",
+)
+parser.add_argument(
+    "--parallel-files",
+    type=int,
+    default=1,
+    metavar="N",
+    help="number of files uploaded at once, defaults to 1",
+)
+parser.add_argument(
+    "--max-parts",
+    type=int,
+    metavar="N",
+    help="limit of chunks uploaded at once across all files",
+)
+parser.add_argument(
+    "--max-inflight-bytes",
+    type=int,
+    metavar="BYTES",
+    help="limit of bytes in chunks uploaded at once across all files",
+)
+parser.add_argument(
+    "--limit-rate",
+    type=byte_rate_type,
+    metavar="RATE",
+    help=(
+        "limit of upload speed in bytes per second across all chunks and "
+        "files, k, m and g suffixes are accepted, e.g. 500k or 10m"
+    ),
+)
+parser.add_argument(
+    "--metrics-dir",
+    type=Path,
+    metavar="DIR",
+    help=(
+        "write a JSON summary of every upload and Prometheus textfile "
+        "collector metrics (qiwigg.prom) to this directory"
+    ),
+)
+parser.add_argument(
+    "--hashes",
+    type=hashes_type,
+    metavar="NAMES",
+    help=(
+        "comma separated hashes computed while uploading, e.g. md5,sha256"
+    ),
+)
+parser.add_argument(
+    "--check-etags",
+    action="store_true",
+    help=(
+        "with --hashes md5, upload a chunk again when its ETag isn't its MD5; "
+        "don't use it with buckets encrypted with KMS"
+    ),
+)
+parser.add_argument(
+    "--size",
+    type=int,
+    metavar="BYTES",
+    help="size of the data read from stdin when uploading -, required with it",
+)
+parser.add_argument(
+    "--name",
+    help="file name for the data read from stdin when uploading -",
+)
+parser.add_argument(
+    "--buffered-parts",
+    type=int,
+    metavar="N",
+    help=(
+        "chunks of stdin kept in memory while uploading -, defaults to "
+        "--parallel-parts + 1"
+    ),
+)
+parser.add_argument(
+    "--resume-store",
+    action="store_true",
+    help=(
+        "keep resume data of uploads in uploads.sqlite in the config directory "
+        "instead of a .qiwi_upload file next to each file; list_pending and "
+        "resume_all work with uploads started this way"
+    ),
+)
+parser.add_argument(
+    "--dedup",
+    action="store_true",
+    help=(
+        "don't upload files already uploaded with --dedup, return the "
+        "uploaded file instead (moved to --to if given); the index is "
+        "dedup.sqlite in the config directory"
+    ),
+)
+parser.add_argument(
+    "--port",
     type=int,
-    help="chunk size for upload, defaults to 100000000 bytes (100MB)",
+    default=0,
+    help="localhost port the serve action listens on, defaults to any free one",
+)
+parser.add_argument(
+    "--max-jobs",
+    type=int,
+    default=2,
+    metavar="N",
+    help="upload jobs the serve action runs at once, defaults to 2",
+)
+parser.add_argument(
+    "--no-daemon",
+    action="store_true",
+    help=(
+        "run upload_files, move_files, delete_files and list_files here even "
+        "when a daemon started with -a serve is running"
+    ),
+)
+parser.add_argument(
+    "--concurrency",
+    type=int,
+    default=1,
+    metavar="N",
+    help=(
+        "number of files moved or deleted at once, defaults to 1; "
+        "failed files are reported and the rest carry on"
+    ),
+)
+parser.add_argument(
+    "--rate",
+    type=float,
+    metavar="N",
+    help="limit of move/delete requests per second",
 )
 parser.add_argument("args", nargs="*")
 
@@ -122,15 +300,152 @@ if args.chunk_size is None:
     except FileNotFoundError:
         pass
     else:
-        args.chunk_size = int(chunk_txt.splitlines()[0])
+        args.chunk_size = chunk_size_type(chunk_txt.splitlines()[0])
+
+def output(record, text):
+    # a line of text, or with --ndjson the record as soon as it's known
+    if args.ndjson:
+        print(json.dumps(record, cls=_qiwitypes.QiwiJSONEncoder), flush=True)
+    elif not args.json:
+        print(text)
+
+
+def report_bulk(verb, item, error):
+    if error is not None:
+        print(f"{item} failed: {error}", file=sys.stderr)
+    else:
+        output(item, f"{item} {verb}")
+
+
+def print_json_array(records):
+    # same text as json.dumps(list(records), indent=4) without building
+    # the list first
+    separator = "[\n"
+    for record in records:
+        text = json.dumps(record, indent=4, cls=_qiwitypes.QiwiJSONEncoder)
+        print(separator + textwrap.indent(text, "    "), end="")
+        separator = ",\n"
+    print("[]" if separator == "[\n" else "\n]")
+
+
+def run_on_daemon(client):
+    # submits the action as a job to the running daemon and prints what
+    # happens the way the action does when it runs here
+    import http.client
+
+    request = {"args": args.args, "to": args.to}
+    if args.action == "upload_files":
+        request.update(
+            args=[str(Path(arg).resolve()) for arg in args.args],
+            parallel_files=args.parallel_files,
+            max_parts=args.max_parts,
+            max_bytes=args.max_inflight_bytes,
+            chunk_size=args.chunk_size,
+            parallel_parts=args.parallel_parts,
+            hashes=args.hashes,
+        )
+    else:
+        request.update(concurrency=args.concurrency, rate=args.rate)
+    job_id = client.submit(args.action, **request)
+    print(f"job {job_id} submitted to the daemon", file=sys.stderr)
+
+    verb = "moved" if args.action == "move_files" else "deleted"
+    sizes = {}
+    finished = None
+    try:
+        for event in client.events(job_id):
+            kind = event["event"]
+            if kind == "upload_started":
+                sizes[event["path"]] = event["size"]
+                print(f"uploading {event['path']}", file=sys.stderr)
+            elif kind == "part_uploaded":
+                _utils.named_upload_callback(event["path"])(
+                    event["uploaded"], sizes[event["path"]]
+                )
+            elif kind == "file_uploaded":
+                file = event["file"]
+                output(file, f"{file['url']} {file['name']}")
+            elif kind == "item_done":
+                report_bulk(verb, event["item"], event["error"])
+            elif kind == "job_finished":
+                finished = event
+    except (OSError, http.client.HTTPException):
+        pass
+
+    if finished is None:
+        # the daemon was stopped or killed, or the connection broke; a job
+        # it was running runs again when it starts
+        print(
+            f"daemon connection lost, job {job_id} may not have finished",
+            file=sys.stderr,
+        )
+        return 10
+    if finished["status"] != "done":
+        print(
+            f"job {job_id} {finished['status']}: {finished['error']}",
+            file=sys.stderr,
+        )
+        return 7
+    result = finished["result"]
+    if args.action == "list_files":
+        for file in result["data"]:
+            output(file, f"{file['name']} (ID:{file['id']})")
+    if args.json:
+        print(json.dumps(result["data"], indent=4))
+    if result.get("retries"):
+        print(f"{result['retries']} requests were retried", file=sys.stderr)
+    return 7 if result.get("failed") else 0
+
+
+# with a daemon running the action is a job for it, unless it needs options
+# the daemon takes from its own command line
+if (
+    args.action in ("upload_files", "move_files", "delete_files", "list_files")
+    and not args.no_daemon
+    and (args.args or args.action == "list_files")
+    and args.args != ["-"]
+    and args.limit_rate is None
+    and args.metrics_dir is None
+    and not args.resume_store
+    and not args.dedup
+    and not args.check_etags
+):
+    from qiwigg import _daemon
+
+    client = _daemon.DaemonClient.find(args.config)
+    if client is not None:
+        sys.exit(run_on_daemon(client))
+
+qiwi = _qiwi.QiwiGG(
+    args.email,
+    args.password,
+    args.config / "cookies.txt",
+    proxies,
+    chunk_sizer=_qiwi.ChunkSizer(args.config / "upload-history.json"),
+    session_cache_path=args.config / "session.json",
+    folder_cache=_qiwi.FolderCache(args.config / "folders.json"),
+    # long uploads and the daemon get new tokens before they're needed
+    refresh_ahead=15,
+    check_etags=args.check_etags,
+)
+
+if args.limit_rate is not None:
+    _ratelimit.set_upload_rate(args.limit_rate)
+
+if args.to is not None and args.to.startswith("/"):
+    args.to = qiwi.find_folder(args.to).id
 
-qiwi = _qiwi.QiwiGG(args.email, args.password, args.config / "cookies.txt", proxies)
 
 data = None
+result = None
+streamed = False
 
 if args.action == "list_folders":
-    data = qiwi.get_folders()
-    if not args.json:
+    data = qiwi.get_folders(refresh=args.refresh)
+    if args.ndjson:
+        for folder in data:
+            output(folder, None)
+    elif not args.json:
         pretty_print_folders(data)
 elif args.action == "create_folders":
     if len(args.args) == 0:
@@ -140,8 +455,7 @@ elif args.action == "create_folders":
     for arg in args.args:
         folder = qiwi.create_folder(arg, args.to)
         data.append(folder)
-        if not args.json:
-            print(folder)
+        output(folder, folder)
 elif args.action == "delete_folders":
     if len(args.args) == 0:
         print("Supply at least one folder ID as argument!", file=sys.stderr)
@@ -150,70 +464,242 @@ elif args.action == "delete_folders":
     for arg in args.args:
         qiwi.delete_folder(arg)
         data.append(arg)
-        if not args.json:
-            print(f"{arg} deleted")
+        output(arg, f"{arg} deleted")
 elif args.action == "list_files":
     if len(args.args) == 0:
         arg = None
     else:
         arg = args.args[0]
-    data = qiwi.get_files(arg)
-    if not args.json:
-        for file in data:
-            print(file)
+    if args.json:
+        print_json_array(qiwi.iter_files(arg))
+        streamed = True
+    else:
+        for file in qiwi.iter_files(arg):
+            output(file, file)
 elif args.action == "move_files":
     if len(args.args) == 0:
         print("Supply at least one file ID as argument!", file=sys.stderr)
         sys.exit(3)
-    data = {"moved": []}
-    for arg in args.args:
-        folder_id = qiwi.move_file(arg, args.to)
-        if "to" not in data:
-            data["to"] = folder_id
-        data["moved"].append(arg)
-        if not args.json:
-            print(f"{arg} moved")
+    result = qiwi.bulk_move_files(
+        args.args,
+        args.to,
+        args.concurrency,
+        args.rate,
+        on_done=partial(report_bulk, "moved"),
+    )
+    data = result.summary("moved")
+    if result.succeeded:
+        data["to"] = "nullFolder" if args.to is None else args.to
 elif args.action == "move_all_files":
     if len(args.args) == 0:
         print("Supply at least one folder ID as argument!", file=sys.stderr)
         sys.exit(4)
-    data = {"moved": []}
+    files = []
     for arg in args.args:
         if arg == args.to:
             continue
-        for file in qiwi.get_files(arg):
-            folder_id = qiwi.move_file(file, args.to)
-            if "to" not in data:
-                data["to"] = folder_id
-            data["moved"].append(file)
-            if not args.json:
-                print(f"{file} moved")
+        files.extend(qiwi.get_files(arg))
+    result = qiwi.bulk_move_files(
+        files,
+        args.to,
+        args.concurrency,
+        args.rate,
+        on_done=partial(report_bulk, "moved"),
+    )
+    data = result.summary("moved")
+    if result.succeeded:
+        data["to"] = "nullFolder" if args.to is None else args.to
 elif args.action == "delete_files":
     if len(args.args) == 0:
         print("Supply at least one file ID as argument!", file=sys.stderr)
         sys.exit(5)
-    data = []
-    for arg in args.args:
-        qiwi.delete_file(arg)
-        data.append(arg)
-        if not args.json:
-            print(f"{arg} deleted")
-elif args.action == "upload_files":
-    if len(args.args) == 0:
+    result = qiwi.bulk_delete_files(
+        args.args,
+        args.concurrency,
+        args.rate,
+        on_done=partial(report_bulk, "deleted"),
+    )
+    data = result.summary("deleted")
+elif args.action == "list_pending":
+    with _qiwi.ResumeStore(args.config / "uploads.sqlite") as store:
+        data = store.pending()
+    for upload in data:
+        parts = "?" if upload["parts"] is None else upload["parts"]
+        changed = " (changed, can't be resumed)" if upload["changed"] else ""
+        output(
+            upload,
+            f"{upload['path']} {upload['parts_done']}/{parts} chunks{changed}",
+        )
+elif args.action == "rebuild_dedup":
+    # every file on the account, so files deleted from qiwi.gg are dropped
+    def all_files():
+        yield from qiwi.iter_files()
+        for folder in qiwi.get_folders(refresh=args.refresh):
+            yield from qiwi.iter_files(folder.id)
+
+    with _qiwi.DedupIndex(args.config / "dedup.sqlite") as index:
+        added = index.rebuild(all_files(), args.args)
+        data = {"files": len(index), "added": added}
+    output(data, f"{data['files']} files indexed, {added} added")
+elif args.action == "sync":
+    if len(args.args) != 1:
+        print("Supply one directory to sync as argument!", file=sys.stderr)
+        sys.exit(8)
+
+    # one state file per directory and destination, kept with the config
+    local_dir = Path(args.args[0]).resolve()
+    key = hashlib.sha1(f"{local_dir}\0{args.to}".encode()).hexdigest()[:16]
+
+    def sync_started(path):
+        print(f"uploading {path}", file=sys.stderr)
+        return _utils.named_upload_callback(path)
+
+    result = qiwi.sync_directory(
+        local_dir,
+        args.to,
+        state_path=args.config / "sync" / f"{key}.json",
+        max_files=args.parallel_files,
+        max_parts=args.max_parts,
+        max_bytes=args.max_inflight_bytes,
+        callback=sync_started,
+        on_done=partial(report_bulk, "uploaded"),
+        chunk_size=args.chunk_size,
+        parallel_parts=args.parallel_parts,
+        hashes=args.hashes,
+        metadata_path=(
+            _qiwi.ResumeStore(args.config / "uploads.sqlite")
+            if args.resume_store else None
+        ),
+        dedup=(
+            _qiwi.DedupIndex(args.config / "dedup.sqlite") if args.dedup else None
+        ),
+        on_event=(
+            None if args.metrics_dir is None
+            else _qiwi.MetricsExporter(args.metrics_dir)
+        ),
+    )
+    data = result.to_dict()
+    if not args.json:
+        print(
+            f"{len(result.uploaded)} uploaded, {result.unchanged} unchanged, "
+            f"{len(result.created_folders)} folders created, "
+            f"{len(result.failed)} failed",
+            file=sys.stderr,
+        )
+elif args.action == "upload_files" and args.args == ["-"]:
+    if args.size is None or args.name is None:
+        print("Uploading stdin needs --size and --name!", file=sys.stderr)
+        sys.exit(9)
+
+    file = qiwi.upload_stream(
+        sys.stdin.buffer,
+        args.name,
+        args.size,
+        chunk_size=args.chunk_size,
+        parallel_parts=args.parallel_parts,
+        buffered_parts=args.buffered_parts,
+        hashes=args.hashes,
+        on_event=(
+            None if args.metrics_dir is None
+            else _qiwi.MetricsExporter(args.metrics_dir)
+        ),
+    )
+    if args.to is not None:
+        qiwi.move_file(file, args.to)
+    file.path = "-"
+    data = [file]
+    output(file, f"{file.url} {file.name}")
+elif args.action == "serve":
+    from qiwigg import _daemon
+
+    upload_options = {}
+    if args.resume_store:
+        upload_options["metadata_path"] = _qiwi.ResumeStore(
+            args.config / "uploads.sqlite"
+        )
+    if args.dedup:
+        upload_options["dedup"] = _qiwi.DedupIndex(args.config / "dedup.sqlite")
+    if args.metrics_dir is not None:
+        upload_options["on_event"] = _qiwi.MetricsExporter(args.metrics_dir)
+
+    daemon = _daemon.Daemon(
+        qiwi,
+        args.config,
+        port=args.port,
+        max_uploads=args.max_jobs,
+        upload_options=upload_options,
+    ).start()
+    print(f"serving on {daemon.url}, stop with Ctrl+C", file=sys.stderr)
+    daemon.serve_forever()
+    streamed = True
+elif args.action in ("upload_files", "resume_all"):
+    store = None
+    if args.resume_store or args.action == "resume_all":
+        store = _qiwi.ResumeStore(args.config / "uploads.sqlite")
+
+    # file paths by destination folder
+    uploads = {args.to: args.args}
+    if args.action == "resume_all":
+        uploads = {}
+        for upload in store.pending():
+            if upload["changed"]:
+                print(
+                    f"{upload['path']} changed since its upload started, "
+                    "skipping",
+                    file=sys.stderr,
+                )
+            else:
+                # uploads started before destinations were kept go to --to
+                destination = upload["destination"] or args.to
+                uploads.setdefault(destination, []).append(upload["path"])
+        # every one keeps the chunk size it was started with
+        args.chunk_size = "auto"
+    elif len(args.args) == 0:
         print("Supply at least one file path as argument!", file=sys.stderr)
         sys.exit(6)
+
+    def upload_started(path):
+        print(f"uploading {path}", file=sys.stderr)
+        if args.parallel_files > 1:
+            return _utils.named_upload_callback(path)
+        return _utils.upload_callback
+
+    dedup = on_event = None
+    if args.dedup:
+        dedup = _qiwi.DedupIndex(args.config / "dedup.sqlite")
+    if args.metrics_dir is not None:
+        on_event = _qiwi.MetricsExporter(args.metrics_dir)
+
     data = []
-    for arg in args.args:
-        print(f"uploading {arg}", file=sys.stderr)
-        file = qiwi.upload_file(arg, chunk_size=args.chunk_size)
-        if args.to is not None:
-            qiwi.move_file(file, args.to)
-        file.path = arg
-        data.append(file)
-        if not args.json:
-            print(f"{file.url} {file.name}")
+    for destination, paths in uploads.items():
+        for arg, file in qiwi.upload_files(
+            paths,
+            destination,
+            max_files=args.parallel_files,
+            max_parts=args.max_parts,
+            max_bytes=args.max_inflight_bytes,
+            callback=upload_started,
+            chunk_size=args.chunk_size,
+            parallel_parts=args.parallel_parts,
+            hashes=args.hashes,
+            metadata_path=store,
+            dedup=dedup,
+            on_event=on_event,
+        ):
+            file.path = arg
+            data.append(file)
+            if file.upload_stats.get("deduplicated"):
+                output(file, f"{file.url} {file.name} (already uploaded)")
+            else:
+                output(file, f"{file.url} {file.name}")
 else:
     raise NotImplementedError(f"{args.action} action is not implemented")
 
-if args.json:
+if args.json and not streamed:
     print(json.dumps(data, indent=4, cls=_qiwitypes.QiwiJSONEncoder))
+
+if result is not None and result.retries:
+    print(f"{result.retries} requests were retried", file=sys.stderr)
+
+if result is not None and not result:
+    sys.exit(7)
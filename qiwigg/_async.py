@@ -0,0 +1,650 @@
+import sys
+import os
+import asyncio
+import datetime
+import json
+
+from email.message import Message
+from http.cookiejar import LWPCookieJar
+from pathlib import Path
+from urllib.request import Request
+from time import monotonic
+
+try:
+    import aiohttp
+except ModuleNotFoundError:
+    aiohttp = None
+
+from . import _exceptions, _qiwitypes
+from ._qiwi import (
+    QiwiGG,
+    find_newest_session,
+    token_expiration_date,
+    client_cookie,
+    session_cookie,
+    check_identifier_step,
+    check_password_step,
+    upload_init_request,
+    completed_parts,
+)
+from ._utils import load_metadata, upload_callback
+from ._dashboard import parse_folders
+from ._chunk import Chunk, plan_parts, MIN_CHUNK_SIZE
+from ._upload import _finish
+from ._chunksize import ChunkSizer, DEFAULT_CHUNK_SIZE, saved_chunk_size
+from ._ratelimit import upload_bandwidth
+from ._retry import RetryPolicy, classify, parse_retry_after, EXPIRED
+
+
+__all__ = ["AsyncQiwiGG"]
+
+
+class _CookieResponse:
+    # just enough of a urllib response for CookieJar.extract_cookies
+    def __init__(self, headers):
+        self._info = Message()
+        for value in headers.getall("Set-Cookie", []):
+            self._info["Set-Cookie"] = value
+
+    def info(self):
+        return self._info
+
+
+class AsyncQiwiGG:
+    USER_AGENT = QiwiGG.USER_AGENT
+    QIWI_URL = QiwiGG.QIWI_URL
+    QIWI_API = QiwiGG.QIWI_API
+    CLERK_API = QiwiGG.CLERK_API
+    CLERK_JS_VERSION = QiwiGG.CLERK_JS_VERSION
+
+    def __init__(
+        self,
+        email=None,
+        password=None,
+        cookie_jar_path=None,
+        proxies=None,
+        timeout=30,
+        max_connections=100,
+        chunk_sizer=None,
+        bandwidth=upload_bandwidth,
+        retry_policy=None,
+    ):
+        if aiohttp is None:
+            raise _exceptions.QiwiGGError("AsyncQiwiGG requires aiohttp")
+
+        if cookie_jar_path is None:
+            cookie_jar_path = "cookies.txt"
+
+        # the same cookie jar format as QiwiGG so both can share a session
+        self.cookies = LWPCookieJar(cookie_jar_path)
+        try:
+            self.cookies.load(ignore_discard=True)
+        except FileNotFoundError:
+            pass
+
+        self.email = email
+        self.password = password
+        self.proxies = proxies
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.bandwidth = bandwidth
+
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+
+        if chunk_sizer is None:
+            chunk_sizer = ChunkSizer()
+        self.chunk_sizer = chunk_sizer
+
+        self._http = None
+        self._session_name = None
+        self._session_expiration_date = None
+        self._token_expiration_date = None
+        self._auth_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = aiohttp.ClientSession(
+                headers={"User-Agent": self.USER_AGENT},
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                cookie_jar=aiohttp.DummyCookieJar(),
+            )
+        return self._http
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    @property
+    def _proxy(self):
+        if not self.proxies:
+            return None
+        return self.proxies.get("https") or self.proxies.get("http")
+
+    def _save_cookies(self):
+        try:
+            self.cookies.save(ignore_discard=True)
+        except FileNotFoundError:
+            Path(self.cookies.filename).parent.mkdir(parents=True, exist_ok=True)
+            self.cookies.save(ignore_discard=True)
+
+    def set_client_cookie(self, cookie_value):
+        self.cookies.set_cookie(client_cookie(cookie_value, self.CLERK_API))
+        self._save_cookies()
+
+    async def _request(self, method, url, params=None, data=None, headers=None):
+        cookie_request = Request(url, method=method.upper())
+        self.cookies.add_cookie_header(cookie_request)
+        headers = dict(headers or {})
+        if cookie_request.has_header("Cookie"):
+            headers["Cookie"] = cookie_request.get_header("Cookie")
+
+        # failures worth retrying are raised as RequestFailedError
+        try:
+            async with self.http.request(
+                method,
+                url,
+                params=params,
+                data=data,
+                headers=headers,
+                proxy=self._proxy,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            ) as r:
+                self.cookies.extract_cookies(
+                    _CookieResponse(r.headers), cookie_request
+                )
+                content = await r.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise _exceptions.RequestFailedError(str(e) or repr(e))
+
+        if r.status == 429 or r.status >= 500:
+            text = content.decode(errors="replace")
+            raise _exceptions.RequestFailedError(
+                f"Request failed with status {r.status}: {text}",
+                text,
+                r.status,
+                parse_retry_after(r.headers.get("Retry-After")),
+            )
+        return r.status, content
+
+    def _report_retry(self, error, delay):
+        print(f"{error}\nRetrying in {delay:.1f}s", file=sys.stderr)
+
+    async def _retry(self, function, *args, idempotent=True):
+        tries = 0
+        while True:
+            try:
+                return await function(*args)
+            except (
+                _exceptions.RequestFailedError, _exceptions.UploadFailedError
+            ) as e:
+                tries += 1
+                delay = self.retry_policy.delay(e, tries, idempotent)
+                if delay is None:
+                    raise
+                self._report_retry(e, delay)
+                await asyncio.sleep(delay)
+
+    async def _request_json(
+        self, method, url, params=None, data=None, headers=None
+    ):
+        status, content = await self._request(method, url, params, data, headers)
+        try:
+            return json.loads(content)
+        except ValueError:
+            text = content.decode(errors="replace")
+            raise _exceptions.RequestFailedError(
+                f"Can't parse response: {text}", text, status
+            )
+
+    async def log_in(self, email=None, password=None, message=None):
+        if email is None or password is None:
+            email = self.email
+            password = self.password
+            if email is None or password is None:
+                if message is None:
+                    message = "Can't log in without email and password"
+                raise _exceptions.AuthenticationError(message)
+
+        self.cookies.clear()
+        self._session_name = None
+        self._session_expiration_date = None
+        self._token_expiration_date = None
+
+        await self._clerk_api_call("get", "environment")
+        data = await self._clerk_api_call(
+            "post", "client/sign_ins", {"identifier": email}
+        )
+        sia = check_identifier_step(data["response"])
+
+        data = await self._clerk_api_call(
+            "post",
+            f"client/sign_ins/{sia}/attempt_first_factor",
+            {"strategy": "password", "password": password},
+        )
+        check_password_step(data["response"])
+
+        (
+            self._session_name,
+            self._session_expiration_date
+        ) = find_newest_session(data["client"]["sessions"])
+
+        if self._session_name is None:
+            raise _exceptions.QiwiGGError("Can't log in, no session found")
+
+        self._save_cookies()
+
+    async def _clerk_api_call(self, method, what, data=None):
+        if self._session_expiration_date is not None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if now > self._session_expiration_date:
+                await self.log_in()
+
+        response_data = await self._retry(
+            self._request_json,
+            method,
+            f"{self.CLERK_API}/{what}",
+            {"_clerk_js_version": self.CLERK_JS_VERSION},
+            data,
+        )
+
+        if "errors" in response_data:
+            error = response_data["errors"][0]
+            if error.get("code") == "signed_out":
+                await self.log_in(message=error.get("long_message"))
+                return await self._clerk_api_call(method, what, data)
+
+            raise _exceptions.QiwiGGError(json.dumps(response_data["errors"]))
+
+        return response_data
+
+    async def _get_session(self):
+        data = (await self._clerk_api_call("get", "client"))["response"]
+        if data is None:
+            await self.log_in(message="Not logged in")
+            return await self._get_session()
+
+        (
+            self._session_name,
+            self._session_expiration_date
+        ) = find_newest_session(data["sessions"])
+
+        if self._session_name is None:
+            await self.log_in(message="No active sessions found")
+            return await self._get_session()
+
+    async def get_session_name(self):
+        if self._session_name is None:
+            await self._get_session()
+
+        return self._session_name
+
+    def _token_valid(self):
+        if self._token_expiration_date is None:
+            return False
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return self._token_expiration_date > now
+
+    async def _get_token(self):
+        if self._token_valid():
+            return
+
+        # many requests in flight share one token refresh
+        async with self._auth_lock:
+            if self._token_valid():
+                return
+
+            session_name = await self.get_session_name()
+            data = await self._clerk_api_call(
+                "post", f"client/sessions/{session_name}/tokens"
+            )
+            token = data["jwt"]
+            self._token_expiration_date = token_expiration_date(token)
+            self.cookies.set_cookie(
+                session_cookie(token, self._token_expiration_date, self.QIWI_URL)
+            )
+
+    async def _qiwi_request(
+        self, method, what, data=None, params=None, idempotent=True
+    ):
+        # see QiwiGG._qiwi_request
+        await self._get_token()
+
+        headers = {}
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+            data = json.dumps(data, cls=_qiwitypes.QiwiIDJSONEncoder)
+
+        if params is not None:
+            params = {k: str(v) for k, v in params.items()}
+
+        response_data = await self._retry(
+            self._request_json,
+            method,
+            f"{self.QIWI_API}/{what}",
+            params,
+            data,
+            headers,
+            idempotent=idempotent,
+        )
+        if "success" not in response_data or not response_data["success"]:
+            raise _exceptions.QiwiGGError(
+                f"Request failed: {json.dumps(response_data)}"
+            )
+        return response_data
+
+    async def _gather(self, coroutines, max_concurrency):
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*(run(c) for c in coroutines))
+
+    async def get_folders(self):
+        await self._get_token()
+        _, content = await self._retry(
+            self._request, "get", f"{self.QIWI_URL}/dashboard"
+        )
+        return parse_folders(content)
+
+    async def create_folder(self, name, parent_id=None):
+        data = await self._qiwi_request(
+            "post",
+            "manageFolder",
+            {"folderName": name, "parentFolder": parent_id},
+            idempotent=False,
+        )
+
+        if parent_id is None:
+            parent_id = "nullFolder"
+
+        return _qiwitypes.QiwiFolder(data["folderId"], data["folderName"], parent_id)
+
+    async def create_folders(self, names, parent_id=None, max_concurrency=10):
+        return await self._gather(
+            (self.create_folder(name, parent_id) for name in names),
+            max_concurrency,
+        )
+
+    async def delete_folder(self, folder_id):
+        await self._qiwi_request("delete", "manageFolder", {"folderId": folder_id})
+
+    async def delete_folders(self, folder_ids, max_concurrency=10):
+        await self._gather(
+            (self.delete_folder(folder_id) for folder_id in folder_ids),
+            max_concurrency,
+        )
+
+    async def get_files(self, folder_id=None):
+        if folder_id is None:
+            folder_id = "nullFolder"
+
+        data = await self._qiwi_request(
+            "post", "getFolderFiles", {"folderId": folder_id}
+        )
+        return [_qiwitypes.QiwiFile(x) for x in data["folderFiles"]]
+
+    async def move_file(self, file_id, folder_id):
+        if folder_id is None:
+            folder_id = "nullFolder"
+
+        await self._qiwi_request(
+            "patch", "manageFile", {"fileId": file_id, "folderId": folder_id}
+        )
+
+        if isinstance(file_id, _qiwitypes.QiwiFile):
+            file_id.parent_id = (
+                folder_id.id if isinstance(folder_id, _qiwitypes.QiwiFolder)
+                else folder_id
+            )
+
+        return folder_id
+
+    async def move_files(self, file_ids, folder_id, max_concurrency=10):
+        results = await self._gather(
+            (self.move_file(file_id, folder_id) for file_id in file_ids),
+            max_concurrency,
+        )
+        return results[-1] if results else None
+
+    async def delete_file(self, file_id):
+        await self._qiwi_request("delete", "manageFile", {"fileId": file_id})
+
+    async def delete_files(self, file_ids, max_concurrency=10):
+        await self._gather(
+            (self.delete_file(file_id) for file_id in file_ids),
+            max_concurrency,
+        )
+
+    async def _initialize_upload(self, name, size):
+        return await self._qiwi_request(
+            "post",
+            "privateUpload",
+            *upload_init_request(name, size),
+            idempotent=False,
+        )
+
+    async def _get_upload_url(self, key, upload_id, part_number):
+        response = await self._qiwi_request(
+            "post",
+            "generatePreSigned",
+            {
+                "key": key,
+                "uploadId": upload_id,
+                "partNumber": part_number,
+            },
+        )
+        return response["preSignedUrl"]
+
+    async def _part_body(self, file_path, offset, length):
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(None, open, file_path, "rb")
+        try:
+            chunk = await loop.run_in_executor(None, Chunk, f, offset, length)
+            while True:
+                size = 1048576
+                if self.bandwidth is not None:
+                    size = min(size, chunk.final_offset - chunk.position)
+                    if size > 0:
+                        size = self.bandwidth.take(size)
+                        if size == 0:
+                            await asyncio.sleep(0.05)
+                            continue
+                data = await loop.run_in_executor(None, chunk.read, size)
+                if not data:
+                    break
+                yield data
+        finally:
+            await loop.run_in_executor(None, f.close)
+
+    async def _put_part(self, upload_url, file_path, offset, length):
+        try:
+            async with self.http.put(
+                upload_url,
+                data=self._part_body(file_path, offset, length),
+                headers={"Content-Length": str(length)},
+                proxy=self._proxy,
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.timeout, sock_read=self.timeout
+                ),
+            ) as r:
+                body = await r.read()
+                header_lines = [f"{k}: {v}" for k, v in r.headers.items()]
+                status_code = r.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise _exceptions.UploadFailedError(str(e) or repr(e), None, None)
+
+        return _finish(status_code, header_lines, body)
+
+    async def _upload_part(self, key, upload_id, file_path, index, offset, length):
+        tries = 0
+        retry_seconds = 0.0
+        upload_url = None
+        while True:
+            if upload_url is None:
+                upload_url = await self._get_upload_url(key, upload_id, index + 1)
+            start = monotonic()
+            try:
+                etag = await self._put_part(upload_url, file_path, offset, length)
+                return etag, monotonic() - start, tries, retry_seconds
+            except _exceptions.UploadFailedError as e:
+                tries += 1
+                delay = self.retry_policy.delay(e, tries)
+                if delay is None:
+                    raise
+                if classify(e) == EXPIRED:
+                    upload_url = None
+                self._report_retry(e, delay)
+                await asyncio.sleep(delay)
+                retry_seconds += delay
+
+    async def _upload_chunks(
+        self,
+        key,
+        upload_id,
+        etags,
+        file_path,
+        size,
+        chunk_size,
+        save_metadata,
+        callback,
+        parallel_parts=4,
+    ):
+        parts = plan_parts(etags, size, chunk_size)
+        uploaded = size - sum(length for _, _, length in parts)
+
+        if callback is not None:
+            callback(uploaded, size)
+
+        semaphore = asyncio.Semaphore(max(1, parallel_parts))
+        put_seconds = 0.0
+        retry_count = 0
+        retry_seconds = 0.0
+
+        async def upload(index, offset, length):
+            async with semaphore:
+                result = await self._upload_part(
+                    key, upload_id, file_path, index, offset, length
+                )
+            return index, length, result
+
+        tasks = [asyncio.ensure_future(upload(*part)) for part in parts]
+        try:
+            for task in asyncio.as_completed(tasks):
+                index, length, (etag, seconds, retries, waited) = await task
+                etags[index] = [etag, length]
+                save_metadata(index)
+
+                put_seconds += seconds
+                retry_count += retries
+                retry_seconds += waited
+
+                uploaded += length
+
+                if callback is not None:
+                    callback(uploaded, size)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        return {
+            "parts": len(parts),
+            "bytes": sum(length for _, _, length in parts),
+            "put_seconds": round(put_seconds, 3),
+            "retries": retry_count,
+            "retry_seconds": round(retry_seconds, 3),
+        }
+
+    async def _finalize_upload(self, key, upload_id, file_id, etags):
+        response = await self._qiwi_request(
+            "post",
+            "completeUpload",
+            {
+                "key": key,
+                "uploadId": upload_id,
+                "fileId": file_id,
+                "completed": True,
+                "parts": completed_parts(etags),
+            },
+        )
+        return response["result"]
+
+    async def upload_file(
+        self,
+        file_path,
+        metadata_path=None,
+        chunk_size=None,
+        callback=upload_callback,
+        parallel_parts=4,
+    ):
+        file_path = Path(file_path)
+        name = file_path.name
+        size = os.path.getsize(file_path)
+
+        data, save_metadata, delete_metadata = load_metadata(file_path, metadata_path)
+
+        if chunk_size == "auto":
+            chunk_size = saved_chunk_size(data)
+            if chunk_size is None:
+                chunk_size = self.chunk_sizer.choose(size)
+        elif chunk_size is None:
+            chunk_size = DEFAULT_CHUNK_SIZE
+        chunk_size = max(MIN_CHUNK_SIZE, chunk_size)
+
+        if "info" not in data:
+            data["info"] = await self._initialize_upload(name, size)
+            data["chunk_size"] = chunk_size
+            save_metadata()
+
+        file_id = data["info"]["result"]
+        key = data["info"]["key"]
+        upload_id = data["info"]["uploadId"]
+        etags = data.setdefault("etags", [])
+
+        upload_stats = await self._upload_chunks(
+            key,
+            upload_id,
+            etags,
+            file_path,
+            size,
+            chunk_size,
+            save_metadata,
+            callback,
+            parallel_parts,
+        )
+
+        if upload_stats["parts"] > 0:
+            self.chunk_sizer.record(
+                upload_stats["bytes"],
+                upload_stats["put_seconds"],
+                upload_stats["parts"],
+                upload_stats["retries"],
+            )
+
+        timestamp = datetime.datetime.now().isoformat()[:23]
+
+        if "final" not in data:
+            data["final"] = await self._finalize_upload(
+                key, upload_id, file_id, etags
+            )
+            save_metadata()
+
+        if "createdAt" not in data["final"]:
+            data["final"]["createdAt"] = f"{timestamp}Z"
+            save_metadata()
+
+        file = _qiwitypes.QiwiFile(data["final"])
+        file.upload_stats = upload_stats
+        delete_metadata()
+        return file
@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+
+from . import _qiwitypes
+from ._ratelimit import RateLimiter
+from ._retry import thread_retries
+
+
+__all__ = ["BulkResult"]
+
+
+def _item_id(item):
+    return item.id if isinstance(item, _qiwitypes.QiwiCommon) else item
+
+
+class BulkResult:
+    def __init__(self):
+        self.succeeded = []
+        self.failed = {}
+        self.errors = {}
+        # requests that failed and were tried again, across all items
+        self.retries = 0
+
+    def __bool__(self):
+        return len(self.failed) == 0
+
+    @property
+    def failed_ids(self):
+        return list(self.failed)
+
+    def summary(self, verb):
+        # what --json prints: the items that worked under verb and errors
+        # of the ones that didn't by ID, to know what to try again
+        return {verb: self.succeeded, "failed": self.to_dict()["failed"]}
+
+    def to_dict(self):
+        return {
+            "succeeded": [_item_id(item) for item in self.succeeded],
+            "failed": {
+                item_id: str(error) for item_id, error in self.errors.items()
+            },
+            "retries": self.retries,
+        }
+
+
+def run_bulk(function, items, max_workers=8, rate=None, on_done=None):
+    # calls function(item) for every item, max_workers at once and at most
+    # rate calls per second; failures are collected instead of raised
+    limiter = RateLimiter(rate)
+    result = BulkResult()
+    lock = Lock()
+
+    def call(item):
+        limiter.acquire()
+        retries = thread_retries()
+        try:
+            return function(item)
+        finally:
+            with lock:
+                result.retries += thread_retries() - retries
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(call, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            error = future.exception()
+            if error is None:
+                result.succeeded.append(item)
+            else:
+                result.failed[_item_id(item)] = item
+                result.errors[_item_id(item)] = error
+            if on_done is not None:
+                on_done(item, error)
+
+    return result
@@ -1,20 +1,252 @@
 import os
+import threading
 
+from time import monotonic
 
-class Chunk():
-    def __init__(self, f, offset, max_size):
-        f.seek(0, os.SEEK_END)
+from ._hashing import Hasher
+from ._exceptions import QiwiGGError, ChunkSizeError
+
+
+MAX_PARTS = 10000
+MIN_CHUNK_SIZE = 5242880
+
+
+_seek_lock = threading.Lock()
 
-        self.final_offset = min(f.tell(), offset + max_size)
-        self.size = self.final_offset - offset
+
+class Chunk():
+    # reads [offset, offset + max_size) of a file with pread so the file
+    # position is never touched and any number of chunks of one file can be
+    # read at once
+    def __init__(self, f, offset, max_size, buffer_size=1048576):
         self.f = f
+        self.fd = f.fileno()
+
+        file_size = os.fstat(self.fd).st_size
+        self.offset = offset
+        self.final_offset = min(file_size, offset + max_size)
+        self.size = max(0, self.final_offset - offset)
+        self.position = offset
+
+        self.buffer_size = buffer_size
+        # time spent reading the file, across rewinds
+        self.read_seconds = 0.0
+        self._buffers = []
+        self._hasher = None
+
+    def __len__(self):
+        return self.size
 
-        f.seek(offset, os.SEEK_SET)
+    def rewind(self):
+        self.position = self.offset
+        if self._hasher is not None:
+            self.start_hashing(self._hasher.names)
+
+    def start_hashing(self, names):
+        # everything read from here on is hashed, a rewind starts over
+        self.stop_hashing()
+        self._hasher = Hasher(names)
+
+    def stop_hashing(self):
+        if self._hasher is not None:
+            self._hasher.close()
+            self._hasher = None
+
+    def finish_hashing(self):
+        hasher, self._hasher = self._hasher, None
+        return hasher.digests()
+
+    def _pread(self, limit):
+        if hasattr(os, "pread"):
+            return os.pread(self.fd, limit, self.position)
+        with _seek_lock:
+            self.f.seek(self.position, os.SEEK_SET)
+            return self.f.read(limit)
+
+    def _preadinto(self, view):
+        if hasattr(os, "preadv"):
+            return os.preadv(self.fd, [view], self.position)
+        data = self._pread(len(view))
+        view[:len(data)] = data
+        return len(data)
 
     def read(self, limit=-1):
-        left = self.final_offset - self.f.tell()
+        left = self.final_offset - self.position
 
         if limit == -1 or limit > left:
             limit = left
 
-        return self.f.read(limit)
+        start = monotonic()
+        data = self._pread(limit)
+        self.read_seconds += monotonic() - start
+        self.position += len(data)
+        if self._hasher is not None and data:
+            self._hasher.update(data)
+        return data
+
+    def _readinto(self, view):
+        left = self.final_offset - self.position
+        if len(view) > left:
+            view = view[:left]
+
+        start = monotonic()
+        n = self._preadinto(view)
+        self.read_seconds += monotonic() - start
+        self.position += n
+        return n
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        n = self._readinto(view)
+        if self._hasher is not None and n:
+            self._hasher.update(bytes(view[:n]))
+        return n
+
+    def views(self, bandwidth=None):
+        return _ChunkViews(self, bandwidth)
+
+
+class _ChunkViews:
+    # iterable over memoryviews of reused buffers; each view is only valid
+    # until the next one is requested, which is how a transport writing it
+    # straight to a socket consumes it. while hashing, two buffers take
+    # turns so one is hashed while the other is sent. bandwidth is a
+    # RateLimiter in bytes that every buffer is taken from before it's read
+    def __init__(self, chunk, bandwidth=None):
+        self.chunk = chunk
+        self.bandwidth = bandwidth
+
+    def __len__(self):
+        return self.chunk.size
+
+    def __iter__(self):
+        chunk = self.chunk
+        hasher = chunk._hasher
+        count = 1 if hasher is None else 2
+        while len(chunk._buffers) < count:
+            chunk._buffers.append(
+                bytearray(min(chunk.buffer_size, chunk.size) or 1)
+            )
+
+        hashed = [None] * count
+        index = 0
+        while True:
+            if hashed[index] is not None:
+                hashed[index].wait()
+            view = memoryview(chunk._buffers[index])
+            if self.bandwidth is not None:
+                view = view[:chunk.final_offset - chunk.position]
+                burst = self.bandwidth.burst
+                if burst is not None:
+                    # smaller reads under a low limit keep the upload steady
+                    view = view[:max(16384, int(burst))]
+                self.bandwidth.acquire(len(view))
+            n = chunk._readinto(view)
+            if n == 0:
+                return
+            view = view[:n]
+            if hasher is not None:
+                hashed[index] = threading.Event()
+                hasher.update(view, hashed[index])
+            yield view
+            index = (index + 1) % count
+
+
+class MemoryChunk(Chunk):
+    # a part held in a buffer, for uploads from streams; reads copy out of
+    # the buffer and views are slices of it, so nothing but the buffer is
+    # allocated. The buffer must not change until the part is uploaded
+    def __init__(self, buffer, size, buffer_size=1048576):
+        self.buffer = memoryview(buffer).cast("B")[:size]
+        self.offset = 0
+        self.final_offset = self.size = len(self.buffer)
+        self.position = 0
+
+        self.buffer_size = buffer_size
+        self.read_seconds = 0.0
+        self._buffers = []
+        self._hasher = None
+
+    def _pread(self, limit):
+        return bytes(self.buffer[self.position:self.position + limit])
+
+    def _preadinto(self, view):
+        n = len(view)
+        view[:] = self.buffer[self.position:self.position + n]
+        return n
+
+    def views(self, bandwidth=None):
+        return _MemoryViews(self, bandwidth)
+
+
+class _MemoryViews(_ChunkViews):
+    # the buffer itself in buffer_size slices; they stay valid, so hashing
+    # doesn't hold the next one back
+    def __iter__(self):
+        chunk = self.chunk
+        while chunk.position < chunk.final_offset:
+            length = min(chunk.buffer_size, chunk.final_offset - chunk.position)
+            if self.bandwidth is not None:
+                burst = self.bandwidth.burst
+                if burst is not None:
+                    length = min(length, max(16384, int(burst)))
+                self.bandwidth.acquire(length)
+            view = chunk.buffer[chunk.position:chunk.position + length]
+            chunk.position += length
+            if chunk._hasher is not None:
+                chunk._hasher.update(view)
+            yield view
+
+
+def read_part(f, buffer, size):
+    # fills buffer[:size] from a file-like object that may return less than
+    # asked for; returns how much it got, less than size at end of stream
+    view = memoryview(buffer).cast("B")[:size]
+    filled = 0
+    readinto = getattr(f, "readinto", None)
+    while filled < size:
+        if readinto is not None:
+            n = readinto(view[filled:])
+        else:
+            data = f.read(size - filled)
+            n = len(data)
+            view[filled:filled + n] = data
+        if not n:
+            break
+        filled += n
+    return filled
+
+
+def plan_parts(etags, size, chunk_size):
+    count = -(-size // chunk_size)
+    if count > MAX_PARTS:
+        raise QiwiGGError(
+            "Use larger chunk size. "
+            f"There's a hard limit of {MAX_PARTS} chunks max per upload."
+        )
+
+    for saved in etags[count:]:
+        if saved is not None:
+            raise ChunkSizeError(
+                "All non-trailing parts must have the same length",
+                saved[1],
+                chunk_size,
+            )
+    del etags[count:]
+    etags.extend([None] * (count - len(etags)))
+
+    # list of (part index, offset, length) that still have to be uploaded
+    parts = []
+    for index, saved in enumerate(etags):
+        offset = index * chunk_size
+        length = min(chunk_size, size - offset)
+        if saved is None:
+            parts.append((index, offset, length))
+        elif saved[1] != length:
+            raise ChunkSizeError(
+                "All non-trailing parts must have the same length",
+                saved[1],
+                length,
+            )
+
+    return parts
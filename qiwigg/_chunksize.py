@@ -0,0 +1,84 @@
+import json
+import threading
+
+from ._chunk import MAX_PARTS, MIN_CHUNK_SIZE
+from ._utils import save_data
+
+
+DEFAULT_CHUNK_SIZE = 100000000
+MAX_CHUNK_SIZE = 5 * 2**30
+
+
+def saved_chunk_size(data):
+    # chunk size an interrupted upload was started with, older metadata
+    # doesn't store it but its first part is never a short trailing one
+    # unless it's the only part
+    if "chunk_size" in data:
+        return data["chunk_size"]
+    etags = data.get("etags")
+    if etags and etags[0] is not None:
+        return etags[0][1]
+    return None
+
+
+class ChunkSizer:
+    # picks a part size from the file size, the part limit and the per part
+    # throughput and retry rate of recent uploads; with a path the history
+    # is kept between runs
+    def __init__(self, path=None, history=50, target_seconds=60):
+        self.path = path
+        self.history = history
+        self.target_seconds = target_seconds
+        self.samples = []
+        # uploads running at once record their samples at once
+        self._lock = threading.Lock()
+
+        if path is not None:
+            try:
+                with open(path) as f:
+                    self.samples = json.load(f)["samples"][-history:]
+            except (FileNotFoundError, ValueError, KeyError):
+                pass
+
+    def record(self, uploaded, seconds, parts, retries):
+        if parts == 0 or seconds <= 0:
+            return
+        with self._lock:
+            self.samples.append([uploaded, seconds, parts, retries])
+            del self.samples[:-self.history]
+            if self.path is not None:
+                save_data(self.path, {"samples": list(self.samples)})
+
+    def throughput(self):
+        with self._lock:
+            samples = list(self.samples)
+        uploaded = sum(s[0] for s in samples)
+        seconds = sum(s[1] for s in samples)
+        if seconds == 0:
+            return None
+        return uploaded / seconds
+
+    def retry_rate(self):
+        with self._lock:
+            samples = list(self.samples)
+        parts = sum(s[2] for s in samples)
+        if parts == 0:
+            return 0.0
+        return sum(s[3] for s in samples) / parts
+
+    def choose(self, size):
+        minimum = max(MIN_CHUNK_SIZE, -(-size // MAX_PARTS))
+
+        throughput = self.throughput()
+        if throughput is None:
+            chunk_size = DEFAULT_CHUNK_SIZE
+        else:
+            # a failed part is uploaded again as a whole, so the flakier the
+            # link the shorter each part should take
+            target = self.target_seconds / (1 + 10 * self.retry_rate())
+            chunk_size = int(throughput * target)
+
+        chunk_size = min(chunk_size, MAX_CHUNK_SIZE, max(size, minimum))
+        chunk_size = max(chunk_size, minimum)
+        # round up to whole MiB
+        return -(-chunk_size // 1048576) * 1048576
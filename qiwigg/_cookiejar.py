@@ -0,0 +1,67 @@
+import os
+import tempfile
+import threading
+
+from http.cookiejar import LWPCookieJar, MISSING_FILENAME_TEXT
+from pathlib import Path
+
+
+class LockedCookieJar(LWPCookieJar):
+    # an LWPCookieJar threads can share: requests stores cookies from
+    # responses and copies the jar into every request while other threads
+    # log in or save it, so everything that reads or changes it holds lock
+    def __init__(self, filename=None, delayload=False, policy=None):
+        self.lock = threading.RLock()
+        super().__init__(filename, delayload, policy)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(super().__iter__()))
+
+    def __len__(self):
+        with self.lock:
+            return super().__len__()
+
+    def add_cookie_header(self, request):
+        with self.lock:
+            super().add_cookie_header(request)
+
+    def extract_cookies(self, response, request):
+        with self.lock:
+            super().extract_cookies(response, request)
+
+    def set_cookie(self, cookie):
+        with self.lock:
+            super().set_cookie(cookie)
+
+    def clear(self, domain=None, path=None, name=None):
+        with self.lock:
+            super().clear(domain, path, name)
+
+    def clear_expired_cookies(self):
+        with self.lock:
+            super().clear_expired_cookies()
+
+    def save(self, filename=None, ignore_discard=False, ignore_expires=False):
+        # written to a file of its own and renamed, processes sharing the
+        # jar may save it at once
+        if filename is None:
+            filename = self.filename
+        if filename is None:
+            raise ValueError(MISSING_FILENAME_TEXT)
+        path = Path(filename)
+        with self.lock:
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=f"{path.name}.", suffix="_tmp", dir=path.parent
+            )
+            os.close(fd)
+            try:
+                super().save(tmp_path, ignore_discard, ignore_expires)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+    def load(self, filename=None, ignore_discard=False, ignore_expires=False):
+        with self.lock:
+            super().load(filename, ignore_discard, ignore_expires)
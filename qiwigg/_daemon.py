@@ -0,0 +1,554 @@
+import os
+import http.client
+import json
+import secrets
+import signal
+import threading
+import time
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+
+from . import _qiwi
+from ._exceptions import QiwiGGError
+from ._utils import SQLiteDatabase
+
+
+__all__ = ["Daemon", "DaemonClient"]
+
+
+# uploads have their own workers so moves, deletes and listings don't wait
+# behind them
+UPLOAD_ACTIONS = ("upload_files",)
+OTHER_ACTIONS = ("move_files", "delete_files", "list_files")
+ACTIONS = UPLOAD_ACTIONS + OTHER_ACTIONS
+# events of this many finished jobs are kept for clients that ask late
+KEEP_EVENTS = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    action TEXT NOT NULL,
+    request TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+"""
+
+
+class JobQueue(SQLiteDatabase):
+    # jobs in a SQLite database, so queued jobs survive a restart; jobs
+    # that were running when the daemon stopped are queued again, uploads
+    # then resume from their metadata
+    def __init__(self, path):
+        super().__init__(path, SCHEMA)
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL "
+                "WHERE status = 'running'"
+            )
+
+    def submit(self, action, request):
+        with self._lock:
+            return self._db.execute(
+                "INSERT INTO jobs (action, request, status, created_at) "
+                "VALUES (?, ?, 'queued', ?)",
+                (action, json.dumps(request), time.time()),
+            ).lastrowid
+
+    def claim(self, actions):
+        # the oldest queued job of one of actions, now running, or None
+        with self._lock:
+            row = self._db.execute(
+                "UPDATE jobs SET status = 'running', started_at = ? "
+                "WHERE id = (SELECT id FROM jobs WHERE status = 'queued' "
+                f"AND action IN ({', '.join('?' * len(actions))}) "
+                "ORDER BY id LIMIT 1) RETURNING id, action, request",
+                (time.time(), *actions),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def finish(self, job_id, result=None, error=None):
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, "
+                "finished_at = ? WHERE id = ?",
+                (
+                    "failed" if error is not None else "done",
+                    json.dumps(result),
+                    error,
+                    time.time(),
+                    job_id,
+                ),
+            )
+
+    def cancel(self, job_id):
+        # only jobs that haven't started can be cancelled
+        with self._lock:
+            return self._db.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? "
+                "WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id),
+            ).rowcount > 0
+
+    def get(self, job_id):
+        jobs = self._select("WHERE id = ?", (job_id,))
+        return jobs[0] if jobs else None
+
+    def jobs(self, limit=100):
+        return self._select("ORDER BY id DESC LIMIT ?", (limit,))
+
+    def counts(self):
+        with self._lock:
+            return dict(
+                self._db.execute("SELECT status, count(*) FROM jobs GROUP BY status")
+            )
+
+    def _select(self, where, parameters):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, action, request, status, result, error, created_at, "
+                f"started_at, finished_at FROM jobs {where}",
+                parameters,
+            ).fetchall()
+        return [
+            {
+                "id": row[0],
+                "action": row[1],
+                "request": json.loads(row[2]),
+                "status": row[3],
+                "result": None if row[4] is None else json.loads(row[4]),
+                "error": row[5],
+                "created_at": row[6],
+                "started_at": row[7],
+                "finished_at": row[8],
+            }
+            for row in rows
+        ]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    daemon = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def _dispatch(self, method):
+        daemon = self.daemon
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        authorization = self.headers.get("Authorization", "")
+        if not secrets.compare_digest(authorization, f"Bearer {daemon.token}"):
+            self._send(401, {"error": "Unauthorized"})
+            return
+
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        parts = url.path.strip("/").split("/")
+        try:
+            if method == "GET" and parts == ["health"]:
+                self._send(
+                    200,
+                    {
+                        "pid": os.getpid(),
+                        "version": _qiwi.VERSION,
+                        "jobs": daemon.queue.counts(),
+                    },
+                )
+            elif method == "GET" and parts == ["jobs"]:
+                self._send(200, daemon.queue.jobs(int(query.get("limit", 100))))
+            elif method == "POST" and parts == ["jobs"]:
+                request = json.loads(body)
+                action = request.pop("action", None)
+                if action not in ACTIONS:
+                    self._send(400, {"error": f"Unknown action: {action}"})
+                    return
+                self._send(201, {"id": daemon.submit(action, request)})
+            elif len(parts) >= 2 and parts[0] == "jobs" and parts[1].isdigit():
+                self._job(method, int(parts[1]), parts[2:], query)
+            else:
+                self._send(404, {"error": "Not found"})
+        except ValueError as e:
+            self._send(400, {"error": str(e)})
+
+    def _job(self, method, job_id, rest, query):
+        daemon = self.daemon
+        job = daemon.queue.get(job_id)
+        if job is None:
+            self._send(404, {"error": f"No job {job_id}"})
+        elif method == "GET" and rest == []:
+            self._send(200, job)
+        elif method == "DELETE" and rest == []:
+            if daemon.queue.cancel(job_id):
+                self._send(200, daemon.queue.get(job_id))
+            else:
+                self._send(409, {"error": f"Job {job_id} is {job['status']}"})
+        elif method == "GET" and rest == ["events"]:
+            self._events(job_id, int(query.get("after", 0)))
+        else:
+            self._send(404, {"error": "Not found"})
+
+    def _events(self, job_id, after):
+        # one JSON event per line as they happen, the last one is
+        # job_finished with the job's status and result; the connection is
+        # closed after it, or without it when the daemon stops
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        for event in self.daemon.events(job_id, after):
+            self.wfile.write(json.dumps(event).encode() + b"\n")
+            self.wfile.flush()
+
+    def _send(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Daemon:
+    # keeps one logged in QiwiGG, with its connections, and runs jobs
+    # submitted over HTTP on localhost. Where it listens and the token
+    # clients need are written to daemon.json in config_dir, readable only
+    # by the user. upload_options go to every upload_file call, e.g. a
+    # ResumeStore as metadata_path
+    def __init__(
+        self,
+        qiwi,
+        config_dir,
+        host="127.0.0.1",
+        port=0,
+        max_uploads=2,
+        max_jobs=4,
+        upload_options=None,
+    ):
+        self.qiwi = qiwi
+        self.config_dir = Path(config_dir)
+        self.info_path = self.config_dir / "daemon.json"
+        self.host = host
+        self.port = port
+        self.max_uploads = max_uploads
+        self.max_jobs = max_jobs
+        self.upload_options = dict(upload_options or {})
+        self.token = secrets.token_urlsafe(32)
+        self.queue = None
+        self._server = None
+        self._events = {}
+        self._finished = {}
+        self._changed = threading.Condition()
+        self._stopping = threading.Event()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        if DaemonClient.find(self.config_dir) is not None:
+            raise QiwiGGError(f"A daemon is already running for {self.config_dir}")
+
+        # log in now, not when the first job comes
+        self.qiwi._ensure_token()
+
+        self.queue = JobQueue(self.config_dir / "jobs.sqlite")
+        handler = type("Handler", (_Handler,), {"daemon": self})
+        self._server = ThreadingHTTPServer((self.host, self.port), handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        threading.Thread(
+            target=self._server.serve_forever, name="qiwigg-daemon", daemon=True
+        ).start()
+
+        for actions, count in (
+            (UPLOAD_ACTIONS, self.max_uploads),
+            (OTHER_ACTIONS, self.max_jobs),
+        ):
+            for _ in range(max(1, count)):
+                threading.Thread(
+                    target=self._work, args=(actions,), daemon=True
+                ).start()
+
+        self.config_dir.mkdir(parents=True, exist_ok=True)
+        info = {
+            "host": self.host,
+            "port": self.port,
+            "token": self.token,
+            "pid": os.getpid(),
+        }
+        tmp_path = self.info_path.with_suffix(".json_tmp")
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(info, f)
+        tmp_path.replace(self.info_path)
+        return self
+
+    def serve_forever(self):
+        # until SIGINT or SIGTERM
+        if self._server is None:
+            self.start()
+        signal.signal(signal.SIGTERM, lambda *_: self._stopping.set())
+        try:
+            while not self._stopping.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        self._stopping.set()
+        with self._changed:
+            self._changed.notify_all()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        try:
+            with open(self.info_path) as f:
+                if json.load(f).get("token") == self.token:
+                    self.info_path.unlink()
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def submit(self, action, request):
+        job_id = self.queue.submit(action, request)
+        with self._changed:
+            self._changed.notify_all()
+        return job_id
+
+    def events(self, job_id, after=0):
+        # events of a job from index after on, waiting for more until it's
+        # finished
+        def more():
+            return (
+                len(self._events.get(job_id, ())) > after
+                or job_id in self._finished
+                or self._stopping.is_set()
+            )
+
+        while True:
+            with self._changed:
+                new = self._events.get(job_id, [])[after:]
+                finished = job_id in self._finished or self._stopping.is_set()
+            yield from new
+            after += len(new)
+            if finished:
+                break
+            if not new:
+                if job_id not in self._events and self.queue.get(job_id)[
+                    "status"
+                ] in ("done", "failed", "cancelled"):
+                    # finished before this daemon started, or cancelled
+                    break
+                with self._changed:
+                    self._changed.wait_for(more, timeout=1)
+
+        job = self.queue.get(job_id)
+        if job["status"] not in ("done", "failed", "cancelled"):
+            # the daemon is stopping, the stream just ends
+            return
+        yield {
+            "event": "job_finished",
+            "id": job_id,
+            "status": job["status"],
+            "result": job["result"],
+            "error": job["error"],
+        }
+
+    def _emit(self, job_id, event):
+        with self._changed:
+            self._events.setdefault(job_id, []).append(event)
+            self._changed.notify_all()
+
+    def _work(self, actions):
+        while not self._stopping.is_set():
+            job = self.queue.claim(actions)
+            if job is None:
+                with self._changed:
+                    self._changed.wait(timeout=1)
+                continue
+
+            job_id, action, request = job
+            self._emit(
+                job_id, {"event": "job_started", "id": job_id, "time": time.time()}
+            )
+            try:
+                result = self._run(action, request, lambda e: self._emit(job_id, e))
+            except Exception as e:
+                self.queue.finish(job_id, error=f"{type(e).__name__}: {e}")
+            else:
+                self.queue.finish(job_id, result)
+
+            with self._changed:
+                self._finished[job_id] = time.time()
+                while len(self._finished) > KEEP_EVENTS:
+                    old = next(iter(self._finished))
+                    del self._finished[old]
+                    self._events.pop(old, None)
+                self._changed.notify_all()
+
+    def _run(self, action, request, emit):
+        # results have the same form as the command line's --json output,
+        # with failed items next to them
+        qiwi = self.qiwi
+        args = request.get("args", [])
+        to = request.get("to")
+        if to is not None and to.startswith("/"):
+            to = qiwi.find_folder(to).id
+
+        if action == "list_files":
+            folder_id = args[0] if args else None
+            return {"data": [f.to_dict() for f in qiwi.iter_files(folder_id)]}
+
+        if action in ("move_files", "delete_files"):
+            def on_done(item, error):
+                emit(
+                    {
+                        "event": "item_done",
+                        "item": item,
+                        "error": None if error is None else str(error),
+                    }
+                )
+
+            if action == "move_files":
+                result = qiwi.bulk_move_files(
+                    args,
+                    to,
+                    request.get("concurrency", 1),
+                    request.get("rate"),
+                    on_done=on_done,
+                )
+                data = result.summary("moved")
+                if result.succeeded:
+                    data["to"] = "nullFolder" if to is None else to
+            else:
+                result = qiwi.bulk_delete_files(
+                    args,
+                    request.get("concurrency", 1),
+                    request.get("rate"),
+                    on_done=on_done,
+                )
+                data = result.summary("deleted")
+            return {
+                "data": data,
+                "failed": result.to_dict()["failed"],
+                "retries": result.retries,
+            }
+
+        on_event = self.upload_options.get("on_event")
+
+        def upload_event(event):
+            emit(event)
+            if on_event is not None:
+                on_event(event)
+
+        data = []
+        for path, file in qiwi.upload_files(
+            args,
+            to,
+            max_files=request.get("parallel_files", 1),
+            max_parts=request.get("max_parts"),
+            max_bytes=request.get("max_bytes"),
+            callback=None,
+            chunk_size=request.get("chunk_size"),
+            parallel_parts=request.get("parallel_parts", 1),
+            hashes=request.get("hashes"),
+            **{**self.upload_options, "on_event": upload_event},
+        ):
+            file.path = path
+            data.append(file.to_dict())
+            emit({"event": "file_uploaded", "path": path, "file": data[-1]})
+        return {"data": data}
+
+
+class DaemonClient:
+    # talks to a Daemon with http.client; it needs no cookies or session,
+    # so submitting a job costs one local request
+    def __init__(self, host, port, token, timeout=30):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.timeout = timeout
+
+    @classmethod
+    def find(cls, config_dir, timeout=1):
+        # a client for the daemon running for config_dir, or None
+        try:
+            with open(Path(config_dir) / "daemon.json") as f:
+                info = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        client = cls(info["host"], info["port"], info["token"], timeout)
+        try:
+            client.health()
+        except (OSError, QiwiGGError):
+            return None
+        return client
+
+    def _request(self, method, path, data=None, stream=False):
+        connection = http.client.HTTPConnection(
+            self.host, self.port, timeout=None if stream else self.timeout
+        )
+        headers = {"Authorization": f"Bearer {self.token}"}
+        body = None
+        if data is not None:
+            body = json.dumps(data)
+            headers["Content-Type"] = "application/json"
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        if response.status >= 300:
+            try:
+                message = json.loads(response.read())["error"]
+            except (ValueError, KeyError):
+                message = response.reason
+            connection.close()
+            raise QiwiGGError(f"Daemon request failed: {message}")
+        if stream:
+            return connection, response
+        try:
+            return json.loads(response.read())
+        finally:
+            connection.close()
+
+    def health(self):
+        return self._request("GET", "/health")
+
+    def submit(self, action, **request):
+        return self._request("POST", "/jobs", {"action": action, **request})["id"]
+
+    def job(self, job_id):
+        return self._request("GET", f"/jobs/{job_id}")
+
+    def jobs(self, limit=100):
+        return self._request("GET", f"/jobs?limit={limit}")
+
+    def cancel(self, job_id):
+        return self._request("DELETE", f"/jobs/{job_id}")
+
+    def events(self, job_id, after=0):
+        # yields the job's events until job_finished, the last one; the
+        # events end without it when the daemon stops or the connection breaks
+        connection, response = self._request(
+            "GET", f"/jobs/{job_id}/events?after={after}", stream=True
+        )
+        try:
+            for line in response:
+                yield json.loads(line)
+        finally:
+            connection.close()
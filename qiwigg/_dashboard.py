@@ -0,0 +1,83 @@
+import json
+
+from . import _exceptions, _qiwitypes
+
+
+_FLIGHT_START = b'self.__next_f.push([1,"f:'
+_FLIGHT_END = b'"])'
+
+
+def _folders_from_flight(text):
+    start = text.find("[")
+    end = text.rfind("]") + 1
+    for element in json.loads(text[start:end]):
+        if isinstance(element, dict):
+            if "data" in element:
+                return [
+                    _qiwitypes.QiwiFolder.from_object(x)
+                    for x in element["data"]
+                ]
+    return None
+
+
+def _literal_end(content, start):
+    # a quote preceded by an odd number of backslashes is escaped
+    end = content.find(_FLIGHT_END, start)
+    while end != -1:
+        backslashes = 0
+        while content[end - 1 - backslashes] == 0x5C:
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return end
+        end = content.find(_FLIGHT_END, end + 1)
+    return -1
+
+
+def _parse_folders_fast(content):
+    # scans the raw page for the "f:" flight chunk and decodes just that
+    # script's string literal instead of parsing the whole page
+    position = 0
+    while True:
+        start = content.find(_FLIGHT_START, position)
+        if start == -1:
+            return None
+        literal_start = start + len(_FLIGHT_START) - 3
+        end = _literal_end(content, literal_start + 1)
+        if end == -1:
+            return None
+
+        text = json.loads(content[literal_start:end + 1])
+        folders = _folders_from_flight(text)
+        if folders is not None:
+            return folders
+        position = end
+
+
+def _parse_folders_bs4(content):
+    try:
+        import bs4
+    except ModuleNotFoundError:
+        return None
+
+    soup = bs4.BeautifulSoup(content, features="html.parser")
+    for script in soup.select("script"):
+        if script.text.startswith('self.__next_f.push([1,"f:'):
+            start = script.text.find('"')
+            end = script.text.rfind('"') + 1
+            folders = _folders_from_flight(json.loads(script.text[start:end]))
+            if folders is not None:
+                return folders
+    return None
+
+
+def parse_folders(content):
+    if isinstance(content, str):
+        content = content.encode()
+
+    # bs4, when installed, is only a fallback for pages the scan can't read
+    folders = _parse_folders_fast(content)
+    if folders is None:
+        folders = _parse_folders_bs4(content)
+    if folders is None:
+        raise _exceptions.QiwiGGError("Folder data not found")
+    return folders
@@ -0,0 +1,181 @@
+import os
+import hashlib
+
+from pathlib import Path
+
+from . import _qiwitypes
+from ._utils import SQLiteDatabase
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    sample TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    name TEXT NOT NULL,
+    slug TEXT NOT NULL,
+    folder TEXT,
+    uploaded TEXT NOT NULL,
+    downloads INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_sample ON files (size, sample);
+"""
+UPDATE_FILE = (
+    "UPDATE files SET name = ?, slug = ?, folder = ?, uploaded = ?, "
+    "downloads = ? WHERE id = ?"
+)
+
+# the sampled fingerprint reads this many blocks, first and last included
+SAMPLE_BLOCKS = 8
+SAMPLE_BLOCK_SIZE = 65536
+HASH_BLOCK_SIZE = 1048576
+
+
+def sample_fingerprint(f, size):
+    # size plus hashes of a few blocks spread over the file: cheap to get
+    # for any file size, and files that differ almost always differ here
+    h = hashlib.blake2b(str(size).encode(), digest_size=16)
+    if size <= SAMPLE_BLOCKS * SAMPLE_BLOCK_SIZE:
+        offsets = [0]
+        length = size
+    else:
+        step = (size - SAMPLE_BLOCK_SIZE) // (SAMPLE_BLOCKS - 1)
+        offsets = [i * step for i in range(SAMPLE_BLOCKS)]
+        length = SAMPLE_BLOCK_SIZE
+    for offset in offsets:
+        h.update(os.pread(f.fileno(), length, offset))
+    return h.hexdigest()
+
+
+def full_hash(f):
+    h = hashlib.sha256()
+    f.seek(0)
+    while block := f.read(HASH_BLOCK_SIZE):
+        h.update(block)
+    return h.hexdigest()
+
+
+def _file_row(file):
+    return (
+        file.name,
+        file.slug,
+        file.parent_id,
+        file.uploaded,
+        file.downloads,
+        file.id,
+    )
+
+
+class DedupIndex(SQLiteDatabase):
+    # files uploaded before, by content: upload_file(dedup=index) returns
+    # the file already on qiwi.gg instead of uploading one whose size and
+    # sampled blocks match an indexed file and whose sha256 confirms it
+    def __init__(self, path):
+        super().__init__(path, SCHEMA)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT count(*) FROM files").fetchone()[0]
+
+    def fingerprint(self, file_path):
+        # (size, sample, sha256 or None); the whole file is only hashed when
+        # the sample matches something
+        with open(file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            sample = sample_fingerprint(f, size)
+            with self._lock:
+                candidates = self._db.execute(
+                    "SELECT count(*) FROM files WHERE size = ? AND sample = ?",
+                    (size, sample),
+                ).fetchone()[0]
+            sha256 = full_hash(f) if candidates else None
+        return size, sample, sha256
+
+    def find(self, fingerprint):
+        # the indexed QiwiFile with the same content or None
+        size, sample, sha256 = fingerprint
+        if sha256 is None:
+            return None
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, name, uploaded, size, slug, folder, downloads "
+                "FROM files WHERE size = ? AND sample = ? AND sha256 = ?",
+                (size, sample, sha256),
+            ).fetchone()
+        if row is None:
+            return None
+        return _qiwitypes.QiwiFile(
+            {
+                "_id": row[0],
+                "fileName": row[1],
+                "createdAt": row[2],
+                "fileSize": row[3],
+                "slug": row[4],
+                "folder": row[5],
+                "downloadCount": row[6],
+            }
+        )
+
+    def add(self, file, fingerprint, file_path=None):
+        # file_path is hashed when the fingerprint doesn't have the sha256
+        size, sample, sha256 = fingerprint
+        if sha256 is None:
+            with open(file_path, "rb") as f:
+                sha256 = full_hash(f)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO files "
+                "(size, sample, sha256, name, slug, folder, uploaded, downloads, id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (size, sample, sha256, *_file_row(file)),
+            )
+
+    def update(self, file):
+        # the indexed file's name and folder are file's, e.g. after a move
+        with self._lock:
+            self._db.execute(UPDATE_FILE, _file_row(file))
+
+    def remove(self, file_id):
+        if isinstance(file_id, _qiwitypes.QiwiFile):
+            file_id = file_id.id
+        with self._lock:
+            self._db.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    def rebuild(self, files, paths=()):
+        # files is a listing of every file on the account: indexed files
+        # that aren't in it are dropped, the rest get their current name
+        # and folder. Local copies in paths are matched to listed files by
+        # name and size and indexed; returns how many were added
+        listed = {}
+        by_name = {}
+        for file in files:
+            listed[file.id] = file
+            by_name.setdefault((file.name, file.size), file)
+
+        with self._lock:
+            indexed = [row[0] for row in self._db.execute("SELECT id FROM files")]
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for file_id in indexed:
+                    if file_id in listed:
+                        self._db.execute(UPDATE_FILE, _file_row(listed[file_id]))
+                    else:
+                        self._db.execute("DELETE FROM files WHERE id = ?", (file_id,))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+        added = 0
+        for path in paths:
+            path = Path(path)
+            file = by_name.get((path.name, path.stat().st_size))
+            if file is None:
+                continue
+            with open(path, "rb") as f:
+                sample = sample_fingerprint(f, file.size)
+                sha256 = full_hash(f)
+            self.add(file, (file.size, sample, sha256))
+            added += 1
+        return added
@@ -15,12 +15,25 @@ def _none_or_str(something):
         raise ValueError(f"Unexpected value: {repr(something)}")
 
 
+class RequestFailedError(QiwiGGError):
+    # status_code is None when no response came back at all, retry_after
+    # is the server's Retry-After in seconds
+    def __init__(self, message, body=None, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.body = _none_or_str(body)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
 class UploadFailedError(QiwiGGError):
-    def __init__(self, message, body, headers):
+    def __init__(self, message, body, headers, status_code=None, retry_after=None):
         super().__init__(message)
         self.message = message
         self.body = _none_or_str(body)
         self.headers = _none_or_str(headers)
+        self.status_code = status_code
+        self.retry_after = retry_after
 
     def __str__(self):
         lines = [self.message]
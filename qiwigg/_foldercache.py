@@ -0,0 +1,145 @@
+import json
+import time
+
+from . import _exceptions, _qiwitypes
+from ._utils import save_data
+
+
+class FolderCache:
+    # local copy of the folder tree indexed by id, path, name and parent;
+    # with a path it's kept on disk between runs
+    def __init__(self, path=None, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        self.updated_at = None
+        self._by_id = {}
+        self._reindex()
+
+        if path is not None:
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+            else:
+                self._by_id = {
+                    x["id"]: _qiwitypes.QiwiFolder(
+                        x["id"], x["name"], x["parent_id"], x["root"]
+                    )
+                    for x in data["folders"]
+                }
+                self.updated_at = data["updated_at"]
+                self._reindex()
+
+    def _parent_key(self, parent_id):
+        if parent_id in (None, "nullFolder"):
+            return self._root_id
+        return parent_id
+
+    def _reindex(self):
+        self._root_id = next(
+            (f.id for f in self._by_id.values() if f.root), None
+        )
+
+        self._children = {}
+        self._by_name = {}
+        for folder in self._by_id.values():
+            if not folder.root:
+                key = self._parent_key(folder.parent_id)
+                self._children.setdefault(key, []).append(folder)
+            self._by_name.setdefault(folder.name, []).append(folder)
+
+        self._by_path = {}
+        self._paths = {}
+        stack = [(f, "/") for f in self._by_id.values() if f.root]
+        stack += [(f, f"/{f.name}") for f in self._children.get(None, [])]
+        while stack:
+            folder, path = stack.pop()
+            self._by_path[path] = folder
+            self._paths[folder.id] = path
+            prefix = path.rstrip("/")
+            stack += [
+                (child, f"{prefix}/{child.name}")
+                for child in self._children.get(folder.id, [])
+            ]
+
+    @property
+    def loaded(self):
+        return self.updated_at is not None
+
+    def fresh(self):
+        return self.loaded and time.time() - self.updated_at < self.ttl
+
+    def save(self):
+        if self.path is None:
+            return
+        save_data(
+            self.path,
+            {
+                "updated_at": self.updated_at,
+                "folders": [
+                    {
+                        "id": f.id,
+                        "name": f.name,
+                        "parent_id": f.parent_id,
+                        "root": f.root,
+                    }
+                    for f in self._by_id.values()
+                ],
+            },
+        )
+
+    def replace(self, folders):
+        self._by_id = {f.id: f for f in folders}
+        self.updated_at = time.time()
+        self._reindex()
+        self.save()
+
+    def invalidate(self):
+        self.updated_at = None
+
+    def add(self, folder):
+        if not self.loaded:
+            return
+        self._by_id[folder.id] = folder
+        self._reindex()
+        self.save()
+
+    def remove(self, folder_id):
+        if not self.loaded:
+            return
+        if isinstance(folder_id, _qiwitypes.QiwiFolder):
+            folder_id = folder_id.id
+        # subfolders go with their parent
+        stack = [folder_id]
+        while stack:
+            current = stack.pop()
+            self._by_id.pop(current, None)
+            stack += [child.id for child in self._children.get(current, [])]
+        self._reindex()
+        self.save()
+
+    def folders(self):
+        return list(self._by_id.values())
+
+    def get(self, folder_id):
+        return self._by_id.get(folder_id)
+
+    def children(self, parent_id):
+        return list(self._children.get(self._parent_key(parent_id), []))
+
+    def path_of(self, folder_id):
+        return self._paths.get(folder_id)
+
+    def find(self, name_or_path):
+        # "/a/b" is a path from the main folder, anything else a folder name
+        # that has to be unique
+        if name_or_path.startswith("/"):
+            return self._by_path.get(name_or_path.rstrip("/") or "/")
+
+        folders = self._by_name.get(name_or_path, [])
+        if len(folders) > 1:
+            raise _exceptions.QiwiGGError(
+                f'Folder name "{name_or_path}" is ambiguous, use its path'
+            )
+        return folders[0] if folders else None
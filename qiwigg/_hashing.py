@@ -0,0 +1,55 @@
+import hashlib
+import queue
+import threading
+
+
+class Hasher:
+    # hashes buffers on its own thread so a part is hashed while its bytes
+    # are on the wire; hashlib drops the GIL for large updates
+    def __init__(self, names, max_pending=4):
+        self.names = tuple(names)
+        self._hashes = [hashlib.new(name) for name in self.names]
+        self._queue = queue.Queue(max_pending)
+        self._thread = threading.Thread(
+            target=self._run, name="qiwigg-hash", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            data, done = item
+            for h in self._hashes:
+                h.update(data)
+            if done is not None:
+                done.set()
+
+    def update(self, data, done=None):
+        # data must not change until done is set
+        self._queue.put((data, done))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def digests(self):
+        self.close()
+        return {name: h.hexdigest() for name, h in zip(self.names, self._hashes)}
+
+
+def combine_digests(part_digests):
+    # one part is the whole file. More parts are combined the way s3 builds
+    # multipart etags, hash of the concatenated part digests plus "-count",
+    # which isn't the file's hash, so they're named e.g. sha256_composite
+    if len(part_digests) == 1:
+        return dict(part_digests[0])
+
+    combined = {}
+    for name in part_digests[0]:
+        h = hashlib.new(name)
+        for digests in part_digests:
+            h.update(bytes.fromhex(digests[name]))
+        combined[f"{name}_composite"] = f"{h.hexdigest()}-{len(part_digests)}"
+    return combined
@@ -0,0 +1,144 @@
+import os
+import json
+import re
+import struct
+import zlib
+
+from pathlib import Path
+
+from ._exceptions import QiwiGGError
+
+
+# .qiwi_upload journal: MAGIC, a snapshot of the whole metadata dict, then
+# one record per part finished since the snapshot. A record is either
+# fixed size (md5 etag, nothing else) or JSON for anything else. Files
+# that don't start with MAGIC are the plain JSON metadata of old versions.
+MAGIC = b"QIWIUP1\n"
+# length, crc32 of the JSON that follows
+SNAPSHOT = struct.Struct("<II")
+# b"P", part index, part size, etag as 16 bytes, crc32 of what's before
+PART = struct.Struct("<c3xIQ16sI")
+# b"J", length, crc32 of the JSON that follows
+PART_JSON = struct.Struct("<c3xII")
+
+MD5_HEX = re.compile("[0-9a-f]{32}")
+
+
+def _set_part(data, index, etag=None, size=None, digests=None):
+    if etag is not None:
+        etags = data.setdefault("etags", [])
+        etags.extend([None] * (index + 1 - len(etags)))
+        etags[index] = [etag, size]
+    if digests is not None:
+        saved = data.setdefault("digests", [])
+        saved.extend([None] * (index + 1 - len(saved)))
+        saved[index] = digests
+
+
+class UploadJournal:
+    # keeps upload metadata so that saving a finished part costs one small
+    # append instead of rewriting everything; the snapshot is rewritten
+    # when anything else changes and every compact_every parts
+    def __init__(self, path, compact_every=1000):
+        self.path = Path(path)
+        self.compact_every = compact_every
+        self._records = 0
+        self._journal = False
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return {}
+
+        if not content.startswith(MAGIC):
+            # metadata of an old version, rewritten as a journal on save
+            return json.loads(content)
+
+        position = len(MAGIC)
+        length, crc = SNAPSHOT.unpack_from(content, position)
+        position += SNAPSHOT.size
+        snapshot = content[position:position + length]
+        if len(snapshot) != length or zlib.crc32(snapshot) != crc:
+            # snapshots are written with a rename, so this isn't a torn write
+            raise QiwiGGError(f"Upload metadata is corrupted: {self.path}")
+        data = json.loads(snapshot)
+        position += length
+
+        records = 0
+        while position < len(content):
+            kind = content[position:position + 1]
+            if kind == b"P" and position + PART.size <= len(content):
+                _, index, size, etag, crc = PART.unpack_from(content, position)
+                if zlib.crc32(content[position:position + PART.size - 4]) != crc:
+                    break
+                _set_part(data, index, etag.hex(), size)
+                position += PART.size
+            elif kind == b"J" and position + PART_JSON.size <= len(content):
+                _, length, crc = PART_JSON.unpack_from(content, position)
+                start = position + PART_JSON.size
+                payload = content[start:start + length]
+                if len(payload) != length or zlib.crc32(payload) != crc:
+                    break
+                _set_part(data, **json.loads(payload))
+                position = start + length
+            else:
+                break
+            records += 1
+
+        if position < len(content):
+            # the process died in the middle of an append, the part it was
+            # writing is simply uploaded again
+            os.truncate(self.path, position)
+
+        self._records = records
+        self._journal = True
+        return data
+
+    def save(self, data, part=None):
+        # part is the index of the one part that changed, None when
+        # anything else may have changed
+        if part is None or not self._journal or self._records >= self.compact_every:
+            self._write_snapshot(data)
+            return
+
+        etags = data.get("etags", [])
+        digests = data.get("digests") or []
+        etag = size = part_digests = None
+        if part < len(etags) and etags[part] is not None:
+            etag, size = etags[part]
+        if part < len(digests):
+            part_digests = digests[part]
+
+        if part_digests is None and etag is not None and MD5_HEX.fullmatch(etag):
+            record = PART.pack(b"P", part, size, bytes.fromhex(etag), 0)
+            record = record[:-4] + struct.pack("<I", zlib.crc32(record[:-4]))
+        else:
+            payload = {"index": part}
+            if etag is not None:
+                payload["etag"] = etag
+                payload["size"] = size
+            if part_digests is not None:
+                payload["digests"] = part_digests
+            payload = json.dumps(payload, separators=(",", ":")).encode()
+            record = PART_JSON.pack(b"J", len(payload), zlib.crc32(payload))
+            record += payload
+
+        with open(self.path, "ab") as f:
+            f.write(record)
+        self._records += 1
+
+    def _write_snapshot(self, data):
+        snapshot = json.dumps(data, separators=(",", ":")).encode()
+        tmp_path = self.path.with_suffix(f"{self.path.suffix}_tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(SNAPSHOT.pack(len(snapshot), zlib.crc32(snapshot)))
+            f.write(snapshot)
+        tmp_path.replace(self.path)
+        self._records = 0
+        self._journal = True
+
+    def delete(self):
+        self.path.unlink()
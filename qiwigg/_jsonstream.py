@@ -0,0 +1,110 @@
+import codecs
+import json
+
+from . import _exceptions
+
+
+_WHITESPACE = " \t\n\r"
+
+
+class _Reader:
+    # text buffer over an iterator of byte chunks; consumed text is dropped
+    # so memory stays bounded by the largest single value
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._decoder_json = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.exhausted = False
+
+    def _more(self):
+        if self.exhausted:
+            return False
+        for chunk in self._chunks:
+            if chunk:
+                text = self._decoder.decode(chunk)
+                if text:
+                    self.buffer = self.buffer[self.position:] + text
+                    self.position = 0
+                    return True
+        self.buffer = self.buffer[self.position:] + self._decoder.decode(
+            b"", final=True
+        )
+        self.position = 0
+        self.exhausted = True
+        return False
+
+    def peek(self):
+        while True:
+            while (
+                self.position < len(self.buffer)
+                and self.buffer[self.position] in _WHITESPACE
+            ):
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._more():
+                return ""
+
+    def expect(self, characters):
+        character = self.peek()
+        if character == "" or character not in characters:
+            raise ValueError(f"Expected {characters!r}, got {character!r}")
+        self.position += 1
+        return character
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder_json.raw_decode(
+                    self.buffer, self.position
+                )
+            except json.JSONDecodeError:
+                if not self._more():
+                    raise
+                continue
+            # a number at the end of the buffer may be cut in half
+            if end == len(self.buffer) and self._more():
+                continue
+            self.position = end
+            return value
+
+
+def iter_object_array(chunks, key, others):
+    # yields the items of the array under key in a top-level JSON object
+    # as they're decoded; every other member is stored in the others dict
+    reader = _Reader(chunks)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        name = reader.value()
+        reader.expect(":")
+        if name == key and reader.peek() == "[":
+            reader.expect("[")
+            if reader.peek() != "]":
+                while True:
+                    yield reader.value()
+                    if reader.expect(",]") == "]":
+                        break
+            else:
+                reader.expect("]")
+        else:
+            others[name] = reader.value()
+        if reader.expect(",}") == "}":
+            return
+
+
+def iter_response_array(response, key):
+    # streams a qiwi API response, raising like QiwiGG._qiwi_request does
+    others = {}
+    try:
+        yield from iter_object_array(
+            response.iter_content(chunk_size=65536), key, others
+        )
+    except ValueError:
+        raise _exceptions.QiwiGGError("Can't parse response")
+    if not others.get("success"):
+        raise _exceptions.QiwiGGError(f"Request failed: {json.dumps(others)}")
@@ -0,0 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import monotonic
+from urllib.parse import urlparse, parse_qs
+
+
+def url_lifetime(url, default):
+    query = parse_qs(urlparse(url).query)
+    try:
+        return min(default, int(query["X-Amz-Expires"][0]))
+    except (KeyError, ValueError):
+        return default
+
+
+class Presigner:
+    # presigns part URLs in the background ahead of the uploaders; a URL
+    # is handed out once, so asking for the same part again (a retry after
+    # the URL expired) fetches a fresh one
+    def __init__(
+        self, presign, part_numbers, lookahead=4, max_age=600, margin=30
+    ):
+        self._presign = presign
+        self._order = list(part_numbers)
+        self._position = {n: i for i, n in enumerate(self._order)}
+        self._lookahead = lookahead
+        self._max_age = max_age
+        self._margin = margin
+
+        self._lock = Lock()
+        self._futures = {}
+        self._handed_out = set()
+        self._expires_at = {}
+        self._next = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, min(lookahead, 8)),
+            thread_name_prefix="qiwigg-presign",
+        )
+
+        self.requests = 0
+        self.seconds = 0.0
+        self.wait_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    def _fetch(self, part_number):
+        start = monotonic()
+        url = self._presign(part_number)
+        end = monotonic()
+        expires_at = start + url_lifetime(url, self._max_age) - self._margin
+        return url, expires_at, end - start
+
+    def _schedule(self, until):
+        while self._next < len(self._order) and self._next <= until:
+            part_number = self._order[self._next]
+            if (
+                part_number not in self._futures
+                and part_number not in self._handed_out
+            ):
+                self._futures[part_number] = self._executor.submit(
+                    self._fetch, part_number
+                )
+            self._next += 1
+
+    def get(self, part_number):
+        with self._lock:
+            future = self._futures.pop(part_number, None)
+            if future is None:
+                future = self._executor.submit(self._fetch, part_number)
+            self._handed_out.add(part_number)
+            self._schedule(self._position.get(part_number, 0) + self._lookahead)
+
+        start = monotonic()
+        url, expires_at, duration = future.result()
+        waited = monotonic() - start
+        requests = 1
+
+        if monotonic() > expires_at:
+            url, expires_at, refetch_duration = self._fetch(part_number)
+            duration += refetch_duration
+            waited += refetch_duration
+            requests += 1
+
+        with self._lock:
+            self._expires_at[part_number] = expires_at
+            self.requests += requests
+            self.seconds += duration
+            self.wait_seconds += waited
+            self.saved_seconds += max(0.0, duration - waited)
+
+        return url
+
+    def expired(self, part_number):
+        # whether the URL last handed out for the part may no longer work
+        with self._lock:
+            expires_at = self._expires_at.get(part_number)
+        return expires_at is None or monotonic() > expires_at
+
+    def close(self):
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "presign_requests": self.requests,
+            "presign_seconds": round(self.seconds, 3),
+            "presign_wait_seconds": round(self.wait_seconds, 3),
+            "presign_saved_seconds": round(self.saved_seconds, 3),
+        }
@@ -4,29 +4,63 @@ import datetime
 import json
 import base64
 import datetime
+import re
+import threading
+import time
 
 from pathlib import Path
-from http.cookiejar import LWPCookieJar, Cookie
-from uuid import uuid4
-from time import sleep
-
-import requests
-import bs4
+from time import sleep, monotonic
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from functools import partial
 
 from . import _exceptions, _qiwitypes
-from ._utils import load_metadata, upload_callback
-from ._crypto import encrypt
-from ._chunk import Chunk
-from ._upload import upload_chunk
-
-
-__all__ = ["QiwiGG"]
+from ._utils import load_metadata, upload_callback, named_upload_callback
+from ._chunk import Chunk, MemoryChunk, plan_parts, read_part, MIN_CHUNK_SIZE
+from ._upload import TransportConfig, make_transport
+from ._presign import Presigner
+from ._scheduler import UploadLimiter
+from ._bulk import run_bulk
+from ._sync import sync_directory
+from ._sessioncache import SessionCache
+from ._foldercache import FolderCache
+from ._dashboard import parse_folders
+from ._jsonstream import iter_response_array
+from ._chunksize import ChunkSizer, DEFAULT_CHUNK_SIZE, saved_chunk_size
+from ._hashing import combine_digests
+from ._retry import RetryPolicy, classify, parse_retry_after, EXPIRED
+from ._telemetry import MetricsExporter, event_emitter, throughput
+from ._resumestore import ResumeStore
+from ._dedup import DedupIndex
+
+
+__all__ = [
+    "QiwiGG",
+    "ChunkSizer",
+    "FolderCache",
+    "MetricsExporter",
+    "ResumeStore",
+    "DedupIndex",
+]
 
 NAME = "QiwiGG Manager"
 VERSION = "1.0.0"
 QIWI_URL = "https://qiwi.gg"
 GITHUB = "https://github.com/FendinTridena/qiwigg-manager"
 
+# per part timings, summed into upload_stats; presigning is summed up by
+# the Presigner
+PART_PHASES = (
+    "queue_seconds",
+    "read_seconds",
+    "put_seconds",
+    "hash_seconds",
+    "retry_seconds",
+)
+
+# a part's etag is the md5 of its body unless the bucket encrypts with kms,
+# and a kms etag looks the same, so checking them is opt-in (check_etags)
+MD5_ETAG = re.compile("[0-9a-f]{32}", re.IGNORECASE)
+
 
 def find_newest_session(sessions):
     active_sessions = [
@@ -47,8 +81,169 @@ def find_newest_session(sessions):
     return session_name, session_expiration_date
 
 
+def token_expiration_date(token):
+    expire_at = json.loads(base64.b64decode(f'{token.split(".")[1]}=='))["exp"]
+    return datetime.datetime.fromtimestamp(
+        # set expiration 2 seconds earlier
+        expire_at - 2, tz=datetime.timezone.utc
+    )
+
+
+def cookie_site(url):
+    # host and whether the cookie is https only, from the URL it's for
+    from urllib.parse import urlsplit
+
+    parts = urlsplit(url)
+    return parts.hostname, parts.scheme == "https"
+
+
+def client_cookie(cookie_value, clerk_api="https://clerk.qiwi.gg/v1"):
+    from http.cookiejar import Cookie
+
+    host, secure = cookie_site(clerk_api)
+    # a leading dot matches subdomains, which an ip address can't have
+    initial_dot = not host.replace(".", "").isdigit() and host != "localhost"
+    in_10_years = datetime.datetime.now() + datetime.timedelta(days=3650)
+    return Cookie(
+        version=0,
+        name="__client",
+        value=cookie_value,
+        port=None,
+        port_specified=False,
+        domain=f".{host}" if initial_dot else host,
+        domain_specified=True,
+        domain_initial_dot=initial_dot,
+        path="/",
+        path_specified=True,
+        secure=secure,
+        expires=in_10_years.timestamp(),
+        discard=False,
+        comment=None,
+        comment_url=None,
+        rest={"HttpOnly": None, "SameSite": "Lax"},
+        rfc2109=True,
+    )
+
+
+def session_cookie(token, expiration_date, qiwi_url=QIWI_URL):
+    from http.cookiejar import Cookie
+
+    host, secure = cookie_site(qiwi_url)
+    return Cookie(
+        version=0,
+        name="__session",
+        value=token,
+        port=None,
+        port_specified=False,
+        domain=host,
+        domain_specified=True,
+        domain_initial_dot=False,
+        path="/",
+        path_specified=True,
+        secure=secure,
+        expires=expiration_date.timestamp(),
+        discard=False,
+        comment=None,
+        comment_url=None,
+        rest={"SameSite": "Lax"},
+        rfc2109=True,
+    )
+
+
+def check_identifier_step(response):
+    if (
+        response["object"] != "sign_in_attempt"
+        or response["status"] != "needs_first_factor"
+        or response["supported_first_factors"] is None
+        or response["supported_second_factors"] is not None
+        or response["first_factor_verification"] is not None
+        or response["second_factor_verification"] is not None
+    ):
+        raise _exceptions.QiwiGGError("Can't log in (email step)")
+    return response["id"]
+
+
+def check_password_step(response):
+    if (
+        response["object"] != "sign_in_attempt"
+        or response["status"] != "complete"
+    ):
+        raise _exceptions.QiwiGGError("Can't log in (password step)")
+
+
+def upload_init_request(name, size):
+    from uuid import uuid4
+    from ._crypto import encrypt
+
+    token = encrypt(str(size).encode())
+    data = {
+        "token": token.decode(),
+    }
+    params = {
+        "fileSize": size,
+        "id": uuid4(),
+        "fileName": name,
+        "fileType": "",
+    }
+    return data, params
+
+
+def check_part_md5(etag, digests):
+    if digests is None or "md5" not in digests or not MD5_ETAG.fullmatch(etag):
+        return
+    if etag.lower() != digests["md5"]:
+        raise _exceptions.UploadFailedError(
+            "Chunk was corrupted in transit, its ETag doesn't match its MD5",
+            None,
+            f"ETag: {etag}\nMD5: {digests['md5']}",
+        )
+
+
+def new_part_stats():
+    return {
+        "parts": 0,
+        "bytes": 0,
+        "retries": 0,
+        **dict.fromkeys(PART_PHASES, 0.0),
+    }
+
+
+def add_part_stats(stats, part, uploaded, started, emit):
+    # adds a finished part to the upload's stats and reports it
+    stats["parts"] += 1
+    stats["bytes"] += part["bytes"]
+    stats["retries"] += part["retries"]
+    for phase in PART_PHASES:
+        stats[phase] += part[phase]
+
+    if emit is not None:
+        emit(
+            "part_uploaded",
+            **part,
+            throughput=throughput(part["bytes"], part["put_seconds"]),
+            uploaded=uploaded,
+            average_throughput=throughput(stats["bytes"], monotonic() - started),
+        )
+
+
+def finish_part_stats(stats, presigner):
+    for phase in PART_PHASES:
+        stats[phase] = round(stats[phase], 3)
+    return {**stats, **presigner.stats()}
+
+
+def completed_parts(etags):
+    return [
+        {"PartNumber": i, "ETag": etag}
+        for i, (etag, _) in enumerate(etags, start=1)
+    ]
+
+
 class QiwiGG:
     USER_AGENT = f"{NAME.replace(' ', '')}/{VERSION} ({GITHUB})"
+    # all three can be set on an instance to talk to another server, see
+    # qiwigg.testing
+    QIWI_URL = QIWI_URL
     QIWI_API = f"{QIWI_URL}/api"
     CLERK_API = "https://clerk.qiwi.gg/v1"
     CLERK_JS_VERSION = "4.60.1"
@@ -60,13 +255,28 @@ class QiwiGG:
         cookie_jar_path=None,
         proxies=None,
         timeout=30,
+        transport_config=None,
+        chunk_sizer=None,
+        session_cache_path=None,
+        folder_cache=None,
+        retry_policy=None,
+        refresh_ahead=None,
+        check_etags=False,
     ):
+        # with refresh_ahead (seconds) a thread renews the token that long
+        # before it expires, as long as it's being used, so requests don't
+        # wait for Clerk
+        # imported here to keep "import qiwigg" and the CLI's --help fast
+        import requests
+        from ._cookiejar import LockedCookieJar
+
         if cookie_jar_path is None:
             cookie_jar_path = "cookies.txt"
 
+        self._requests = requests
         self.session = requests.Session()
         self.session.headers["User-Agent"] = self.USER_AGENT
-        self.session.cookies = LWPCookieJar(cookie_jar_path)
+        self.session.cookies = LockedCookieJar(cookie_jar_path)
 
         try:
             self.session.cookies.load(ignore_discard=True)
@@ -78,45 +288,124 @@ class QiwiGG:
         self.proxies = proxies
         self.timeout = timeout
 
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        # with hashes including md5, a part whose etag isn't its md5 failed
+        self.check_etags = check_etags
+
         self._session_name = None
         self._session_expiration_date = None
         self._token_expiration_date = None
+        # seconds a new token is valid for, known after the first one
+        self._token_lifetime = None
+        # one thread at a time logs in or gets a token, the rest wait for it
+        # and use what it got
+        self._auth_lock = threading.RLock()
+        self.refresh_ahead = refresh_ahead
+        self._token_used = False
+        self._refresher = None
+        self._refresher_stop = threading.Event()
+
+        self.session_cache = None
+        if session_cache_path is not None:
+            self.session_cache = SessionCache(session_cache_path)
+            self._use_cached_session(self.session_cache.load())
+
+        if folder_cache is None:
+            folder_cache = FolderCache()
+        self.folder_cache = folder_cache
+
+        if transport_config is None:
+            transport_config = TransportConfig(proxies=proxies)
+        self.transport_config = transport_config
+
+        if chunk_sizer is None:
+            chunk_sizer = ChunkSizer()
+        self.chunk_sizer = chunk_sizer
+        self._transport = None
+        self._transport_lock = threading.Lock()
 
-    def _save_cookies(self):
-        try:
-            self.session.cookies.save(ignore_discard=True)
-        except FileNotFoundError:
-            Path(self.session.cookies.filename).parent.mkdir(
-                parents=True, exist_ok=True
+    @property
+    def transport(self):
+        with self._transport_lock:
+            if self._transport is None:
+                self._transport = make_transport(self.transport_config)
+            return self._transport
+
+    def close(self):
+        self._refresher_stop.set()
+        with self._transport_lock:
+            if self._transport is not None:
+                self._transport.close()
+                self._transport = None
+        self.session.close()
+
+    def _use_cached_session(self, data):
+        now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+
+        if data.get("session_expires_at", 0) > now:
+            self._session_name = data["session_name"]
+            self._session_expiration_date = datetime.datetime.fromtimestamp(
+                data["session_expires_at"], tz=datetime.timezone.utc
             )
-            self.session.cookies.save(ignore_discard=True)
+        else:
+            return False
+
+        if data.get("token_expires_at", 0) > now:
+            self._token_expiration_date = datetime.datetime.fromtimestamp(
+                data["token_expires_at"], tz=datetime.timezone.utc
+            )
+            self.session.cookies.set_cookie(
+                session_cookie(
+                    data["token"], self._token_expiration_date, self.QIWI_URL
+                )
+            )
+            return True
+
+        return False
+
+    def _save_session_cache(self, token=None):
+        if self.session_cache is None or self._session_name is None:
+            return
+
+        # merged into what's there: another process may have saved a newer
+        # token for the same session meanwhile
+        with self.session_cache.lock():
+            data = self.session_cache.load()
+            if data.get("session_name") != self._session_name:
+                data = {}
+            data["session_name"] = self._session_name
+            data["session_expires_at"] = self._session_expiration_date.timestamp()
+            if token is not None:
+                expires_at = self._token_expiration_date.timestamp()
+                if expires_at > data.get("token_expires_at", 0):
+                    data["token"] = token
+                    data["token_expires_at"] = expires_at
+            self.session_cache.save(data)
+
+    def _save_cookies(self):
+        # nothing changes the jar while it's written out
+        with self.session.cookies.lock:
+            try:
+                self.session.cookies.save(ignore_discard=True)
+            except FileNotFoundError:
+                Path(self.session.cookies.filename).parent.mkdir(
+                    parents=True, exist_ok=True
+                )
+                self.session.cookies.save(ignore_discard=True)
 
     def set_client_cookie(self, cookie_value):
-        in_10_years = datetime.datetime.now() + datetime.timedelta(days=3650)
         self.session.cookies.set_cookie(
-            Cookie(
-                version=0,
-                name="__client",
-                value=cookie_value,
-                port=None,
-                port_specified=False,
-                domain=".clerk.qiwi.gg",
-                domain_specified=True,
-                domain_initial_dot=True,
-                path="/",
-                path_specified=True,
-                secure=True,
-                expires=in_10_years.timestamp(),
-                discard=False,
-                comment=None,
-                comment_url=None,
-                rest={"HttpOnly": None, "SameSite": "Lax"},
-                rfc2109=True,
-            )
+            client_cookie(cookie_value, self.CLERK_API)
         )
         self._save_cookies()
 
     def log_in(self, email=None, password=None, message=None):
+        with self._auth_lock:
+            self._log_in(email, password, message)
+
+    def _log_in(self, email, password, message):
         if email is None or password is None:
             email = self.email
             password = self.password
@@ -132,29 +421,14 @@ class QiwiGG:
 
         self._clerk_api_call("get", "environment")
         data = self._clerk_api_call("post", "client/sign_ins", {"identifier": email})
-        response = data["response"]
-        if (
-            response["object"] != "sign_in_attempt"
-            or response["status"] != "needs_first_factor"
-            or response["supported_first_factors"] is None
-            or response["supported_second_factors"] is not None
-            or response["first_factor_verification"] is not None
-            or response["second_factor_verification"] is not None
-        ):
-            raise _exceptions.QiwiGGError("Can't log in (email step)")
-        sia = response["id"]
+        sia = check_identifier_step(data["response"])
 
         data = self._clerk_api_call(
             "post",
             f"client/sign_ins/{sia}/attempt_first_factor",
             {"strategy": "password", "password": password},
         )
-        response = data["response"]
-        if (
-            response["object"] != "sign_in_attempt"
-            or response["status"] != "complete"
-        ):
-            raise _exceptions.QiwiGGError("Can't log in (password step)")
+        check_password_step(data["response"])
 
         (
             self._session_name,
@@ -165,6 +439,7 @@ class QiwiGG:
             raise _exceptions.QiwiGGError("Can't log in, no session found")
 
         self._save_cookies()
+        self._save_session_cache()
 
     def _clerk_api_call(self, method, what, data=None):
         if self._session_expiration_date is not None:
@@ -172,17 +447,13 @@ class QiwiGG:
             if now > self._session_expiration_date:
                 self.log_in()
 
-        url = f"{self.CLERK_API}/{what}"
-
-        r = self.session.request(
+        response_data = self._retry(
+            self._send_json,
             method,
-            url,
+            f"{self.CLERK_API}/{what}",
             params={"_clerk_js_version": self.CLERK_JS_VERSION},
             data=data,
-            proxies=self.proxies,
-            timeout=self.timeout,
         )
-        response_data = r.json()
 
         if "errors" in response_data:
             error = response_data["errors"][0]
@@ -195,10 +466,14 @@ class QiwiGG:
         return response_data
 
     def _get_session(self):
+        with self._auth_lock:
+            self._find_session()
+
+    def _find_session(self):
         data = self._clerk_api_call("get", "client")["response"]
         if data is None:
             self.log_in(message="Not logged in")
-            return self._get_session()
+            return self._find_session()
 
         (
             self._session_name,
@@ -207,12 +482,16 @@ class QiwiGG:
 
         if self._session_name is None:
             self.log_in(message="No active sessions found")
-            return self._get_session()
+            return self._find_session()
+
+        self._save_session_cache()
 
     @property
     def session_name(self):
         if self._session_name is None:
-            self._get_session()
+            with self._auth_lock:
+                if self._session_name is None:
+                    self._get_session()
 
         return self._session_name
 
@@ -223,44 +502,143 @@ class QiwiGG:
             {"active_organization_id": ""},
         )
 
+    def _token_valid(self, ahead=0):
+        if self._token_expiration_date is None:
+            return False
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return self._token_expiration_date > now + datetime.timedelta(
+            seconds=ahead
+        )
+
     def _get_token(self):
-        if self._token_expiration_date is not None:
-            now = datetime.datetime.now(datetime.timezone.utc)
-            if self._token_expiration_date > now:
+        # what requests call: the refresher only renews used tokens
+        self._token_used = True
+        if self.refresh_ahead is not None and self._refresher is None:
+            self._start_refresher()
+        self._ensure_token()
+
+    def _ensure_token(self, ahead=0):
+        # a token valid for at least ahead more seconds
+        if self._token_valid(ahead):
+            return
+
+        with self._auth_lock:
+            # another thread may have got one while this one was waiting
+            if self._token_valid(ahead):
+                return
+
+            if self.session_cache is None:
+                self._refresh_token()
+                return
+
+            session_name = self.session_name
+            # another process may have refreshed the token while this one
+            # was waiting for the lock
+            with self.session_cache.lock():
+                data = self.session_cache.load()
+                if data.get("session_name") == session_name:
+                    if self._use_cached_session(data) and self._token_valid(ahead):
+                        return
+                self._refresh_token()
+
+    def _start_refresher(self):
+        with self._auth_lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(
+                target=self._refresh_in_background,
+                name="qiwigg-token",
+                daemon=True,
+            )
+            self._refresher.start()
+
+    def _refresh_margin(self):
+        # refresh_ahead, but at most half a token's lifetime so a new token
+        # isn't already due for renewal
+        if self._token_lifetime is None:
+            return self.refresh_ahead
+        return min(self.refresh_ahead, self._token_lifetime / 2)
+
+    def _refresh_in_background(self):
+        # wakes up before the token expires and gets a new one if the
+        # current one was used since the last time; an unused token is left
+        # to expire and renewed by its next user
+        while True:
+            expires = self._token_expiration_date
+            margin = self._refresh_margin()
+            delay = 1.0
+            if expires is not None:
+                delay = max(1.0, expires.timestamp() - time.time() - margin)
+            if self._refresher_stop.wait(delay):
                 return
+            margin = self._refresh_margin()
+            if not self._token_used or self._token_valid(margin):
+                continue
+            self._token_used = False
+            try:
+                self._ensure_token(margin)
+            except Exception as e:
+                # the next request tries again itself
+                print(f"Couldn't refresh token: {e}", file=sys.stderr)
 
+    def _refresh_token(self):
         data = self._clerk_api_call(
             "post", f"client/sessions/{self.session_name}/tokens"
         )
         token = data["jwt"]
-        expire_at = json.loads(base64.b64decode(f'{token.split(".")[1]}=='))["exp"]
-        self._token_expiration_date = datetime.datetime.fromtimestamp(
-            # set expiration 2 seconds earlier
-            expire_at - 2, tz=datetime.timezone.utc
-        )
+        self._token_expiration_date = token_expiration_date(token)
+        self._token_lifetime = (
+            self._token_expiration_date
+            - datetime.datetime.now(datetime.timezone.utc)
+        ).total_seconds()
         self.session.cookies.set_cookie(
-            Cookie(
-                version=0,
-                name="__session",
-                value=token,
-                port=None,
-                port_specified=False,
-                domain="qiwi.gg",
-                domain_specified=True,
-                domain_initial_dot=False,
-                path="/",
-                path_specified=True,
-                secure=True,
-                expires=self._token_expiration_date.timestamp(),
-                discard=False,
-                comment=None,
-                comment_url=None,
-                rest={"SameSite": "Lax"},
-                rfc2109=True,
-            )
+            session_cookie(token, self._token_expiration_date, self.QIWI_URL)
+        )
+        self._save_session_cache(token)
+
+    def _report_retry(self, error, delay):
+        print(f"{error}\nRetrying in {delay:.1f}s", file=sys.stderr)
+
+    def _retry(self, function, *args, idempotent=True, **kwargs):
+        return self.retry_policy.call(
+            function,
+            *args,
+            on_retry=self._report_retry,
+            idempotent=idempotent,
+            **kwargs,
         )
 
-    def _qiwi_request(self, method, what, data=None, params=None):
+    def _send(self, method, url, **kwargs):
+        # failures worth retrying are raised as RequestFailedError, any
+        # other response is returned
+        try:
+            r = self.session.request(
+                method, url, proxies=self.proxies, timeout=self.timeout, **kwargs
+            )
+        except self._requests.RequestException as e:
+            raise _exceptions.RequestFailedError(str(e))
+
+        if r.status_code == 429 or r.status_code >= 500:
+            raise _exceptions.RequestFailedError(
+                f"Request failed with status {r.status_code}: {r.text}",
+                r.text,
+                r.status_code,
+                parse_retry_after(r.headers.get("Retry-After")),
+            )
+        return r
+
+    def _send_json(self, method, url, **kwargs):
+        r = self._send(method, url, **kwargs)
+        try:
+            return r.json()
+        except ValueError:
+            raise _exceptions.RequestFailedError(
+                f"Can't parse response: {r.text}", r.text, r.status_code
+            )
+
+    def _qiwi_request(self, method, what, data=None, params=None, idempotent=True):
+        # requests that create something aren't idempotent: they're only
+        # sent again when they can't have reached the server, see unprocessed
         self._get_token()
 
         headers = {}
@@ -268,66 +646,95 @@ class QiwiGG:
             headers["Content-Type"] = "application/json"
             data = json.dumps(data, cls=_qiwitypes.QiwiIDJSONEncoder)
 
-        r = self.session.request(
+        response_data = self._retry(
+            self._send_json,
             method,
             f"{self.QIWI_API}/{what}",
             params=params,
             data=data,
             headers=headers,
-            proxies=self.proxies,
-            timeout=self.timeout,
+            idempotent=idempotent,
         )
-        try:
-            data = r.json()
-        except:
-            raise _exceptions.QiwiGGError(f"Can't parse response: {r.text}")
-        if "success" not in data or not data["success"]:
-            raise _exceptions.QiwiGGError(f"Request failed: {r.text}")
-        return data
-
-    def get_folders(self):
+        if "success" not in response_data or not response_data["success"]:
+            raise _exceptions.QiwiGGError(
+                f"Request failed: {json.dumps(response_data)}"
+            )
+        return response_data
+
+    def get_folders(self, refresh=False):
+        if not refresh and self.folder_cache.fresh():
+            return self.folder_cache.folders()
+
+        folders = self._fetch_folders()
+        self.folder_cache.replace(folders)
+        return folders
+
+    def find_folder(self, name_or_path):
+        # "/a/b" is a path from the main folder, anything else is a folder
+        # name; the dashboard is loaded again once if it's not in the cache
+        self.get_folders()
+        folder = self.folder_cache.find(name_or_path)
+        if folder is None and not self._folders_just_fetched():
+            self.get_folders(refresh=True)
+            folder = self.folder_cache.find(name_or_path)
+        if folder is None:
+            raise _exceptions.QiwiGGError(f"Folder not found: {name_or_path}")
+        return folder
+
+    def _folders_just_fetched(self):
+        return time.time() - self.folder_cache.updated_at < 1
+
+    def _fetch_folders(self):
         self._get_token()
-        r = self.session.get(
-            f"{QIWI_URL}/dashboard", proxies=self.proxies, timeout=self.timeout
-        )
-        soup = bs4.BeautifulSoup(r.content, features="html.parser")
-        for script in soup.select("script"):
-            if script.text.startswith('self.__next_f.push([1,"f:'):
-                start = script.text.find('"')
-                end = script.text.rfind('"') + 1
-                tmp1 = json.loads(script.text[start:end])
-                start = tmp1.find("[")
-                end = tmp1.rfind("]") + 1
-                tmp2 = json.loads(tmp1[start:end])
-                for element in tmp2:
-                    if isinstance(element, dict):
-                        if "data" in element:
-                            return [
-                                _qiwitypes.QiwiFolder.from_object(x)
-                                for x in element["data"]
-                            ]
-
-        raise _exceptions.QiwiGGError("Folder data not found")
+        r = self._retry(self._send, "get", f"{self.QIWI_URL}/dashboard")
+        return parse_folders(r.content)
 
     def create_folder(self, name, parent_id=None):
         data = self._qiwi_request(
-            "post", "manageFolder", {"folderName": name, "parentFolder": parent_id}
+            "post",
+            "manageFolder",
+            {"folderName": name, "parentFolder": parent_id},
+            idempotent=False,
         )
 
         if parent_id is None:
             parent_id = "nullFolder"
+        elif isinstance(parent_id, _qiwitypes.QiwiFolder):
+            parent_id = parent_id.id
 
-        return _qiwitypes.QiwiFolder(data["folderId"], data["folderName"], parent_id)
+        folder = _qiwitypes.QiwiFolder(
+            data["folderId"], data["folderName"], parent_id
+        )
+        self.folder_cache.add(folder)
+        return folder
 
     def delete_folder(self, folder_id):
         self._qiwi_request("delete", "manageFolder", {"folderId": folder_id})
+        self.folder_cache.remove(folder_id)
 
     def get_files(self, folder_id=None):
+        return list(self.iter_files(folder_id))
+
+    def iter_files(self, folder_id=None):
+        # decodes the listing while it's downloaded, holding only the file
+        # being decoded instead of the whole response
         if folder_id is None:
             folder_id = "nullFolder"
 
-        data = self._qiwi_request("post", "getFolderFiles", {"folderId": folder_id})
-        return [_qiwitypes.QiwiFile(x) for x in data["folderFiles"]]
+        self._get_token()
+        # only getting the response is retried, not reading it
+        with self._retry(
+            self._send,
+            "post",
+            f"{self.QIWI_API}/getFolderFiles",
+            data=json.dumps(
+                {"folderId": folder_id}, cls=_qiwitypes.QiwiIDJSONEncoder
+            ),
+            headers={"Content-Type": "application/json"},
+            stream=True,
+        ) as r:
+            for x in iter_response_array(r, "folderFiles"):
+                yield _qiwitypes.QiwiFile(x)
 
     def move_file(self, file_id, folder_id):
         if folder_id is None:
@@ -351,6 +758,17 @@ class QiwiGG:
 
         return f_id
 
+    def bulk_move_files(
+        self, file_ids, folder_id, max_workers=8, rate=None, on_done=None
+    ):
+        return run_bulk(
+            lambda file_id: self.move_file(file_id, folder_id),
+            file_ids,
+            max_workers,
+            rate,
+            on_done,
+        )
+
     def delete_file(self, file_id):
         self._qiwi_request("delete", "manageFile", {"fileId": file_id})
 
@@ -358,20 +776,15 @@ class QiwiGG:
         for file_id in file_ids:
             self.delete_file(file_id)
 
+    def bulk_delete_files(self, file_ids, max_workers=8, rate=None, on_done=None):
+        return run_bulk(self.delete_file, file_ids, max_workers, rate, on_done)
+
     def _initialize_upload(self, name, size):
-        token = encrypt(str(size).encode())
         return self._qiwi_request(
             "post",
             "privateUpload",
-            {
-                "token": token.decode(),
-            },
-            {
-                "fileSize": size,
-                "id": uuid4(),
-                "fileName": name,
-                "fileType": "",
-            },
+            *upload_init_request(name, size),
+            idempotent=False,
         )
 
     def _get_upload_url(self, key, upload_id, part_number):
@@ -386,62 +799,231 @@ class QiwiGG:
         )
         return response["preSignedUrl"]
 
-    def _upload_chunks(
-        self, key, upload_id, etags, f, size, chunk_size, save_metadata, callback
-    ):
-        uploaded = 0
-        for _, saved_chunk_size in etags:
-            uploaded += saved_chunk_size
-            if uploaded == size:
-                break
-
-            if saved_chunk_size != chunk_size:
-                raise _exceptions.ChunkSizeError(
-                    "All non-trailing parts must have the same length",
-                    saved_chunk_size,
-                    chunk_size,
-                )
+    def _upload_part(self, presigner, limiter, hashes, chunk, index):
+        # returns the etag, the digests and how long each phase took
+        length = chunk.size
+        part = {
+            "part": index + 1,
+            "bytes": length,
+            "presign_wait_seconds": 0.0,
+            "queue_seconds": 0.0,
+            "put_seconds": 0.0,
+            "hash_seconds": 0.0,
+            "retries": 0,
+            "retry_seconds": 0.0,
+        }
+        upload_url = None
+        try:
+            while True:
+                # a URL is reused by retries until it expires
+                if upload_url is None or presigner.expired(index + 1):
+                    start = monotonic()
+                    upload_url = presigner.get(index + 1)
+                    part["presign_wait_seconds"] += monotonic() - start
+                chunk.rewind()
+                if hashes:
+                    chunk.start_hashing(hashes)
+
+                if limiter is not None:
+                    start = monotonic()
+                    limiter.acquire(length)
+                    part["queue_seconds"] += monotonic() - start
+                start = monotonic()
+                try:
+                    etag = self.transport.upload_chunk(upload_url, chunk)
+                    part["put_seconds"] = monotonic() - start
+
+                    start = monotonic()
+                    digests = chunk.finish_hashing() if hashes else None
+                    part["hash_seconds"] = monotonic() - start
+                    if self.check_etags:
+                        check_part_md5(etag, digests)
+
+                    part["read_seconds"] = chunk.read_seconds
+                    return etag, digests, part
+                except _exceptions.UploadFailedError as e:
+                    error = e
+                finally:
+                    # given back before the backoff, so a part waiting to be
+                    # retried doesn't hold up the other uploads
+                    if limiter is not None:
+                        limiter.release(length)
+
+                part["retries"] += 1
+                delay = self.retry_policy.delay(error, part["retries"])
+                if delay is None:
+                    raise error
+                if classify(error) == EXPIRED:
+                    upload_url = None
+                self._report_retry(error, delay)
+                sleep(delay)
+                part["retry_seconds"] += delay
+        finally:
+            chunk.stop_hashing()
+
+    def _hash_part(self, hashes, f, index, offset, length):
+        # for parts uploaded before hashing was asked for
+        chunk = Chunk(f, offset, length)
+        chunk.start_hashing(hashes)
+        for _ in chunk.views():
+            pass
+        return chunk.finish_hashing()
 
-        if (size - uploaded) / chunk_size > 10000 - len(etags):
-            raise _exceptions.QiwiGGError(
-                "Use larger chunk size. "
-                "There's a hard limit of 10000 chunks max per upload."
-            )
+    def _upload_parts(
+        self,
+        key,
+        upload_id,
+        parts,
+        chunks,
+        size,
+        uploaded,
+        callback,
+        on_part,
+        parallel_parts=1,
+        presign_ahead=None,
+        limiter=None,
+        hashes=None,
+        emit=None,
+        max_pending=None,
+        background=(),
+    ):
+        # uploads every (index, chunk) chunks yields, planned in parts, and
+        # calls on_part(index, etag, digests, part) as each one finishes;
+        # with max_pending the next chunk is only asked for once fewer
+        # parts are in flight. background is (function, on_result) pairs
+        # run by the same workers
+        stats = new_part_stats()
 
         if callback is not None:
             callback(uploaded, size)
 
-        tries = 0
-        while uploaded < size:
-            upload_url = self._get_upload_url(key, upload_id, len(etags) + 1)
-            chunk = Chunk(f, uploaded, chunk_size)
-            real_chunk_size = chunk.size
+        if len(parts) == 0 and len(background) == 0:
+            return stats
 
-            try:
-                etag = upload_chunk(upload_url, chunk)
-            except _exceptions.UploadFailedError as e:
-                tries += 1
-                if tries >= 10:
-                    raise
-                print(e, file=sys.stderr)
-                sleep(10)
-                continue
+        parallel_parts = max(1, parallel_parts)
+        if presign_ahead is None:
+            presign_ahead = 2 * parallel_parts
 
-            etags.append([etag, real_chunk_size])
-            save_metadata()
+        presigner = Presigner(
+            partial(self._get_upload_url, key, upload_id),
+            [index + 1 for index, _, _ in parts],
+            presign_ahead,
+        )
+
+        started = monotonic()
+        pending = {}
+
+        def collect(done):
+            nonlocal uploaded
+            for future in done:
+                index, on_result = pending.pop(future)
+                if on_result is not None:
+                    on_result(future.result())
+                    continue
 
-            tries = 0
-            uploaded += real_chunk_size
+                etag, part_digests, part = future.result()
+                on_part(index, etag, part_digests, part)
 
-            if callback is not None:
-                callback(uploaded, size)
+                uploaded += part["bytes"]
+                add_part_stats(stats, part, uploaded, started, emit)
 
+                if callback is not None:
+                    callback(uploaded, size)
+
+        executor = ThreadPoolExecutor(max_workers=parallel_parts)
+        try:
+            for function, on_result in background:
+                pending[executor.submit(function)] = (None, on_result)
+            for index, chunk in chunks:
+                future = executor.submit(
+                    self._upload_part, presigner, limiter, hashes, chunk, index
+                )
+                pending[future] = (index, None)
+                while max_pending is not None and len(pending) >= max_pending:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+            while pending:
+                collect(wait(pending, return_when=FIRST_COMPLETED).done)
+        finally:
+            executor.shutdown(cancel_futures=True)
+            presigner.close()
+
+        return finish_part_stats(stats, presigner)
+
+    def _upload_chunks(
+        self,
+        key,
+        upload_id,
+        etags,
+        f,
+        size,
+        chunk_size,
+        save_metadata,
+        callback,
+        parallel_parts=1,
+        presign_ahead=None,
+        limiter=None,
+        hashes=None,
+        digests=None,
+        emit=None,
+    ):
+        parts = plan_parts(etags, size, chunk_size)
+        uploaded = size - sum(length for _, _, length in parts)
+
+        def rehashed(index, part_digests):
+            digests[index] = part_digests
+            save_metadata(index)
+
+        # digests[i] belongs to etags[i], parts already uploaded keep theirs
+        background = []
+        if hashes:
+            del digests[len(etags):]
+            digests.extend([None] * (len(etags) - len(digests)))
+            for index, saved in enumerate(digests):
+                if etags[index] is None:
+                    digests[index] = None
+                elif saved is None or not set(hashes) <= saved.keys():
+                    background.append((
+                        partial(
+                            self._hash_part,
+                            hashes,
+                            f,
+                            index,
+                            index * chunk_size,
+                            etags[index][1],
+                        ),
+                        partial(rehashed, index),
+                    ))
+
+        # parts finish out of order, etags are stored under their part index
+        # so that anything in flight when the process dies is simply
+        # uploaded again on resume
+        def on_part(index, etag, part_digests, part):
+            etags[index] = [etag, part["bytes"]]
+            if hashes:
+                digests[index] = part_digests
+            save_metadata(index)
+
+        return self._upload_parts(
+            key,
+            upload_id,
+            parts,
+            (
+                (index, Chunk(f, offset, length))
+                for index, offset, length in parts
+            ),
+            size,
+            uploaded,
+            callback,
+            on_part,
+            parallel_parts,
+            presign_ahead,
+            limiter,
+            hashes,
+            emit,
+            background=background,
+        )
 
     def _finalize_upload(self, key, upload_id, file_id, etags):
-        parts = [
-            {"PartNumber": i, "ETag": etag}
-            for i, (etag, _) in enumerate(etags, start=1)
-        ]
         response = self._qiwi_request(
             "post",
             "completeUpload",
@@ -450,52 +1032,380 @@ class QiwiGG:
                 "uploadId": upload_id,
                 "fileId": file_id,
                 "completed": True,
-                "parts": parts,
+                "parts": completed_parts(etags),
             },
         )
         return response["result"]
 
+    def _run_upload(self, started, emit, upload_parts, finalize, hashes):
+        # what every upload does around its parts: upload_parts() returns
+        # the upload's stats and part digests, finalize(created_at) the
+        # finished file's data; failures are reported to emit
+        upload_stats = {}
+        try:
+            upload_stats, digests = upload_parts()
+
+            if upload_stats["parts"] > 0:
+                try:
+                    self.chunk_sizer.record(
+                        upload_stats["bytes"],
+                        upload_stats["put_seconds"],
+                        upload_stats["parts"],
+                        upload_stats["retries"],
+                    )
+                except Exception as e:
+                    # only chunk_size="auto" misses it, the upload is fine
+                    print(f"Couldn't save upload history: {e}", file=sys.stderr)
+
+            timestamp = datetime.datetime.now().isoformat()[:23]
+
+            start = monotonic()
+            final = finalize(f"{timestamp}Z")
+            upload_stats["finalize_seconds"] = round(monotonic() - start, 3)
+        except Exception as e:
+            if emit is not None:
+                emit("upload_failed", error=str(e), stats=upload_stats)
+            raise
+
+        seconds = monotonic() - started
+        upload_stats["seconds"] = round(seconds, 3)
+        upload_stats["throughput"] = throughput(upload_stats["bytes"], seconds)
+
+        file = _qiwitypes.QiwiFile(final)
+        file.upload_stats = upload_stats
+        if hashes:
+            file.digests = {**combine_digests(digests), "parts": digests}
+        return file
+
     def upload_file(
         self,
         file_path,
         metadata_path=None,
         chunk_size=None,
         callback=upload_callback,
+        parallel_parts=1,
+        presign_ahead=None,
+        limiter=None,
+        hashes=None,
+        on_event=None,
+        dedup=None,
+        destination=None,
     ):
-        if chunk_size is None:
-            chunk_size = 100000000
-        chunk_size = max(5242880, chunk_size)
-
+        # hashes names hashlib algorithms, e.g. ("md5", "sha256"), computed
+        # from the buffers as they're sent instead of a second read;
+        # on_event is called with a dict for every step of the upload;
+        # with a DedupIndex a file uploaded before is returned as it is;
+        # destination is the folder ID the file is going to be moved to,
+        # it's only kept with the resume data for resume_all
         file_path = Path(file_path)
         name = file_path.name
         size = os.path.getsize(file_path)
+        emit = event_emitter(on_event, path=str(file_path), name=name)
+        started = monotonic()
+
+        if dedup is not None:
+            fingerprint = dedup.fingerprint(file_path)
+            file = dedup.find(fingerprint)
+            if file is not None:
+                file.upload_stats = {
+                    "deduplicated": True,
+                    "seconds": round(monotonic() - started, 3),
+                }
+                if emit is not None:
+                    emit("upload_deduplicated", file_id=file.id, size=size)
+                return file
 
         data, save_metadata, delete_metadata = load_metadata(file_path, metadata_path)
 
-        if "info" not in data:
-            data["info"] = self._initialize_upload(name, size)
+        if chunk_size == "auto":
+            # a resumed upload has to keep the part size it started with
+            chunk_size = saved_chunk_size(data)
+            if chunk_size is None:
+                chunk_size = self.chunk_sizer.choose(size)
+        elif chunk_size is None:
+            chunk_size = DEFAULT_CHUNK_SIZE
+        chunk_size = max(MIN_CHUNK_SIZE, chunk_size)
+
+        def upload_parts():
+            if "info" not in data:
+                data["info"] = self._initialize_upload(name, size)
+                data["chunk_size"] = chunk_size
+                if destination is not None:
+                    data["destination"] = destination
+                save_metadata()
+
+            etags = data.setdefault("etags", [])
+            digests = data.setdefault("digests", []) if hashes else None
+
+            if emit is not None:
+                emit(
+                    "upload_started",
+                    size=size,
+                    chunk_size=chunk_size,
+                    resumed_parts=sum(etag is not None for etag in etags),
+                )
+
+            # parts are read with pread, so every worker shares one file
+            with open(file_path, "rb") as f:
+                upload_stats = self._upload_chunks(
+                    data["info"]["key"],
+                    data["info"]["uploadId"],
+                    etags,
+                    f,
+                    size,
+                    chunk_size,
+                    save_metadata,
+                    callback,
+                    parallel_parts,
+                    presign_ahead,
+                    limiter,
+                    hashes,
+                    digests,
+                    emit,
+                )
+            return upload_stats, digests
+
+        def finalize(created_at):
+            if "final" not in data:
+                data["final"] = self._finalize_upload(
+                    data["info"]["key"],
+                    data["info"]["uploadId"],
+                    data["info"]["result"],
+                    data["etags"],
+                )
+            data["final"].setdefault("createdAt", created_at)
             save_metadata()
+            return data["final"]
 
-        file_id = data["info"]["result"]
-        key = data["info"]["key"]
-        upload_id = data["info"]["uploadId"]
-        etags = data.setdefault("etags", [])
+        file = self._run_upload(started, emit, upload_parts, finalize, hashes)
+        delete_metadata()
 
-        with open(file_path, "rb") as f:
-            self._upload_chunks(
-                key, upload_id, etags, f, size, chunk_size, save_metadata, callback
+        if dedup is not None:
+            digests = data.get("digests") if hashes else None
+            if len(digests or ()) == 1 and "sha256" in digests[0]:
+                # a single chunk's digest is the whole file's
+                fingerprint = (*fingerprint[:2], digests[0]["sha256"])
+            dedup.add(file, fingerprint, file_path)
+
+        if emit is not None:
+            emit("upload_finished", file_id=file.id, stats=file.upload_stats)
+        return file
+
+    def _upload_stream_chunks(
+        self,
+        key,
+        upload_id,
+        fileobj,
+        size,
+        chunk_size,
+        callback,
+        parallel_parts,
+        buffered_parts,
+        presign_ahead,
+        limiter,
+        hashes,
+        emit,
+    ):
+        # parts are read in order into a ring of buffered_parts buffers,
+        # each one reused once its part is uploaded, retries included
+        etags = []
+        parts = plan_parts(etags, size, chunk_size)
+        digests = [None] * len(etags)
+        free = []
+        # buffer and read time of parts in flight
+        reading = {}
+
+        def chunks():
+            # only asked for a part while fewer than buffered_parts are in
+            # flight, so there's always a buffer to read it into
+            for index, _, length in parts:
+                buffer = free.pop() if free else bytearray(chunk_size)
+
+                start = monotonic()
+                n = read_part(fileobj, buffer, length)
+                reading[index] = (buffer, monotonic() - start)
+                if n < length:
+                    raise _exceptions.QiwiGGError(
+                        f"Stream ended after {index * chunk_size + n} bytes, "
+                        f"expected {size}"
+                    )
+                yield index, MemoryChunk(buffer, length)
+
+            if read_part(fileobj, bytearray(1), 1):
+                raise _exceptions.QiwiGGError(
+                    f"Stream is longer than expected {size} bytes"
+                )
+
+        def on_part(index, etag, part_digests, part):
+            buffer, read_seconds = reading.pop(index)
+            free.append(buffer)
+            etags[index] = [etag, part["bytes"]]
+            digests[index] = part_digests
+            part["read_seconds"] += read_seconds
+
+        stats = self._upload_parts(
+            key,
+            upload_id,
+            parts,
+            chunks(),
+            size,
+            0,
+            callback,
+            on_part,
+            parallel_parts,
+            presign_ahead,
+            limiter,
+            hashes,
+            emit,
+            max_pending=buffered_parts,
+        )
+        return etags, digests, stats
+
+    def upload_stream(
+        self,
+        fileobj,
+        name,
+        size,
+        chunk_size=None,
+        callback=upload_callback,
+        parallel_parts=1,
+        buffered_parts=None,
+        presign_ahead=None,
+        limiter=None,
+        hashes=None,
+        on_event=None,
+    ):
+        # uploads size bytes read from fileobj, which only has to have read
+        # or readinto, e.g. a pipe or a response body. Parts are kept in
+        # memory until they're uploaded so they can be retried, at most
+        # buffered_parts of them (parallel_parts + 1 by default), and that
+        # many times chunk_size is the memory it takes. Nothing is saved to
+        # resume from, a stream can't be read again
+        emit = event_emitter(on_event, path=None, name=name)
+        started = monotonic()
+
+        if chunk_size == "auto":
+            chunk_size = self.chunk_sizer.choose(size)
+        elif chunk_size is None:
+            chunk_size = DEFAULT_CHUNK_SIZE
+        chunk_size = max(MIN_CHUNK_SIZE, chunk_size)
+        # a small stream doesn't need a full sized buffer
+        chunk_size = min(chunk_size, max(MIN_CHUNK_SIZE, size))
+        if buffered_parts is None:
+            buffered_parts = max(1, parallel_parts) + 1
+
+        info = {}
+        etags = []
+
+        def upload_parts():
+            info.update(self._initialize_upload(name, size))
+            if emit is not None:
+                emit("upload_started", size=size, chunk_size=chunk_size)
+
+            part_etags, digests, upload_stats = self._upload_stream_chunks(
+                info["key"],
+                info["uploadId"],
+                fileobj,
+                size,
+                chunk_size,
+                callback,
+                parallel_parts,
+                max(1, buffered_parts),
+                presign_ahead,
+                limiter,
+                hashes,
+                emit,
             )
+            etags.extend(part_etags)
+            return upload_stats, digests
 
-        timestamp = datetime.datetime.now().isoformat()[:23]
+        def finalize(created_at):
+            final = self._finalize_upload(
+                info["key"], info["uploadId"], info["result"], etags
+            )
+            final.setdefault("createdAt", created_at)
+            return final
 
-        if "final" not in data:
-            data["final"] = self._finalize_upload(key, upload_id, file_id, etags)
-            save_metadata()
+        file = self._run_upload(started, emit, upload_parts, finalize, hashes)
 
-        if "createdAt" not in data["final"]:
-            data["final"]["createdAt"] = f"{timestamp}Z"
-            save_metadata()
+        if emit is not None:
+            emit("upload_finished", file_id=file.id, stats=file.upload_stats)
+        return file
 
-        file = _qiwitypes.QiwiFile(data["final"])
-        delete_metadata()
+    def _upload_to_folder(self, path, folder_id, **kwargs):
+        # uploads land in the main folder and are moved from there
+        if folder_id is None:
+            folder_id = "nullFolder"
+        elif isinstance(folder_id, _qiwitypes.QiwiFolder):
+            folder_id = folder_id.id
+        file = self.upload_file(path, destination=folder_id, **kwargs)
+        if folder_id != "nullFolder":
+            self.move_file(file, folder_id)
+            # the index has the folder the file was uploaded to
+            dedup = kwargs.get("dedup")
+            if dedup is not None:
+                dedup.update(file)
         return file
+
+    def upload_files(
+        self,
+        file_paths,
+        folder_id=None,
+        max_files=4,
+        max_parts=None,
+        max_bytes=None,
+        callback=named_upload_callback,
+        **kwargs,
+    ):
+        # yields (path, QiwiFile) as each file finishes; callback is called
+        # with the path when its upload starts and returns the progress
+        # callback for that file
+        limiter = UploadLimiter(max_parts, max_bytes)
+
+        def upload(path):
+            return self._upload_to_folder(
+                path,
+                folder_id,
+                callback=None if callback is None else callback(path),
+                limiter=limiter,
+                **kwargs,
+            )
+
+        executor = ThreadPoolExecutor(max_workers=max(1, max_files))
+        try:
+            futures = {executor.submit(upload, path): path for path in file_paths}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def sync_directory(
+        self,
+        local_dir,
+        folder_id=None,
+        state_path=None,
+        max_files=4,
+        max_parts=None,
+        max_bytes=None,
+        callback=named_upload_callback,
+        on_done=None,
+        **kwargs,
+    ):
+        # mirrors local_dir into folder_id: missing folders are created and
+        # files uploaded unless a file of the same name and size is there
+        # already; returns a SyncResult. state_path keeps what was synced so
+        # the next run only stats unchanged files, by default it's
+        # .qiwigg-sync.json in local_dir, False keeps no state; on_done is
+        # called with the path and None or the error of every upload
+        return sync_directory(
+            self,
+            local_dir,
+            folder_id,
+            state_path,
+            max_files,
+            max_parts,
+            max_bytes,
+            callback,
+            on_done,
+            **kwargs,
+        )
@@ -1,4 +1,3 @@
-from inspect import getmembers
 from json import JSONEncoder
 
 from . import _qiwi
@@ -14,6 +13,19 @@ __all__ = [
 
 
 class QiwiCommon:
+    __slots__ = ()
+    # attributes (and properties) that make up the JSON form, sorted by name
+    _fields = ()
+
+    def to_dict(self):
+        data = {}
+        for name in self._fields:
+            try:
+                data[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        return data
+
     def __str__(self):
         return f"{self.name} (ID:{self.id})"
 
@@ -27,6 +39,9 @@ class QiwiCommon:
 
 
 class QiwiFolder(QiwiCommon):
+    __slots__ = ("id", "name", "parent_id", "root")
+    _fields = tuple(sorted((*__slots__, "url")))
+
     def __init__(self, id, name, parent_id, root=False):
         self.id = id
         self.name = name
@@ -48,6 +63,21 @@ class QiwiFolder(QiwiCommon):
 
 
 class QiwiFile(QiwiCommon):
+    # path, upload_stats and digests are only set on files from uploads
+    __slots__ = (
+        "id",
+        "name",
+        "uploaded",
+        "size",
+        "slug",
+        "parent_id",
+        "downloads",
+        "path",
+        "upload_stats",
+        "digests",
+    )
+    _fields = tuple(sorted((*__slots__, "url")))
+
     def __init__(self, object):
         self.id = object["_id"]
         self.name = object["fileName"]
@@ -75,9 +105,5 @@ class QiwiIDJSONEncoder(JSONEncoder):
 class QiwiJSONEncoder(JSONEncoder):
     def default(self, obj):
         if isinstance(obj, QiwiCommon):
-            return dict(
-                (k, v)
-                for k, v in getmembers(obj)
-                if not k.startswith("_") and not callable(v)
-            )
+            return obj.to_dict()
         return JSONEncoder.default(self, obj)
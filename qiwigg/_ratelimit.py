@@ -0,0 +1,70 @@
+import threading
+
+from time import monotonic, sleep
+
+
+__all__ = ["set_upload_rate"]
+
+
+class RateLimiter:
+    # token bucket; rate is in tokens per second, None means unlimited
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self.rate = None
+        self.burst = None
+        self._tokens = 0.0
+        self._updated = monotonic()
+        self.set_rate(rate, burst)
+        if self.burst is not None:
+            self._tokens = self.burst
+
+    def set_rate(self, rate, burst=None):
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            if burst is None and rate is not None:
+                burst = max(1.0, rate)
+            self.burst = burst
+            if burst is not None:
+                self._tokens = min(self._tokens, burst)
+
+    def _refill(self):
+        now = monotonic()
+        if self.rate is not None:
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        # more tokens than the bucket holds are taken as a debt that later
+        # callers wait out, so big requests still go through
+        while True:
+            with self._lock:
+                if self.rate is None:
+                    return
+                self._refill()
+                if self._tokens >= min(tokens, self.burst):
+                    self._tokens -= tokens
+                    return
+                wait = (min(tokens, self.burst) - self._tokens) / self.rate
+            sleep(wait)
+
+    def take(self, tokens):
+        # doesn't wait, returns how many of the tokens may be used now
+        with self._lock:
+            if self.rate is None:
+                return tokens
+            self._refill()
+            granted = max(0, min(tokens, int(self._tokens)))
+            self._tokens -= granted
+            return granted
+
+
+# bytes per second of chunk uploads, shared by every transport in the process
+upload_bandwidth = RateLimiter()
+
+
+def set_upload_rate(rate, burst=None):
+    # takes effect on transfers already running; None removes the limit
+    upload_bandwidth.set_rate(rate, burst)
@@ -0,0 +1,214 @@
+import json
+import time
+
+from functools import partial
+from pathlib import Path
+
+from ._utils import SQLiteDatabase
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS parts (
+    upload_id INTEGER NOT NULL REFERENCES uploads (id) ON DELETE CASCADE,
+    part INTEGER NOT NULL,
+    etag TEXT,
+    size INTEGER,
+    digests TEXT,
+    PRIMARY KEY (upload_id, part)
+) WITHOUT ROWID;
+"""
+
+
+def _file_key(file_path):
+    file_path = Path(file_path).resolve()
+    stat = file_path.stat()
+    return str(file_path), stat.st_size, stat.st_mtime_ns
+
+
+class ResumeStore(SQLiteDatabase):
+    # resume metadata of every upload in one SQLite database instead of a
+    # .qiwi_upload file next to each file; pass it as metadata_path. An
+    # upload is found by the file's absolute path and resumed only while
+    # the file's size and mtime are what they were when it started
+    def __init__(self, path):
+        # a committed part may be lost with the OS, never half written
+        super().__init__(path, SCHEMA, ("synchronous=NORMAL", "foreign_keys=ON"))
+
+    def load(self, file_path):
+        # same (data, save_metadata, delete_metadata) as load_metadata
+        path, size, mtime_ns = _file_key(file_path)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, size, mtime_ns, data FROM uploads WHERE path = ?",
+                (path,),
+            ).fetchone()
+            if row is not None and (row[1], row[2]) != (size, mtime_ns):
+                # the file changed, its parts can't be used anymore
+                self._db.execute("DELETE FROM uploads WHERE id = ?", (row[0],))
+                row = None
+            if row is None:
+                data = {}
+                upload = _StoredUpload(self, path, size, mtime_ns)
+                return data, partial(upload.save, data), upload.delete
+
+            upload_id = row[0]
+            data = json.loads(row[3])
+            parts = self._db.execute(
+                "SELECT part, etag, size, digests FROM parts WHERE upload_id = ?",
+                (upload_id,),
+            ).fetchall()
+
+        for part, etag, part_size, digests in parts:
+            if etag is not None:
+                etags = data.setdefault("etags", [])
+                etags.extend([None] * (part + 1 - len(etags)))
+                etags[part] = [etag, part_size]
+            if digests is not None:
+                saved = data.setdefault("digests", [])
+                saved.extend([None] * (part + 1 - len(saved)))
+                saved[part] = json.loads(digests)
+
+        upload = _StoredUpload(self, path, size, mtime_ns, upload_id)
+        return data, partial(upload.save, data), upload.delete
+
+    def pending(self):
+        # uploads that were started and haven't finished, oldest first;
+        # changed is True when the file is gone or no longer the same,
+        # destination is the folder ID upload_files was moving it to
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT uploads.path, uploads.size, uploads.mtime_ns, "
+                "uploads.data, uploads.updated_at, count(parts.etag) "
+                "FROM uploads LEFT JOIN parts ON parts.upload_id = uploads.id "
+                "GROUP BY uploads.id ORDER BY uploads.updated_at"
+            ).fetchall()
+
+        uploads = []
+        for path, size, mtime_ns, data, updated_at, done in rows:
+            data = json.loads(data)
+            chunk_size = data.get("chunk_size")
+            try:
+                changed = _file_key(path)[1:] != (size, mtime_ns)
+            except OSError:
+                changed = True
+            uploads.append({
+                "path": path,
+                "size": size,
+                "mtime": mtime_ns / 1e9,
+                "file_id": data.get("info", {}).get("result"),
+                "parts_done": done,
+                "parts": -(-size // chunk_size) if chunk_size else None,
+                "destination": data.get("destination"),
+                "updated_at": updated_at,
+                "changed": changed,
+            })
+        return uploads
+
+    def forget(self, file_path):
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM uploads WHERE path = ?",
+                (str(Path(file_path).resolve()),),
+            )
+
+
+class _StoredUpload:
+    # save_metadata and delete_metadata of one upload in a ResumeStore
+    def __init__(self, store, path, size, mtime_ns, upload_id=None):
+        self.store = store
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.upload_id = upload_id
+
+    def save(self, data, part=None):
+        # part is the index of the one part that changed, None when
+        # anything else may have changed
+        db = self.store._db
+        with self.store._lock:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                if part is not None and self.upload_id is not None:
+                    # one small row per finished part
+                    db.execute(
+                        "INSERT OR REPLACE INTO parts VALUES (?, ?, ?, ?, ?)",
+                        (self.upload_id, part, *self._part(data, part)),
+                    )
+                    db.execute(
+                        "UPDATE uploads SET updated_at = ? WHERE id = ?",
+                        (time.time(), self.upload_id),
+                    )
+                    db.execute("COMMIT")
+                    return
+
+                rest = {
+                    key: value
+                    for key, value in data.items()
+                    if key not in ("etags", "digests")
+                }
+                if self.upload_id is None:
+                    # another process may have started this file meanwhile,
+                    # the last one to start wins
+                    db.execute("DELETE FROM uploads WHERE path = ?", (self.path,))
+                    self.upload_id = db.execute(
+                        "INSERT INTO uploads "
+                        "(path, size, mtime_ns, data, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (
+                            self.path,
+                            self.size,
+                            self.mtime_ns,
+                            json.dumps(rest),
+                            time.time(),
+                        ),
+                    ).lastrowid
+                else:
+                    db.execute(
+                        "UPDATE uploads SET data = ?, updated_at = ? WHERE id = ?",
+                        (json.dumps(rest), time.time(), self.upload_id),
+                    )
+                    db.execute(
+                        "DELETE FROM parts WHERE upload_id = ?", (self.upload_id,)
+                    )
+                parts = max(
+                    len(data.get("etags", [])), len(data.get("digests") or [])
+                )
+                rows = [
+                    (self.upload_id, index, *self._part(data, index))
+                    for index in range(parts)
+                ]
+                db.executemany(
+                    "INSERT INTO parts VALUES (?, ?, ?, ?, ?)",
+                    [row for row in rows if row[2:] != (None, None, None)],
+                )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    @staticmethod
+    def _part(data, index):
+        etags = data.get("etags", [])
+        digests = data.get("digests") or []
+        etag = size = part_digests = None
+        if index < len(etags) and etags[index] is not None:
+            etag, size = etags[index]
+        if index < len(digests) and digests[index] is not None:
+            part_digests = json.dumps(digests[index])
+        return etag, size, part_digests
+
+    def delete(self):
+        if self.upload_id is None:
+            return
+        with self.store._lock:
+            self.store._db.execute(
+                "DELETE FROM uploads WHERE id = ?", (self.upload_id,)
+            )
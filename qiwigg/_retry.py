@@ -0,0 +1,137 @@
+import datetime
+import random
+import threading
+
+from email.utils import parsedate_to_datetime
+from time import sleep
+
+from ._exceptions import RequestFailedError, UploadFailedError
+
+
+__all__ = ["RetryPolicy"]
+
+
+# what a failed request is, decides if and how soon it's tried again
+FATAL = "fatal"
+TRANSIENT = "transient"
+THROTTLED = "throttled"
+EXPIRED = "expired"
+
+_counter = threading.local()
+
+
+def parse_retry_after(value):
+    # seconds or an http date, None if missing or unreadable
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (date - now).total_seconds())
+
+
+def classify(error):
+    if not isinstance(error, (RequestFailedError, UploadFailedError)):
+        return FATAL
+
+    body = error.body or ""
+    status_code = error.status_code
+    if "Worker exceeded resource limits" in body:
+        return THROTTLED
+    if status_code is None:
+        # connection reset, timeout, a corrupted chunk: nothing came back
+        # or what came back was wrong
+        return TRANSIENT
+    if status_code in (429, 503):
+        return THROTTLED
+    if status_code == 403 and "expired" in body.lower():
+        return EXPIRED
+    if status_code == 408 or status_code >= 500 or status_code < 400:
+        return TRANSIENT
+    return FATAL
+
+
+def refused(error):
+    # a refused connection never carried the request, so it can't have done
+    # anything on the server; the cause is somewhere down the chain
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, ConnectionRefusedError):
+            return True
+        seen.add(id(error))
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def unprocessed(error):
+    # failures a request that isn't idempotent can be sent again after:
+    # anything else may have happened on the server before it failed
+    return getattr(error, "status_code", None) == 429 or refused(error)
+
+
+def thread_retries():
+    # retries made by RetryPolicy.call on the calling thread so far
+    return getattr(_counter, "retries", 0)
+
+
+class RetryPolicy:
+    # exponential backoff with jitter; throttling starts from a longer delay
+    # and honours Retry-After, an expired presigned URL is retried at once
+    # and other 4xx errors aren't retried at all
+    def __init__(
+        self,
+        max_tries=10,
+        base_delay=1.0,
+        throttle_delay=10.0,
+        max_delay=60.0,
+        max_retry_after=600.0,
+        jitter=0.5,
+    ):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.throttle_delay = throttle_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.jitter = jitter
+
+    def delay(self, error, tries, idempotent=True):
+        # seconds to wait after the tries-th failure, None to give up
+        kind = classify(error)
+        if kind == FATAL or tries >= self.max_tries:
+            return None
+        if not idempotent and not unprocessed(error):
+            return None
+        if kind == EXPIRED:
+            return 0.0
+
+        base = self.throttle_delay if kind == THROTTLED else self.base_delay
+        delay = min(self.max_delay, base * 2 ** (tries - 1))
+        # jitter takes off up to that fraction so clients that failed
+        # together don't all come back together
+        delay *= 1 - self.jitter * random.random()
+
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_retry_after))
+        return delay
+
+    def call(self, function, *args, on_retry=None, idempotent=True, **kwargs):
+        tries = 0
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except (RequestFailedError, UploadFailedError) as error:
+                tries += 1
+                delay = self.delay(error, tries, idempotent)
+                if delay is None:
+                    raise
+                _counter.retries = thread_retries() + 1
+                if on_retry is not None:
+                    on_retry(error, delay)
+                sleep(delay)
@@ -0,0 +1,34 @@
+import threading
+
+
+class UploadLimiter:
+    # caps the number of parts and bytes being uploaded at once across all
+    # files sharing the limiter; a part bigger than max_bytes is still let
+    # through when nothing else is in flight
+    def __init__(self, max_parts=None, max_bytes=None):
+        self.max_parts = max_parts
+        self.max_bytes = max_bytes
+        self.parts = 0
+        self.bytes = 0
+        self._condition = threading.Condition()
+
+    def _fits(self, size):
+        if self.parts == 0:
+            return True
+        if self.max_parts is not None and self.parts >= self.max_parts:
+            return False
+        if self.max_bytes is not None and self.bytes + size > self.max_bytes:
+            return False
+        return True
+
+    def acquire(self, size):
+        with self._condition:
+            self._condition.wait_for(lambda: self._fits(size))
+            self.parts += 1
+            self.bytes += size
+
+    def release(self, size):
+        with self._condition:
+            self.parts -= 1
+            self.bytes -= size
+            self._condition.notify_all()
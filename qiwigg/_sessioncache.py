@@ -0,0 +1,8 @@
+from ._utils import LockedJSONFile
+
+
+class SessionCache(LockedJSONFile):
+    # Clerk session id and the current __session token with their expiry
+    # dates, shared by every process using the same file; lock() lets one
+    # process at a time refresh the token
+    pass
@@ -0,0 +1,231 @@
+import os
+import json
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from ._scheduler import UploadLimiter
+from ._utils import save_data
+
+
+__all__ = ["SyncResult"]
+
+STATE_NAME = ".qiwigg-sync.json"
+# resume metadata of uploads is never synced
+SKIP_SUFFIXES = (".qiwi_upload", ".qiwi_upload_tmp")
+# the state is saved at most this often while files are uploaded
+SAVE_INTERVAL = 5
+
+
+class SyncResult:
+    def __init__(self):
+        self.uploaded = []
+        self.unchanged = 0
+        self.created_folders = []
+        self.failed = {}
+        # requests that failed and were tried again, across all uploads
+        self.retries = 0
+
+    def __bool__(self):
+        return len(self.failed) == 0
+
+    def to_dict(self):
+        return {
+            "uploaded": [file.id for file in self.uploaded],
+            "unchanged": self.unchanged,
+            "created_folders": [folder.id for folder in self.created_folders],
+            "failed": {path: str(error) for path, error in self.failed.items()},
+            "retries": self.retries,
+        }
+
+
+def _walk(root, skip=()):
+    # (relative directory, name, stat) of every file and (relative
+    # directory, None, None) of every directory, parents first; symlinked
+    # directories aren't followed, so there are no loops
+    stack = [""]
+    while stack:
+        relative = stack.pop()
+        yield relative, None, None
+        with os.scandir(root / relative if relative else root) as entries:
+            for entry in entries:
+                path = f"{relative}/{entry.name}" if relative else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(path)
+                elif (
+                    entry.is_file()
+                    and not entry.name.endswith(SKIP_SUFFIXES)
+                    and not entry.path.startswith(skip)
+                ):
+                    yield relative, entry.name, entry.stat()
+
+
+class _SyncState:
+    # what the last runs found: remote folder of every local directory and
+    # size, mtime and remote file of every local file, so unchanged files
+    # cost a stat and nothing else
+    def __init__(self, path, root, folder_id):
+        self.path = path
+        self.lock = threading.Lock()
+        self.saved_at = time.monotonic()
+        data = {}
+        if path is not None:
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+        if (data.get("root"), data.get("folder")) != (str(root), folder_id):
+            data = {}
+        self.data = {
+            "root": str(root),
+            "folder": folder_id,
+            "folders": data.get("folders", {}),
+            "files": data.get("files", {}),
+        }
+        self.folders = self.data["folders"]
+        self.files = self.data["files"]
+
+    def save(self, when_due=False):
+        if self.path is None:
+            return
+        with self.lock:
+            if when_due and time.monotonic() - self.saved_at < SAVE_INTERVAL:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            save_data(self.path, self.data)
+            self.saved_at = time.monotonic()
+
+
+def sync_directory(
+    qiwi,
+    local_dir,
+    folder_id=None,
+    state_path=None,
+    max_files=4,
+    max_parts=None,
+    max_bytes=None,
+    callback=None,
+    on_done=None,
+    **kwargs,
+):
+    root = Path(local_dir).resolve()
+    if state_path is None:
+        state_path = root / STATE_NAME
+    elif state_path is not False:
+        state_path = Path(state_path).resolve()
+    else:
+        state_path = None
+    folder_id = getattr(folder_id, "id", folder_id) or "nullFolder"
+
+    state = _SyncState(state_path, root, folder_id)
+    result = SyncResult()
+    listings = {}
+
+    def child_folder(parent_id, name):
+        if parent_id == "nullFolder":
+            parent_id = None
+        children = qiwi.folder_cache.children(parent_id)
+        return next((f for f in children if f.name == name), None)
+
+    def remote_folder(relative):
+        # the folder for a local directory, created when it's missing
+        if relative == "":
+            return folder_id
+        if relative in state.folders:
+            return state.folders[relative]
+        parent_relative, _, name = relative.rpartition("/")
+        parent_id = remote_folder(parent_relative)
+        qiwi.get_folders()
+        folder = child_folder(parent_id, name)
+        if folder is None and not qiwi._folders_just_fetched():
+            qiwi.get_folders(refresh=True)
+            folder = child_folder(parent_id, name)
+        if folder is None:
+            folder = qiwi.create_folder(
+                name, None if parent_id == "nullFolder" else parent_id
+            )
+            result.created_folders.append(folder)
+        state.folders[relative] = folder.id
+        return folder.id
+
+    def remote_files(target):
+        # listings are only loaded for folders with new or changed files
+        if target not in listings:
+            listings[target] = {}
+            for file in qiwi.iter_files(target):
+                listings[target].setdefault((file.name, file.size), file)
+        return listings[target]
+
+    # the state file, and the copies it's written to, when it's in the tree
+    skip = () if state_path is None else (str(state_path),)
+    uploads = []
+    seen = set()
+    seen_folders = set()
+    for relative, name, stat in _walk(root, skip):
+        if name is None:
+            seen_folders.add(relative)
+            remote_folder(relative)
+            continue
+        key = f"{relative}/{name}" if relative else name
+        seen.add(key)
+        known = state.files.get(key)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            result.unchanged += 1
+            continue
+        target = remote_folder(relative)
+        if known is None:
+            # synced some other way, or by a run whose state was lost
+            file = remote_files(target).get((name, stat.st_size))
+            if file is not None:
+                state.files[key] = [stat.st_size, stat.st_mtime_ns, file.id]
+                result.unchanged += 1
+                continue
+        uploads.append((key, root / key, stat, target))
+
+    # what's gone locally is forgotten, not deleted from qiwi.gg
+    for key in set(state.files) - seen:
+        del state.files[key]
+    for key in set(state.folders) - seen_folders:
+        del state.folders[key]
+    state.save()
+
+    limiter = UploadLimiter(max_parts, max_bytes)
+
+    def upload(path, target):
+        return qiwi._upload_to_folder(
+            path,
+            target,
+            callback=None if callback is None else callback(str(path)),
+            limiter=limiter,
+            **kwargs,
+        )
+
+    executor = ThreadPoolExecutor(max_workers=max(1, max_files))
+    try:
+        futures = {
+            executor.submit(upload, path, target): (key, path, stat)
+            for key, path, stat, target in uploads
+        }
+        for future in as_completed(futures):
+            key, path, stat = futures[future]
+            error = future.exception()
+            if error is None:
+                file = future.result()
+                file.path = str(path)
+                result.uploaded.append(file)
+                result.retries += file.upload_stats.get("retries", 0)
+                with state.lock:
+                    state.files[key] = [stat.st_size, stat.st_mtime_ns, file.id]
+                state.save(when_due=True)
+            else:
+                result.failed[str(path)] = error
+            if on_done is not None:
+                on_done(str(path), error)
+    finally:
+        executor.shutdown(cancel_futures=True)
+        state.save()
+
+    return result
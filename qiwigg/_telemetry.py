@@ -0,0 +1,158 @@
+import datetime
+import re
+import threading
+import time
+
+from pathlib import Path
+
+from ._utils import LockedJSONFile, save_data
+
+
+__all__ = ["MetricsExporter"]
+
+
+# phase label: upload_stats key
+PHASES = {
+    "presign": "presign_wait_seconds",
+    "queue": "queue_seconds",
+    "read": "read_seconds",
+    "put": "put_seconds",
+    "hash": "hash_seconds",
+    "retry": "retry_seconds",
+    "finalize": "finalize_seconds",
+}
+
+
+def event_emitter(on_event, **common):
+    # on_event gets one dict per event: {"event": name, "time": unix time,
+    # **common, **fields}
+    if on_event is None:
+        return None
+
+    def emit(event, **fields):
+        on_event({"event": event, "time": time.time(), **common, **fields})
+
+    return emit
+
+
+def throughput(size, seconds):
+    return round(size / seconds, 1) if seconds > 0 else None
+
+
+class MetricsExporter:
+    # upload event hook that writes a JSON summary of every upload and keeps
+    # a Prometheus textfile collector file up to date; totals live in a
+    # JSON file next to it, so every process writing to one directory adds
+    # to the same counters
+    def __init__(self, directory, prom_name="qiwigg.prom", summaries=True):
+        self.directory = Path(directory)
+        self.prom_path = self.directory / prom_name
+        self.summaries = summaries
+        self._totals = LockedJSONFile(self.directory / "qiwigg-metrics.json")
+        self._parts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        kind = event["event"]
+        if kind == "upload_started":
+            with self._lock:
+                self._parts[event["path"]] = []
+        elif kind == "part_uploaded":
+            with self._lock:
+                self._parts.setdefault(event["path"], []).append(event)
+        elif kind in ("upload_finished", "upload_failed"):
+            with self._lock:
+                parts = self._parts.pop(event["path"], [])
+            self._add_to_totals(event)
+            if self.summaries:
+                self._write_summary(event, parts)
+
+    def _write_summary(self, event, parts):
+        summaries = self.directory / "uploads"
+        summaries.mkdir(parents=True, exist_ok=True)
+        timestamp = datetime.datetime.fromtimestamp(event["time"])
+        name = re.sub(r"[^\w.-]", "_", event["name"])
+        path = summaries / f"{timestamp:%Y%m%dT%H%M%S.%f}-{name}.json"
+        save_data(path, {**event, "parts": parts})
+
+    def _add_to_totals(self, event):
+        stats = event.get("stats", {})
+        with self._totals.lock():
+            totals = self._totals.load()
+            status = "finished" if event["event"] == "upload_finished" else "failed"
+            uploads = totals.setdefault("uploads", {})
+            uploads[status] = uploads.get(status, 0) + 1
+            for key in ("bytes", "parts", "retries"):
+                totals[key] = totals.get(key, 0) + stats.get(key, 0)
+            phases = totals.setdefault("phase_seconds", {})
+            for phase, key in PHASES.items():
+                phases[phase] = phases.get(phase, 0.0) + stats.get(key, 0.0)
+            if status == "finished":
+                totals["last_throughput"] = stats.get("throughput") or 0.0
+                totals["last_finished"] = event["time"]
+            self._totals.save(totals)
+            self._write_prom(totals)
+
+    def _write_prom(self, totals):
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+
+        metric(
+            "qiwigg_uploads_total",
+            "counter",
+            "Files whose upload finished or failed.",
+            [
+                (f'{{status="{status}"}}', count)
+                for status, count in sorted(totals["uploads"].items())
+            ],
+        )
+        metric(
+            "qiwigg_upload_bytes_total",
+            "counter",
+            "Bytes of chunks uploaded.",
+            [("", totals.get("bytes", 0))],
+        )
+        metric(
+            "qiwigg_upload_parts_total",
+            "counter",
+            "Chunks uploaded.",
+            [("", totals.get("parts", 0))],
+        )
+        metric(
+            "qiwigg_upload_retries_total",
+            "counter",
+            "Chunk uploads that failed and were tried again.",
+            [("", totals.get("retries", 0))],
+        )
+        metric(
+            "qiwigg_upload_phase_seconds_total",
+            "counter",
+            "Time spent in each phase of uploads, summed over chunks.",
+            [
+                (f'{{phase="{phase}"}}', round(seconds, 6))
+                for phase, seconds in sorted(totals["phase_seconds"].items())
+            ],
+        )
+        if "last_finished" in totals:
+            metric(
+                "qiwigg_upload_last_throughput_bytes_per_second",
+                "gauge",
+                "Average throughput of the last finished upload.",
+                [("", totals["last_throughput"])],
+            )
+            metric(
+                "qiwigg_upload_last_finished_timestamp_seconds",
+                "gauge",
+                "When the last upload finished.",
+                [("", round(totals["last_finished"], 3))],
+            )
+
+        # written with a rename so the collector never reads half a file
+        tmp_path = self.prom_path.with_suffix(".prom_tmp")
+        tmp_path.write_text("\n".join(lines) + "\n")
+        tmp_path.replace(self.prom_path)
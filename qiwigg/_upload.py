@@ -1,14 +1,26 @@
-import os
 import io
+import queue
+import threading
 
-from ._exceptions import UploadFailedError
+from functools import partial
+
+from ._exceptions import QiwiGGError, UploadFailedError
+from ._ratelimit import upload_bandwidth
+from ._retry import parse_retry_after
+
+
+__all__ = ["TransportConfig"]
 
 
 def _finish(status_code, header_lines, body):
-    if status_code == 200:
-        for line in header_lines:
-            if line.upper().startswith("ETAG:"):
-                return line[5:].strip().strip('"')
+    retry_after = None
+    for line in header_lines:
+        name, _, value = line.partition(":")
+        name = name.strip().upper()
+        if name == "ETAG" and status_code == 200:
+            return value.strip().strip('"')
+        if name == "RETRY-AFTER":
+            retry_after = parse_retry_after(value.strip())
 
     headers = "\n".join(header_lines)
     if b"Worker exceeded resource limits" in body:
@@ -18,43 +30,290 @@ def _finish(status_code, header_lines, body):
         f"Upload for chunk failed!",
         body,
         headers,
+        status_code,
+        retry_after,
     )
 
 
-try:
-    import pycurl
-except ModuleNotFoundError:
-    import requests
+class TransportConfig:
+    def __init__(
+        self,
+        max_connections=8,
+        connect_timeout=30,
+        timeout=60,
+        proxies=None,
+        backend=None,
+        progress_meter=True,
+        bandwidth=upload_bandwidth,
+    ):
+        # timeout is how long a transfer may stall before it's aborted,
+        # backend is "curl", "requests" or None to pick the best available,
+        # bandwidth is a RateLimiter in bytes shared with other transports
+        # (set_upload_rate adjusts the default one) or None for no limit
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.proxies = proxies
+        self.backend = backend
+        self.progress_meter = progress_meter
+        self.bandwidth = bandwidth
+
+    @property
+    def proxy(self):
+        if not self.proxies:
+            return None
+        return self.proxies.get("https") or self.proxies.get("http")
+
+
+class RequestsTransport:
+    def __init__(self, config):
+        import requests
+        from requests.adapters import HTTPAdapter
 
-    def upload_chunk(upload_url, chunk):
-        r = requests.put(
-            upload_url, headers={"Content-Length": str(chunk.size)}, data=chunk
+        self._requests = requests
+        self.config = config
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=config.max_connections,
+            pool_maxsize=config.max_connections,
+            pool_block=True,
         )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def upload_chunk(self, upload_url, chunk):
+        try:
+            r = self.session.put(
+                upload_url,
+                headers={"Content-Length": str(chunk.size)},
+                data=chunk.views(self.config.bandwidth),
+                proxies=self.config.proxies,
+                timeout=(self.config.connect_timeout, self.config.timeout),
+            )
+        except self._requests.RequestException as e:
+            raise UploadFailedError(str(e), None, None)
+
         header_lines = [f"{k}: {v}" for k, v in r.headers.items()]
         return _finish(r.status_code, header_lines, r.content)
-else:
-    def upload_chunk(upload_url, chunk):
-        header_f = io.BytesIO()
-        body_f = io.BytesIO()
 
-        c = pycurl.Curl()
+    def close(self):
+        self.session.close()
+
+
+class _CurlTransfer:
+    def __init__(self, handle, chunk):
+        self.handle = handle
+        self.chunk = chunk
+        self.header_f = io.BytesIO()
+        self.body_f = io.BytesIO()
+        self.error = None
+        # what killed the multi thread, the transfer can't be retried here
+        self.exception = None
+        self.paused = False
+        self.done = threading.Event()
+
+
+class CurlTransport:
+    # one thread drives every transfer through a CurlMulti, whose connection
+    # cache keeps connections alive between parts and files; callers block
+    # until their own transfer is done
+    def __init__(self, config):
+        import pycurl
+
+        self._pycurl = pycurl
+        self.config = config
+
+        self._multi = pycurl.CurlMulti()
+        self._multi.setopt(pycurl.M_MAX_TOTAL_CONNECTIONS, config.max_connections)
+        self._multi.setopt(pycurl.M_MAXCONNECTS, config.max_connections)
+
+        self._idle = []
+        self._pending = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._exception = None
+
+    def _new_handle(self):
+        pycurl = self._pycurl
+        try:
+            c = self._idle.pop()
+        except IndexError:
+            c = pycurl.Curl()
+        else:
+            c.reset()
 
-        c.setopt(c.URL, upload_url)
         c.setopt(c.UPLOAD, True)
-        c.setopt(c.INFILESIZE, chunk.size)
-        c.setopt(c.READDATA, chunk)
-        c.setopt(c.WRITEDATA, body_f)
-        c.setopt(c.WRITEHEADER, header_f)
-        c.setopt(c.NOPROGRESS, False)
+        c.setopt(c.NOPROGRESS, not self.config.progress_meter)
+        c.setopt(c.CONNECTTIMEOUT, self.config.connect_timeout)
+        c.setopt(c.LOW_SPEED_LIMIT, 1)
+        c.setopt(c.LOW_SPEED_TIME, self.config.timeout)
+        if self.config.proxy is not None:
+            c.setopt(c.PROXY, self.config.proxy)
+        return c
+
+    def _check_open(self):
+        if self._exception is not None:
+            raise QiwiGGError(
+                f"Upload thread failed: {self._exception!r}"
+            ) from self._exception
+        if self._closed:
+            raise UploadFailedError("Transport is closed", None, None)
 
+    def upload_chunk(self, upload_url, chunk):
+        with self._lock:
+            self._check_open()
+            c = self._new_handle()
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="qiwigg-curl", daemon=True
+                )
+                self._thread.start()
+
+        transfer = _CurlTransfer(c, chunk)
+        c.setopt(c.URL, upload_url)
+        c.setopt(c.INFILESIZE_LARGE, chunk.size)
+        # pycurl wants bytes from its read callback, pread gives them
+        # with a single copy out of the page cache
+        if self.config.bandwidth is None:
+            c.setopt(c.READFUNCTION, chunk.read)
+        else:
+            c.setopt(c.READFUNCTION, partial(self._read, transfer))
+        c.setopt(c.WRITEDATA, transfer.body_f)
+        c.setopt(c.WRITEHEADER, transfer.header_f)
+
+        # queued under the lock, so a transfer is either queued before the
+        # multi thread fails and is failed by it, or sees it failed
+        with self._lock:
+            try:
+                self._check_open()
+            except Exception:
+                self._idle.append(c)
+                raise
+            self._pending.put(transfer)
+        transfer.done.wait()
+
+        if transfer.exception is not None:
+            raise QiwiGGError(
+                f"Upload thread failed: {transfer.exception!r}"
+            ) from transfer.exception
+
+        status_code = c.getinfo(c.RESPONSE_CODE)
+        with self._lock:
+            self._idle.append(c)
+
+        if transfer.error is not None:
+            raise UploadFailedError(transfer.error, None, None)
+
+        header_lines = transfer.header_f.getvalue().decode().splitlines()
+        return _finish(status_code, header_lines, transfer.body_f.getvalue())
+
+    def _read(self, transfer, size):
+        # runs on the multi thread, so it must not wait for the limiter;
+        # a transfer without budget is paused and resumed by _run
+        chunk = transfer.chunk
+        size = min(size, chunk.final_offset - chunk.position)
+        if size > 0:
+            size = self.config.bandwidth.take(size)
+            if size == 0:
+                transfer.paused = True
+                return self._pycurl.READFUNC_PAUSE
+        return chunk.read(size)
+
+    def _run(self):
+        active = {}
         try:
-            c.perform()
-        except pycurl.error as e:
+            self._drive(active)
+        except Exception as e:
+            # nothing drives transfers anymore: every caller waiting for one
+            # gets the error and later uploads fail right away
+            with self._lock:
+                self._exception = e
+                self._closed = True
+            failed = list(active.values())
+            while True:
+                try:
+                    transfer = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                if transfer is not None:
+                    failed.append(transfer)
+            for transfer in failed:
+                try:
+                    self._multi.remove_handle(transfer.handle)
+                except Exception:
+                    pass
+                transfer.exception = e
+                transfer.done.set()
+
+    def _drive(self, active):
+        multi = self._multi
+        while True:
+            while True:
+                try:
+                    if active:
+                        transfer = self._pending.get_nowait()
+                    else:
+                        transfer = self._pending.get()
+                except queue.Empty:
+                    break
+                if transfer is None:
+                    for transfer in active.values():
+                        multi.remove_handle(transfer.handle)
+                        transfer.error = "Transport is closed"
+                        transfer.done.set()
+                    return
+                active[id(transfer.handle)] = transfer
+                multi.add_handle(transfer.handle)
+
+            while multi.perform()[0] == self._pycurl.E_CALL_MULTI_PERFORM:
+                pass
+
+            while True:
+                queued, ok_list, err_list = multi.info_read()
+                finished = [(c, None) for c in ok_list]
+                finished += [(c, message) for c, _, message in err_list]
+                for c, error in finished:
+                    multi.remove_handle(c)
+                    transfer = active.pop(id(c))
+                    transfer.error = error
+                    transfer.done.set()
+                if queued == 0:
+                    break
+
+            if active:
+                multi.select(0.05)
+
+            for transfer in active.values():
+                if transfer.paused:
+                    transfer.paused = False
+                    transfer.handle.pause(self._pycurl.PAUSE_CONT)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        if thread is not None:
+            self._pending.put(None)
+            thread.join()
+        for c in self._idle:
             c.close()
-            raise UploadFailedError(str(e), None, None)
+        self._idle.clear()
+        self._multi.close()
 
-        status_code = c.getinfo(c.RESPONSE_CODE)
-        c.close()
 
-        header_lines = header_f.getvalue().decode().splitlines()
-        return _finish(status_code, header_lines, body_f.getvalue())
+def make_transport(config):
+    backend = config.backend
+    if backend is None:
+        try:
+            import pycurl
+        except ModuleNotFoundError:
+            backend = "requests"
+        else:
+            backend = "curl"
+
+    if backend == "curl":
+        return CurlTransport(config)
+    elif backend == "requests":
+        return RequestsTransport(config)
+    raise ValueError(f"Unknown upload backend: {backend}")
@@ -1,34 +1,159 @@
+import os
 import sys
 import json
+import tempfile
+import threading
 
+from contextlib import contextmanager
 from functools import partial
 from pathlib import Path
 
+try:
+    import fcntl
+except ModuleNotFoundError:
+    fcntl = None
+    import msvcrt
+
+from ._journal import UploadJournal
+
 
 def save_data(path, data):
+    # written to a temporary file of its own and renamed, so readers never
+    # see half a file and writers at the same time don't share one
     path = Path(path)
-    tmp_path = path.with_suffix(f"{path.suffix}_tmp")
-    with open(tmp_path, "w") as f:
-        json.dump(data, f, indent="\t")
-    tmp_path.replace(path)
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=f"{path.name}.", suffix="_tmp", dir=path.parent
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent="\t")
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class LockedJSONFile:
+    # a JSON file shared by processes: lock() lets one of them at a time
+    # read, change and save it. It can be taken again by the thread holding
+    # it, a second flock from the same process would wait for the first
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock_path = self.path.with_suffix(f"{self.path.suffix}.lock")
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+
+    @contextmanager
+    def lock(self):
+        with self._thread_lock:
+            self._depth += 1
+            try:
+                if self._depth > 1:
+                    yield
+                else:
+                    with self._file_lock():
+                        yield
+            finally:
+                self._depth -= 1
+
+    @contextmanager
+    def _file_lock(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "a+b") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save(self, data):
+        # written with a rename, so readers never see half a file
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        save_data(self.path, data)
+
+
+class SQLiteDatabase:
+    # one SQLite connection threads share, each statement or transaction
+    # under _lock; WAL lets other processes read while one writes
+    def __init__(self, path, schema, pragmas=()):
+        # sqlite3 is only imported by code that keeps a database
+        import sqlite3
+
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(
+            self.path,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            for pragma in pragmas:
+                self._db.execute(f"PRAGMA {pragma}")
+            self._db.executescript(schema)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
 def load_metadata(file_path, metadata_path):
+    # imported here, ResumeStore is built on SQLiteDatabase
+    from ._resumestore import ResumeStore
+
+    if isinstance(metadata_path, ResumeStore):
+        return metadata_path.load(file_path)
+
     file_path = Path(file_path)
 
     if metadata_path is None:
         metadata_path = file_path.with_suffix(f"{file_path.suffix}.qiwi_upload")
+    metadata_path = Path(metadata_path)
 
-    try:
-        with open(metadata_path) as f:
-            data = json.load(f)
-    except FileNotFoundError:
-        data = {}
-
-    save_metadata = partial(save_data, metadata_path, data)
+    # save_metadata(part_index) after a part is done, save_metadata() after
+    # anything else changed
+    journal = UploadJournal(metadata_path)
+    data = journal.load()
+    save_metadata = partial(journal.save, data)
 
-    return data, save_metadata, metadata_path.unlink
+    return data, save_metadata, journal.delete
 
 
 def upload_callback(uploaded, size):
     print(f"{100 * uploaded / size:.2f}% of {size} uploaded", file=sys.stderr)
+
+
+def named_upload_callback(name):
+    def callback(uploaded, size):
+        print(
+            f"{name}: {100 * uploaded / size:.2f}% of {size} uploaded",
+            file=sys.stderr,
+        )
+
+    return callback
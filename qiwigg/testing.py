@@ -0,0 +1,583 @@
+# A local stand-in for qiwi.gg, its Clerk instance and the S3 bucket uploads
+# go to, for tests and benchmarks that shouldn't touch the real site.
+#
+#     with FakeQiwi(latency=0.02, bandwidth=50e6) as server:
+#         qiwi = server.configure(QiwiGG(server.email, server.password))
+#         qiwi.upload_file("file.bin")
+#
+# or in its own process: python -m qiwigg.testing --port 8000
+
+import argparse
+import base64
+import datetime
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from collections import Counter
+from http.cookies import SimpleCookie
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from ._ratelimit import RateLimiter
+
+
+__all__ = ["FakeQiwi", "configure"]
+
+
+ROOT_FOLDER = "0" * 24
+MIN_PART_SIZE = 5242880
+
+
+def configure(qiwi, url):
+    # points a QiwiGG or AsyncQiwiGG at a server started elsewhere
+    qiwi.QIWI_URL = url
+    qiwi.QIWI_API = f"{url}/api"
+    qiwi.CLERK_API = f"{url}/v1"
+    # a cached token was given a cookie for the real site
+    session_cache = getattr(qiwi, "session_cache", None)
+    if session_cache is not None:
+        qiwi._use_cached_session(session_cache.load())
+    return qiwi
+
+
+def make_jwt(expires_at):
+    def encode(data):
+        return base64.b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+    return f'{encode({"alg": "none"})}.{encode({"exp": int(expires_at)})}.fake'
+
+
+def _object_id():
+    return uuid.uuid4().hex[:24]
+
+
+def _per_endpoint(value, endpoint):
+    # a number applies to every endpoint, a dict maps endpoint names (or
+    # "*" for the rest) to numbers
+    if isinstance(value, dict):
+        return value.get(endpoint, value.get("*", 0))
+    return value or 0
+
+
+# method, path, endpoint name; endpoint names are what latency, failures
+# and the request counters are keyed by
+ROUTES = [
+    ("GET", "/v1/environment", "environment"),
+    ("POST", "/v1/client/sign_ins", "sign_ins"),
+    (
+        "POST",
+        "/v1/client/sign_ins/(?P<sign_in>[^/]+)/attempt_first_factor",
+        "attempt_first_factor",
+    ),
+    ("GET", "/v1/client", "client"),
+    ("POST", "/v1/client/sessions/(?P<session>[^/]+)/tokens", "tokens"),
+    ("POST", "/v1/client/sessions/(?P<session>[^/]+)/touch", "touch"),
+    ("POST", "/api/privateUpload", "privateUpload"),
+    ("POST", "/api/generatePreSigned", "generatePreSigned"),
+    ("POST", "/api/completeUpload", "completeUpload"),
+    ("POST", "/api/getFolderFiles", "getFolderFiles"),
+    ("PATCH", "/api/manageFile", "manageFile"),
+    ("DELETE", "/api/manageFile", "manageFile"),
+    ("POST", "/api/manageFolder", "manageFolder"),
+    ("DELETE", "/api/manageFolder", "manageFolder"),
+    ("GET", "/dashboard", "dashboard"),
+    ("PUT", "/s3/(?P<upload>[^/]+)/(?P<part>[0-9]+)", "put"),
+]
+ROUTES = [(method, re.compile(path), name) for method, path, name in ROUTES]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes, nagle would hold the body back
+    # until the client's delayed ack
+    disable_nagle_algorithm = True
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_PATCH(self):
+        self._dispatch("PATCH")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def _dispatch(self, method):
+        fake = self.fake
+        url = urlsplit(self.path)
+        self.query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.cookies = {
+            k: morsel.value
+            for k, morsel in SimpleCookie(self.headers.get("Cookie", "")).items()
+        }
+
+        for route_method, pattern, endpoint in ROUTES:
+            match = pattern.fullmatch(url.path)
+            if match is not None and route_method == method:
+                break
+        else:
+            self._read_body()
+            self._send(404, {"success": False, "message": "Not found"})
+            return
+
+        fake._count(endpoint)
+        delay = _per_endpoint(fake.latency, endpoint)
+        if delay:
+            time.sleep(delay)
+
+        if fake._should_fail(endpoint):
+            self._read_body()
+            headers = {}
+            if fake.fail_status in (429, 503):
+                headers["Retry-After"] = "0"
+            self._send(fake.fail_status, fake.fail_body.encode(), headers)
+            return
+
+        if endpoint == "put":
+            self._put(match["upload"], int(match["part"]))
+            return
+
+        body = self._read_body()
+        if url.path.startswith("/v1/"):
+            self.data = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        else:
+            try:
+                self.data = json.loads(body) if body else {}
+            except ValueError:
+                self._send(400, {"success": False, "message": "Bad JSON"})
+                return
+            if not fake._authorized(self.cookies.get("__session")):
+                self._send(401, {"success": False, "message": "Unauthorized"})
+                return
+
+        getattr(self, f"_{endpoint}")(**match.groupdict())
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _send(self, status, body, headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+            headers = {"Content-Type": "application/json", **(headers or {})}
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # clerk
+
+    def _environment(self):
+        self._send(200, {"auth_config": {}, "display_config": {}})
+
+    def _sign_ins(self):
+        fake = self.fake
+        if self.data.get("identifier") != fake.email:
+            self._send(422, {"errors": [{"code": "form_identifier_not_found"}]})
+            return
+
+        client = self.cookies.get("__client") or uuid.uuid4().hex
+        sign_in = f"sia_{uuid.uuid4().hex}"
+        with fake._lock:
+            fake._sign_ins[sign_in] = client
+        self._send(
+            200,
+            {
+                "response": {
+                    "object": "sign_in_attempt",
+                    "id": sign_in,
+                    "status": "needs_first_factor",
+                    "supported_first_factors": [{"strategy": "password"}],
+                    "supported_second_factors": None,
+                    "first_factor_verification": None,
+                    "second_factor_verification": None,
+                },
+                "client": None,
+            },
+            {"Set-Cookie": f"__client={client}; Path=/; HttpOnly"},
+        )
+
+    def _attempt_first_factor(self, sign_in):
+        fake = self.fake
+        with fake._lock:
+            client = fake._sign_ins.pop(sign_in, None)
+        if client is None or self.data.get("password") != fake.password:
+            self._send(422, {"errors": [{"code": "form_password_incorrect"}]})
+            return
+
+        session = {
+            "id": f"sess_{uuid.uuid4().hex}",
+            "status": "active",
+            "expire_at": int((time.time() + fake.session_ttl) * 1000),
+        }
+        with fake._lock:
+            fake._sessions.setdefault(client, []).append(session)
+            sessions = list(fake._sessions[client])
+        self._send(
+            200,
+            {
+                "response": {"object": "sign_in_attempt", "status": "complete"},
+                "client": {"sessions": sessions},
+            },
+        )
+
+    def _client_sessions(self):
+        with self.fake._lock:
+            sessions = self.fake._sessions.get(self.cookies.get("__client"))
+            return None if sessions is None else list(sessions)
+
+    def _client(self):
+        sessions = self._client_sessions()
+        if sessions is None:
+            self._send(200, {"response": None})
+        else:
+            self._send(200, {"response": {"sessions": sessions}})
+
+    def _signed_out(self):
+        self._send(
+            401,
+            {"errors": [{"code": "signed_out", "long_message": "Signed out"}]},
+        )
+
+    def _tokens(self, session):
+        sessions = self._client_sessions() or []
+        if session not in [s["id"] for s in sessions]:
+            self._signed_out()
+            return
+        token = make_jwt(time.time() + self.fake.token_ttl)
+        with self.fake._lock:
+            self.fake._tokens[token] = time.time() + self.fake.token_ttl
+        self._send(200, {"object": "token", "jwt": token})
+
+    def _touch(self, session):
+        sessions = self._client_sessions() or []
+        if session not in [s["id"] for s in sessions]:
+            self._signed_out()
+            return
+        self._send(200, {"response": {"id": session}})
+
+    # qiwi api
+
+    def _privateUpload(self):
+        fake = self.fake
+        upload_id = uuid.uuid4().hex
+        file_id = _object_id()
+        with fake._lock:
+            fake.uploads[upload_id] = {
+                "key": f"uploads/{file_id}",
+                "file_id": file_id,
+                "name": self.query.get("fileName", ""),
+                "size": int(self.query.get("fileSize", 0)),
+                "parts": {},
+            }
+        self._send(
+            200,
+            {
+                "success": True,
+                "result": file_id,
+                "key": f"uploads/{file_id}",
+                "uploadId": upload_id,
+            },
+        )
+
+    def _generatePreSigned(self):
+        upload_id = self.data.get("uploadId")
+        if upload_id not in self.fake.uploads:
+            self._send(404, {"success": False, "message": "No such upload"})
+            return
+        signature = uuid.uuid4().hex
+        self._send(
+            200,
+            {
+                "success": True,
+                "preSignedUrl": (
+                    f"{self.fake.url}/s3/{upload_id}/{self.data['partNumber']}"
+                    f"?X-Amz-Expires=900&X-Amz-Signature={signature}"
+                ),
+            },
+        )
+
+    def _put(self, upload_id, part_number):
+        fake = self.fake
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self._send(411, b"Length Required")
+            self.close_connection = True
+            return
+
+        # the body is read at most bandwidth bytes per second, shared by
+        # every upload like one link would be
+        md5 = hashlib.md5()
+        left = int(length)
+        while left > 0:
+            size = min(left, 65536)
+            fake._bandwidth.acquire(size)
+            data = self.rfile.read(size)
+            if not data:
+                return
+            md5.update(data)
+            left -= len(data)
+        with fake._lock:
+            fake.bytes_received += int(length)
+            upload = fake.uploads.get(upload_id)
+            if upload is not None:
+                upload["parts"][part_number] = (md5.hexdigest(), int(length))
+
+        if upload is None:
+            self._send(404, b"<Error><Code>NoSuchUpload</Code></Error>")
+            return
+        self._send(200, b"", {"ETag": f'"{md5.hexdigest()}"'})
+
+    def _completeUpload(self):
+        fake = self.fake
+        with fake._lock:
+            upload = fake.uploads.get(self.data.get("uploadId"))
+        if upload is None:
+            self._send(404, {"success": False, "message": "No such upload"})
+            return
+
+        parts = self.data.get("parts", [])
+        sizes = []
+        for part in parts:
+            saved = upload["parts"].get(part["PartNumber"])
+            if saved is None or saved[0] != part["ETag"].strip('"'):
+                self._send(400, {"success": False, "message": "InvalidPart"})
+                return
+            sizes.append(saved[1])
+        if any(size < MIN_PART_SIZE for size in sizes[:-1]) or (
+            sum(sizes) != upload["size"]
+        ):
+            self._send(400, {"success": False, "message": "EntityTooSmall"})
+            return
+
+        file = {
+            "_id": upload["file_id"],
+            "fileName": upload["name"],
+            "fileSize": str(upload["size"]),
+            "slug": uuid.uuid4().hex[:8],
+            "folder": None,
+            "downloadCount": 0,
+        }
+        with fake._lock:
+            fake.uploads.pop(self.data["uploadId"], None)
+            fake.files[file["_id"]] = {
+                **file,
+                "createdAt": datetime.datetime.now(datetime.timezone.utc)
+                .isoformat()[:23] + "Z",
+            }
+        self._send(200, {"success": True, "result": file})
+
+    def _getFolderFiles(self):
+        folder = self.data.get("folderId")
+        if folder == "nullFolder":
+            folder = None
+        with self.fake._lock:
+            files = [f for f in self.fake.files.values() if f["folder"] == folder]
+        self._send(200, {"success": True, "folderFiles": files})
+
+    def _manageFile(self):
+        fake = self.fake
+        with fake._lock:
+            file = fake.files.get(self.data.get("fileId"))
+            if file is not None:
+                if self.command == "DELETE":
+                    del fake.files[file["_id"]]
+                else:
+                    folder = self.data.get("folderId")
+                    file["folder"] = None if folder == "nullFolder" else folder
+        if file is None:
+            self._send(404, {"success": False, "message": "File not found"})
+        else:
+            self._send(200, {"success": True})
+
+    def _manageFolder(self):
+        fake = self.fake
+        if self.command == "DELETE":
+            with fake._lock:
+                folder = fake.folders.pop(self.data.get("folderId"), None)
+            if folder is None:
+                self._send(404, {"success": False, "message": "Folder not found"})
+            else:
+                self._send(200, {"success": True})
+            return
+
+        parent = self.data.get("parentFolder")
+        if parent in (None, "nullFolder"):
+            parent = ROOT_FOLDER
+        folder = {
+            "_id": _object_id(),
+            "folderName": self.data.get("folderName"),
+            "parentFolder": parent,
+        }
+        with fake._lock:
+            fake.folders[folder["_id"]] = folder
+        self._send(
+            200,
+            {
+                "success": True,
+                "folderId": folder["_id"],
+                "folderName": folder["folderName"],
+            },
+        )
+
+    def _dashboard(self):
+        # the folder list is in the "f:" chunk of the Next.js flight data
+        with self.fake._lock:
+            folders = [{"_id": ROOT_FOLDER, "folderName": "Home"}]
+            folders += list(self.fake.folders.values())
+        flight = json.dumps(["$", "$L1", None, {"data": folders}])
+        payload = json.dumps(f"f:{flight}\n")
+        page = (
+            "<!DOCTYPE html><html><body>"
+            f"<script>self.__next_f.push([1,{payload}])</script>"
+            "</body></html>"
+        )
+        self._send(200, page.encode(), {"Content-Type": "text/html"})
+
+
+class FakeQiwi:
+    # latency (seconds) and failures (chance of answering with fail_status)
+    # are numbers for every endpoint or dicts by endpoint name, see ROUTES;
+    # bandwidth is bytes per second of all chunk uploads together
+    def __init__(
+        self,
+        email="user@example.com",
+        password="password",
+        latency=0.0,
+        bandwidth=None,
+        failures=0.0,
+        fail_status=503,
+        fail_body="Injected failure",
+        token_ttl=60,
+        session_ttl=7 * 86400,
+        host="127.0.0.1",
+        port=0,
+        seed=None,
+    ):
+        self.email = email
+        self.password = password
+        self.latency = latency
+        self.failures = failures
+        self.fail_status = fail_status
+        self.fail_body = fail_body
+        self.token_ttl = token_ttl
+        self.session_ttl = session_ttl
+        self.host = host
+        self.port = port
+
+        self._bandwidth = RateLimiter(bandwidth)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+        self.requests = Counter()
+        self.failed = Counter()
+        self.bytes_received = 0
+        self.files = {}
+        self.folders = {}
+        self.uploads = {}
+        self._sign_ins = {}
+        self._sessions = {}
+        self._tokens = {}
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def set_bandwidth(self, bandwidth):
+        self._bandwidth.set_rate(bandwidth)
+
+    def start(self):
+        handler = type("Handler", (_Handler,), {"fake": self})
+        self._server = ThreadingHTTPServer((self.host, self.port), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="qiwigg-fake", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def configure(self, qiwi):
+        return configure(qiwi, self.url)
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] += 1
+
+    def _should_fail(self, endpoint):
+        chance = _per_endpoint(self.failures, endpoint)
+        with self._lock:
+            failed = chance > 0 and self._random.random() < chance
+            if failed:
+                self.failed[endpoint] += 1
+        return failed
+
+    def _authorized(self, token):
+        with self._lock:
+            return self._tokens.get(token, 0) > time.time()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m qiwigg.testing",
+        description="Serve a fake qiwi.gg for tests and benchmarks.",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--email", default="user@example.com")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--latency", type=float, default=0.0, metavar="SECONDS")
+    parser.add_argument("--bandwidth", type=float, metavar="BYTES_PER_SECOND")
+    parser.add_argument("--failures", type=float, default=0.0, metavar="CHANCE")
+    parser.add_argument("--fail-status", type=int, default=503)
+    args = parser.parse_args()
+
+    server = FakeQiwi(
+        args.email,
+        args.password,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        failures=args.failures,
+        fail_status=args.fail_status,
+        host=args.host,
+        port=args.port,
+    ).start()
+    # the first line is the URL, for whoever started this process
+    print(server.url, flush=True)
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import threading
+import time
+
+import pytest
+
+from qiwigg import QiwiGG, TransportConfig
+from qiwigg.testing import FakeQiwi
+
+
+def make_client(server, tmp_path, **kwargs):
+    return server.configure(
+        QiwiGG(
+            server.email,
+            server.password,
+            tmp_path / "cookies.txt",
+            transport_config=TransportConfig(progress_meter=False),
+            **kwargs,
+        )
+    )
+
+
+@pytest.fixture
+def server():
+    # tokens are valid for 2 s, their expiry minus the 2 s safety margin
+    with FakeQiwi(token_ttl=4) as server:
+        yield server
+
+
+def test_expired_token_is_refreshed_once(server, tmp_path):
+    qiwi = make_client(server, tmp_path)
+    qiwi._get_token()
+    time.sleep(2.5)
+    tokens = server.requests["tokens"]
+
+    barrier = threading.Barrier(16)
+
+    def get_token():
+        barrier.wait()
+        qiwi._get_token()
+
+    threads = [threading.Thread(target=get_token) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert server.requests["tokens"] == tokens + 1
+    qiwi.close()
+
+
+def test_used_token_is_renewed_in_background(server, tmp_path):
+    qiwi = make_client(server, tmp_path, refresh_ahead=1)
+    qiwi._get_token()
+    for _ in range(8):
+        time.sleep(0.5)
+        assert qiwi._token_valid()
+        qiwi._get_token()
+    qiwi.close()
+
+
+@pytest.mark.parametrize("refresh_ahead", [1, 60])
+def test_idle_client_mints_no_tokens(server, tmp_path, refresh_ahead):
+    # refresh_ahead longer than a token's lifetime is cut to half of it
+    qiwi = make_client(server, tmp_path, refresh_ahead=refresh_ahead)
+    qiwi._get_token()
+    # the refresher may renew the token that was used once
+    time.sleep(1.5)
+    tokens = server.requests["tokens"]
+    time.sleep(4)
+    assert server.requests["tokens"] == tokens
+    qiwi.close()
@@ -0,0 +1,28 @@
+import json
+import threading
+
+from qiwigg import ChunkSizer
+
+
+def test_concurrent_records_are_all_saved(tmp_path):
+    path = tmp_path / "upload-history.json"
+    sizer = ChunkSizer(path, history=50)
+    errors = []
+
+    def record():
+        for _ in range(300):
+            try:
+                sizer.record(1048576, 0.1, 1, 0)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with open(path) as f:
+        assert len(json.load(f)["samples"]) == 50
+    assert [p.name for p in tmp_path.iterdir()] == [path.name]
@@ -0,0 +1,45 @@
+import threading
+
+import pytest
+
+from qiwigg import QiwiGGError, TransportConfig
+from qiwigg._chunk import MemoryChunk
+from qiwigg._upload import make_transport
+
+pytest.importorskip("pycurl")
+
+
+class BrokenMulti:
+    def add_handle(self, handle):
+        raise RuntimeError("boom")
+
+    def remove_handle(self, handle):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_failed_multi_thread_fails_waiting_and_later_uploads():
+    transport = make_transport(TransportConfig(backend="curl"))
+    transport._multi = BrokenMulti()
+    errors = []
+
+    def upload():
+        try:
+            transport.upload_chunk("http://127.0.0.1:9/", MemoryChunk(b"x", 1))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=upload, daemon=True) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+        assert not thread.is_alive()
+
+    assert len(errors) == 4
+    assert all(isinstance(error, QiwiGGError) for error in errors)
+    with pytest.raises(QiwiGGError, match="boom"):
+        transport.upload_chunk("http://127.0.0.1:9/", MemoryChunk(b"x", 1))
+    transport.close()
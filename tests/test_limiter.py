@@ -0,0 +1,57 @@
+import threading
+import time
+
+from qiwigg import QiwiGG, RetryPolicy, UploadFailedError
+from qiwigg._scheduler import UploadLimiter
+from qiwigg._chunk import MemoryChunk
+
+
+class StubPresigner:
+    def get(self, part):
+        return f"part-{part}"
+
+    def expired(self, part):
+        return False
+
+
+class StubTransport:
+    # the first upload of "slow" fails, every other one succeeds
+    def __init__(self):
+        self.failed = False
+        self.uploaded = []
+
+    def upload_chunk(self, url, chunk):
+        if url == "part-1" and not self.failed:
+            self.failed = True
+            raise UploadFailedError("Injected failure", "", "", 503)
+        self.uploaded.append((url, time.monotonic()))
+        return "etag"
+
+    def close(self):
+        pass
+
+
+def test_part_backing_off_releases_its_slot(tmp_path):
+    qiwi = QiwiGG(cookie_jar_path=tmp_path / "cookies.txt")
+    qiwi._transport = StubTransport()
+    qiwi.retry_policy = RetryPolicy(base_delay=1.0, throttle_delay=1.0, jitter=0)
+    limiter = UploadLimiter(max_parts=1)
+
+    def upload(index):
+        qiwi._upload_part(
+            StubPresigner(), limiter, None, MemoryChunk(b"x" * 16, 16), index
+        )
+
+    started = time.monotonic()
+    backing_off = threading.Thread(target=upload, args=(0,))
+    backing_off.start()
+    while not qiwi._transport.failed:
+        time.sleep(0.01)
+    # another file's part gets the only slot while the first one waits
+    upload(1)
+    assert time.monotonic() - started < 0.5
+    backing_off.join()
+
+    assert [url for url, _ in qiwi._transport.uploaded] == ["part-2", "part-1"]
+    assert limiter.parts == 0
+    qiwi.close()
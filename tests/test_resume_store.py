@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from qiwigg import QiwiGG, ResumeStore, TransportConfig
+from qiwigg.testing import FakeQiwi
+
+
+class Stop(Exception):
+    pass
+
+
+def stop_after(limit):
+    def callback(uploaded, size):
+        if uploaded >= limit:
+            raise Stop
+    return callback
+
+
+def test_resumed_upload_goes_to_its_destination(tmp_path):
+    chunk_size = 5 * 2**20
+    path = tmp_path / "a.bin"
+    path.write_bytes(os.urandom(3 * chunk_size))
+
+    with FakeQiwi() as server, ResumeStore(tmp_path / "uploads.sqlite") as store:
+        qiwi = server.configure(
+            QiwiGG(
+                server.email,
+                server.password,
+                tmp_path / "cookies.txt",
+                transport_config=TransportConfig(progress_meter=False),
+            )
+        )
+        folder = qiwi.create_folder("photos")
+
+        with pytest.raises(Stop):
+            list(qiwi.upload_files(
+                [path],
+                folder,
+                callback=lambda path: stop_after(chunk_size),
+                chunk_size=chunk_size,
+                metadata_path=store,
+            ))
+        [upload] = store.pending()
+        assert upload["destination"] == folder.id
+
+        [(_, file)] = qiwi.upload_files(
+            [upload["path"]],
+            upload["destination"],
+            callback=None,
+            chunk_size="auto",
+            metadata_path=store,
+        )
+        assert server.files[file.id]["folder"] == folder.id
+        assert store.pending() == []
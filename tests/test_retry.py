@@ -0,0 +1,69 @@
+import socket
+
+import pytest
+
+from qiwigg import QiwiGG, QiwiGGError, RetryPolicy, TransportConfig
+from qiwigg.testing import FakeQiwi
+
+
+def make_client(server, tmp_path):
+    qiwi = server.configure(
+        QiwiGG(
+            server.email,
+            server.password,
+            tmp_path / "cookies.txt",
+            transport_config=TransportConfig(progress_meter=False),
+            retry_policy=RetryPolicy(base_delay=0, throttle_delay=0, jitter=0),
+        )
+    )
+    qiwi._get_token()
+    return qiwi
+
+
+@pytest.mark.parametrize("status", [500, 503])
+def test_create_isnt_retried_after_ambiguous_failure(tmp_path, status):
+    with FakeQiwi(failures={"manageFolder": 1.0}, fail_status=status) as server:
+        qiwi = make_client(server, tmp_path)
+        with pytest.raises(QiwiGGError):
+            qiwi.create_folder("a")
+        assert server.requests["manageFolder"] == 1
+
+
+def test_create_is_retried_when_throttled(tmp_path):
+    with FakeQiwi(failures={"privateUpload": 0.5}, fail_status=429, seed=1) as server:
+        qiwi = make_client(server, tmp_path)
+        for _ in range(5):
+            qiwi._initialize_upload("a", 1)
+        assert server.failed["privateUpload"] > 0
+        assert server.requests["privateUpload"] == 5 + server.failed["privateUpload"]
+
+
+def test_create_is_retried_when_refused(tmp_path):
+    with FakeQiwi() as server:
+        qiwi = make_client(server, tmp_path)
+        # nothing listens on a port that was just bound and released
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        request = qiwi.session.request
+        calls = []
+
+        def refuse_first(method, url, **kwargs):
+            calls.append(url)
+            if len(calls) == 1:
+                url = f"http://127.0.0.1:{port}/"
+            return request(method, url, **kwargs)
+
+        qiwi.session.request = refuse_first
+        qiwi.create_folder("a")
+        assert len(calls) == 2
+        assert server.requests["manageFolder"] == 1
+
+
+def test_timeout_isnt_retried_for_create(tmp_path):
+    with FakeQiwi(latency={"manageFolder": 1.0}) as server:
+        qiwi = make_client(server, tmp_path)
+        qiwi.timeout = 0.2
+        with pytest.raises(QiwiGGError):
+            qiwi.create_folder("a")
+        assert server.requests["manageFolder"] == 1
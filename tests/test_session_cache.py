@@ -0,0 +1,79 @@
+import json
+import multiprocessing
+
+import pytest
+
+from qiwigg import QiwiGG, TransportConfig
+from qiwigg.testing import FakeQiwi
+
+
+def make_client(server, config_dir):
+    return server.configure(
+        QiwiGG(
+            server.email,
+            server.password,
+            f"{config_dir}/cookies.txt",
+            transport_config=TransportConfig(progress_meter=False),
+            session_cache_path=f"{config_dir}/session.json",
+        )
+    )
+
+
+def use_client(server, config_dir, queue):
+    try:
+        qiwi = make_client(server, config_dir)
+        qiwi.get_files()
+        # new tokens and session lookups save the cache at the same time
+        # as the other processes
+        for _ in range(20):
+            qiwi._refresh_token()
+            qiwi._get_session()
+        qiwi.close()
+    except Exception as e:
+        queue.put(repr(e))
+    else:
+        queue.put(None)
+
+
+def run_processes(server, config_dir, count):
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    processes = [
+        context.Process(
+            target=use_client,
+            args=(server, config_dir, queue),
+        )
+        for _ in range(count)
+    ]
+    for process in processes:
+        process.start()
+    results = [queue.get(timeout=60) for _ in processes]
+    for process in processes:
+        process.join()
+    return results
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="needs fork"
+)
+def test_processes_share_the_session_cache(tmp_path):
+    with FakeQiwi() as server:
+        # logged in once, so every process uses the same session
+        qiwi = make_client(server, tmp_path)
+        qiwi.get_files()
+        qiwi.close()
+
+        assert run_processes(server, tmp_path, 8) == [None] * 8
+
+        with open(tmp_path / "session.json") as f:
+            cached = json.load(f)
+        assert cached["token"] and cached["session_name"]
+        assert not [p for p in tmp_path.iterdir() if p.name.endswith("_tmp")]
+
+        # a session lookup keeps the token another process saved
+        qiwi = make_client(server, tmp_path)
+        requests = server.requests.copy()
+        qiwi.get_files()
+        assert server.requests["sign_ins"] == requests["sign_ins"]
+        assert server.requests["tokens"] == requests["tokens"]
+        qiwi.close()